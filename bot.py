@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import src.bot
+import src.shard
 import configparser
 import logging
 
@@ -12,5 +13,9 @@ if(conf['Connection'].get('debug').lower() == 'true'):
 else:
 	logging.getLogger().setLevel(logging.INFO)
 
-bot = src.bot.Bot(conf)
-bot.start()
+if src.shard.sharded(conf):
+	# One process per shard, each with its own connection
+	src.shard.Coordinator(conf).start()
+else:
+	bot = src.bot.Bot(conf)
+	bot.start()
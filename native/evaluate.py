@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# Offline accuracy and speed evaluation for the death detector.
+#
+# Runs the morbidcv Python extension over a directory of recorded videos, each
+# with a JSON sidecar listing when deaths happen ("video.mp4.json" containing
+# {"deaths": [seconds, ...]}), or over synthetic clips made by compositing
+# bobross.png onto generated frames. Every (video, configuration) pair runs in
+# its own worker process so peak memory can be measured per run.
+#
+#   python3 evaluate.py --synthetic 8 --config fast=1 --config divisor=1
+#   python3 evaluate.py --videos ~/vods --config idle_divisor=8 --jobs 4
+import argparse, json, multiprocessing, os, os.path, resource, sys, tempfile, time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bobross.png')
+VIDEO_EXTS = ('.mp4', '.mkv', '.flv', '.ts', '.avi')
+
+# Message region, as in detector.hpp
+MSG_REGION = (0.14, 0.4, 0.85, 0.65)
+
+def parse_config(text):
+        conf = {}
+        if text == 'default':
+                return conf
+        for part in text.split(','):
+                k, v = part.split('=')
+                conf[k.strip()] = int(v)
+        return conf
+
+def config_name(conf):
+        if not conf:
+                return 'default'
+        return ','.join('%s=%d' % kv for kv in sorted(conf.items()))
+
+def load_labels(video):
+        with open(video + '.json') as f:
+                return json.load(f)['deaths']
+
+def find_videos(root):
+        res = []
+        for name in sorted(os.listdir(root)):
+                pth = os.path.join(root, name)
+                if name.lower().endswith(VIDEO_EXTS) and os.path.exists(pth + '.json'):
+                        res.append(pth)
+        return res
+
+def make_synthetic(path, seed, seconds=60, fps=30, size=(1280, 720)):
+        import cv2, numpy as np
+        rng = np.random.RandomState(seed)
+        ross = cv2.imread(TEMPLATE, 1)
+        w, h = size
+        x0, y0 = int(w * MSG_REGION[0]), int(h * MSG_REGION[1])
+        x1, y1 = int(w * MSG_REGION[2]), int(h * MSG_REGION[3])
+
+        # A few deaths, each showing the message for 2-5 seconds
+        deaths = []
+        t = rng.uniform(3, 10)
+        while t < seconds - 8:
+                deaths.append((t, rng.uniform(2, 5)))
+                t += rng.uniform(10, 20)
+
+        out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+        base = rng.randint(0, 255, (h // 8, w // 8, 3)).astype(np.uint8)
+        base = cv2.resize(base, size, interpolation=cv2.INTER_CUBIC)
+        for i in range(int(seconds * fps)):
+                now = i / fps
+                frame = np.roll(base, i * 2, axis=1)
+                frame = cv2.add(frame, rng.randint(0, 20, frame.shape).astype(np.uint8))
+                for start, length in deaths:
+                        if start <= now < start + length:
+                                ry = y0 + (y1 - y0 - ross.shape[0]) // 2
+                                for rx in (x0 + 40, x1 - 40 - ross.shape[1]):
+                                        frame[ry:ry+ross.shape[0], rx:rx+ross.shape[1]] = ross
+                out.write(frame)
+        out.release()
+
+        with open(path + '.json', 'w') as f:
+                json.dump({'deaths': [d[0] for d in deaths], 'synthetic': True}, f)
+        return path
+
+def run_one(task):
+        video, conf = task
+        import cv2, morbidcv
+        det = morbidcv.Detector(TEMPLATE, **conf)
+        cap = cv2.VideoCapture(video)
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+
+        events = []
+        frames = 0
+        start = time.time()
+        while True:
+                ok, frame = cap.read()
+                if not ok:
+                        break
+                frames += 1
+                ev = det.feed(frame)
+                if ev is not None:
+                        events.append(ev[1])
+        elapsed = time.time() - start
+        cap.release()
+
+        # ru_maxrss is in kilobytes on Linux; each task has its own process
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        return {
+                'video': video,
+                'config': config_name(conf),
+                'fps': fps,
+                'frames': frames,
+                'elapsed': elapsed,
+                'detections': events,
+                'peak_mb': peak,
+        }
+
+def score(result, labels, tolerance):
+        # A detection counts for a death if it fires within `tolerance`
+        # seconds after the message appears; each death matches at most once.
+        fps = result['fps']
+        truth = sorted(int(t * fps) for t in labels)
+        window = tolerance * fps
+        used = set()
+        tp, latencies = 0, []
+        for d in result['detections']:
+                for i, t in enumerate(truth):
+                        if i not in used and t <= d <= t + window:
+                                used.add(i)
+                                tp += 1
+                                latencies.append(d - t)
+                                break
+        return tp, len(result['detections']) - tp, len(truth) - tp, latencies
+
+def main():
+        ap = argparse.ArgumentParser()
+        ap.add_argument('--videos', help='directory of labelled recordings')
+        ap.add_argument('--synthetic', type=int, default=0,
+                        help='number of synthetic clips to generate')
+        ap.add_argument('--config', action='append', default=[],
+                        help='detector options, e.g. fast=1,idle_divisor=8')
+        ap.add_argument('--jobs', type=int, default=os.cpu_count())
+        ap.add_argument('--tolerance', type=float, default=35.0,
+                        help='seconds after a death a detection may arrive')
+        ap.add_argument('--module-path', default=os.path.join(
+                        os.path.dirname(os.path.abspath(__file__)), 'build'),
+                        help='directory containing the built morbidcv extension')
+        ap.add_argument('--json', help='also write raw results here')
+        args = ap.parse_args()
+
+        sys.path.insert(0, args.module_path)
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+                        [args.module_path, os.environ.get('PYTHONPATH', '')])
+
+        videos = find_videos(args.videos) if args.videos else []
+        tmp = None
+        if args.synthetic:
+                tmp = tempfile.mkdtemp(prefix='morbidcv-eval-')
+                for i in range(args.synthetic):
+                        videos.append(make_synthetic(os.path.join(tmp, 'synth%d.mp4' % i), i))
+        if not videos:
+                ap.error('no labelled videos to evaluate')
+
+        configs = [parse_config(c) for c in (args.config or ['default'])]
+        tasks = [(v, c) for c in configs for v in videos]
+
+        pool = multiprocessing.Pool(args.jobs, maxtasksperchild=1)
+        results = pool.map(run_one, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+
+        print('%-32s %6s %6s %8s %8s %8s %8s' % ('config', 'prec', 'recall',
+                'lat avg', 'lat max', 'fps', 'peak MB'))
+        for conf in configs:
+                name = config_name(conf)
+                rows = [r for r in results if r['config'] == name]
+                tp = fp = fn = 0
+                lats = []
+                for r in rows:
+                        t, f, n, l = score(r, load_labels(r['video']), args.tolerance)
+                        tp, fp, fn = tp + t, fp + f, fn + n
+                        lats.extend(l)
+                frames = sum(r['frames'] for r in rows)
+                elapsed = sum(r['elapsed'] for r in rows)
+                print('%-32s %6.3f %6.3f %8.1f %8d %8.1f %8.1f' % (name,
+                        tp / max(tp + fp, 1), tp / max(tp + fn, 1),
+                        sum(lats) / max(len(lats), 1), max(lats or [0]),
+                        frames / max(elapsed, 1e-9),
+                        max(r['peak_mb'] for r in rows)))
+
+        if args.json:
+                with open(args.json, 'w') as f:
+                        json.dump(results, f, indent=2)
+        if tmp:
+                print('Synthetic clips kept in %s' % tmp)
+
+if __name__ == '__main__':
+        main()
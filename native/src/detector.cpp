@@ -0,0 +1,215 @@
+#include "detector.hpp"
+
+#include <cstdlib>
+#include <algorithm>
+
+using namespace std;
+using namespace cv;
+
+void fastMultiMatch(const Mat& img, const Mat& templ, vector<Point>& results, double thresh) {
+    // perform template matching
+    Mat res = Mat::zeros(img.size() + Size(1,1) - templ.size(), CV_32FC1);
+
+    matchTemplate(img, templ, res, CV_TM_CCORR_NORMED);
+    threshold(res, res, 0.9, 1, CV_THRESH_TOZERO);
+
+    Point minloc, maxloc;
+    double minval, maxval;
+    while(true) {
+        minMaxLoc(res, &minval, &maxval, &minloc, &maxloc);
+
+        if(maxval >= thresh) {
+            // extract best values
+            results.push_back(maxloc);
+            floodFill(res, maxloc, Scalar(0), 0, Scalar(.1), Scalar(1.));
+        } else {
+            break;
+        }
+    }
+}
+
+void coarseToFineMatch(const Mat& img, const Mat& templ, const Mat& coarseTempl,
+        int levels, vector<Point>& results) {
+    // shrink the search image to the template's coarse scale
+    Mat small = img;
+    for(int i = 0; i < levels; i++) {
+        Mat next;
+        pyrDown(small, next);
+        small = next;
+    }
+    if(small.cols < coarseTempl.cols || small.rows < coarseTempl.rows)
+        return;
+
+    Mat res;
+    matchTemplate(small, coarseTempl, res, CV_TM_CCORR_NORMED);
+    threshold(res, res, COARSE_THRESHOLD, 1, CV_THRESH_TOZERO);
+
+    // confirm the strongest coarse candidates at full resolution
+    int scale = 1 << levels;
+    Point minloc, maxloc;
+    double minval, maxval;
+    for(int n = 0; n < MAX_CANDIDATES; n++) {
+        minMaxLoc(res, &minval, &maxval, &minloc, &maxloc);
+        if(maxval < COARSE_THRESHOLD)
+            break;
+        floodFill(res, maxloc, Scalar(0), 0, Scalar(.1), Scalar(1.));
+
+        Point found;
+        if(!matchNear(img, templ, maxloc * scale, scale * 2, found))
+            continue;
+
+        // neighbouring candidates can resolve to the same Ross
+        bool dup = false;
+        for(const Point& p : results) {
+            if(abs(p.x - found.x) < templ.cols / 2 && abs(p.y - found.y) < templ.rows / 2)
+                dup = true;
+        }
+        if(!dup)
+            results.push_back(found);
+    }
+}
+
+bool matchNear(const Mat& img, const Mat& templ, Point guess, int margin,
+        Point& found) {
+    Rect window(guess.x - margin, guess.y - margin,
+            templ.cols + 2 * margin, templ.rows + 2 * margin);
+    window &= Rect(0, 0, img.cols, img.rows);
+    if(window.width < templ.cols || window.height < templ.rows)
+        return false;
+
+    Mat res;
+    matchTemplate(img(window), templ, res, CV_TM_CCORR_NORMED);
+
+    Point minloc, maxloc;
+    double minval, maxval;
+    minMaxLoc(res, &minval, &maxval, &minloc, &maxloc);
+    if(maxval < MATCH_THRESHOLD)
+        return false;
+    found = maxloc + window.tl();
+    return true;
+}
+
+Mat messageRegion(const Mat& frame) {
+    Size imsize = frame.size();
+    return frame(Rect(
+                imsize.width    * MSG_REGION_START_X,
+                imsize.height   * MSG_REGION_START_Y,
+                imsize.width    * (MSG_REGION_END_X - MSG_REGION_START_X),
+                imsize.height   * (MSG_REGION_END_Y - MSG_REGION_START_Y)));
+}
+
+FrameSampler::FrameSampler(int divisor, int idleDivisor)
+    : divisor(divisor < 1 ? 1 : divisor), idleDivisor(idleDivisor),
+      since(0), lastStep(1) {
+    current = adaptive() ? this->idleDivisor : this->divisor;
+}
+
+bool FrameSampler::sample() {
+    since++;
+    if(since < current)
+        return false;
+    lastStep = since;
+    since = 0;
+    return true;
+}
+
+void FrameSampler::update(bool candidate) {
+    if(!adaptive())
+        return;
+    if(candidate) {
+        current = 1;
+    } else {
+        // back off gradually so a flickering match isn't missed
+        current = std::min(current * 2, idleDivisor);
+    }
+}
+
+RossDetector::RossDetector(const Mat& templ, int minFrames, int maxFrames, bool fast)
+    : templ(templ), minFrames(minFrames), maxFrames(maxFrames), seen(0),
+      lastDeath(0), fast(fast), refHeight(0), trackHits(0) {
+    coarseTempl = templ;
+    for(int i = 0; i < COARSE_LEVELS; i++) {
+        Mat next;
+        pyrDown(coarseTempl, next);
+        coarseTempl = next;
+    }
+}
+
+void RossDetector::findRosses(RossMatch& out, const RossMatch *prev) const {
+    if(!fast) {
+        fastMultiMatch(out.msg, templ, out.pts, 0.1);
+        return;
+    }
+
+    // Rosses barely move while the message is up, so look where they were
+    if(prev != NULL && prev->aligned) {
+        Point l, r;
+        if(matchNear(out.msg, templ, prev->pts[0], TRACK_MARGIN, l) &&
+                matchNear(out.msg, templ, prev->pts[1], TRACK_MARGIN, r)) {
+            out.pts.push_back(l);
+            out.pts.push_back(r);
+            out.tracked = true;
+            return;
+        }
+    }
+
+    coarseToFineMatch(out.msg, templ, coarseTempl, COARSE_LEVELS, out.pts);
+}
+
+void RossDetector::match(const Mat& frame, RossMatch& out, const RossMatch *prev) const {
+    out.pts.clear();
+    out.aligned = false;
+    out.tracked = false;
+
+    out.msg = messageRegion(frame);
+    if(refHeight > 0 && frame.rows != refHeight) {
+        Mat scaled;
+        double s = (double)refHeight / frame.rows;
+        resize(out.msg, scaled, Size(), s, s, INTER_AREA);
+        out.msg = scaled;
+    }
+    findRosses(out, prev);
+
+    std::vector<Point>& pts = out.pts;
+    if(pts.size() == 2) {
+        // identify left and right points
+        Point left, right;
+        if(pts[0].x < pts[1].x) {
+            left = pts[0];
+            right = pts[1];
+        } else {
+            left = pts[1];
+            right = pts[0];
+        }
+        out.lcenter = Point(left.x + (templ.cols/2), left.y + (templ.rows/2));
+        out.rcenter = Point(right.x + (templ.cols/2), right.y + (templ.rows/2));
+
+        // make sure the Rosses are aligned by comparing their X and Y distances
+        out.aligned = (out.rcenter-out.lcenter).y < 8;
+    }
+}
+
+bool RossDetector::advance(const RossMatch& m, int step) {
+    last = m;
+    if(m.tracked)
+        trackHits++;
+
+    if(m.aligned) {
+        seen += step;
+        return false;
+    }
+
+    if(seen > minFrames && seen < maxFrames) {
+        lastDeath = seen;
+        seen = -999999999;
+        return true;
+    }
+    seen = 0;
+    return false;
+}
+
+bool RossDetector::feed(const Mat& frame, int step) {
+    RossMatch m;
+    match(frame, m, fast ? &last : NULL);
+    return advance(m, step);
+}
@@ -0,0 +1,135 @@
+#ifndef MORBIDCV_DETECTOR_HPP
+#define MORBIDCV_DETECTOR_HPP
+
+#include "opencv2/opencv.hpp"
+#include <vector>
+
+// Default sampling: analyse every FRAME_DIVISOR'th frame, or in adaptive
+// mode every IDLE_DIVISOR'th frame until a Ross shows up
+#define FRAME_DIVISOR 3
+#define IDLE_DIVISOR 8
+
+// How long the message must be up, in source frames regardless of sampling
+#define MIN_ROSS_FRAMES 30
+#define MAX_ROSS_FRAMES 900
+
+// Frame positioning constants
+#define MSG_REGION_START_X 0.14
+#define MSG_REGION_START_Y 0.4
+#define MSG_REGION_END_X 0.85
+#define MSG_REGION_END_Y 0.65
+
+// Fast mode: match at 1/2^COARSE_LEVELS scale first, then confirm each
+// candidate at full resolution inside a small window around it
+#define COARSE_LEVELS 2
+#define COARSE_THRESHOLD 0.85
+#define MATCH_THRESHOLD 0.9
+#define MAX_CANDIDATES 8
+#define TRACK_MARGIN 12
+
+void fastMultiMatch(const cv::Mat& img, const cv::Mat& templ,
+        std::vector<cv::Point>& results, double thresh);
+
+void coarseToFineMatch(const cv::Mat& img, const cv::Mat& templ,
+        const cv::Mat& coarseTempl, int levels, std::vector<cv::Point>& results);
+
+// Best full resolution match inside templ-sized window around guess, widened
+// by margin on every side. Returns false if nothing matches well enough.
+bool matchNear(const cv::Mat& img, const cv::Mat& templ, cv::Point guess,
+        int margin, cv::Point& found);
+
+// Extracts the region of the frame where the death message appears
+cv::Mat messageRegion(const cv::Mat& frame);
+
+// Decides which source frames get analysed. With a fixed divisor every
+// divisor'th frame is sampled; in adaptive mode the interval grows towards
+// idleDivisor while nothing is on screen and drops to every frame as soon as
+// the detector reports a candidate.
+class FrameSampler {
+public:
+    FrameSampler(int divisor = FRAME_DIVISOR, int idleDivisor = 0);
+
+    // Call for every source frame; true if this one should be analysed
+    bool sample();
+    // Source frames covered by the last sample
+    int step() const { return lastStep; }
+    // Feed back whether the analysed frame showed anything interesting
+    void update(bool candidate);
+
+    int interval() const { return current; }
+    bool adaptive() const { return idleDivisor > divisor; }
+
+private:
+    int divisor, idleDivisor;
+    int current, since, lastStep;
+};
+
+// Result of matching one frame. Produced independently per frame, so frames
+// can be matched on several threads and then fed to the state machine in order.
+struct RossMatch {
+    RossMatch() : aligned(false), tracked(false) {}
+
+    cv::Mat msg;
+    std::vector<cv::Point> pts;
+    bool aligned;
+    cv::Point lcenter, rcenter;
+    bool tracked; // found by the tracking window alone
+};
+
+// Death detection state machine. Feed it every sampled frame along with the
+// number of source frames it stands for; it reports a death once two aligned
+// Rosses have been visible for between minFrames and maxFrames source frames.
+class RossDetector {
+public:
+    RossDetector(const cv::Mat& templ, int minFrames = MIN_ROSS_FRAMES,
+            int maxFrames = MAX_ROSS_FRAMES, bool fast = false);
+
+    // Returns true if a death finished on this frame
+    bool feed(const cv::Mat& frame, int step = 1);
+
+    // The two halves of feed(). match() only reads detector state and is
+    // safe to call from several threads at once; advance() must see the
+    // results in frame order. prev enables tracking in fast mode.
+    void match(const cv::Mat& frame, RossMatch& out,
+            const RossMatch *prev = NULL) const;
+    bool advance(const RossMatch& m, int step = 1);
+
+    // Match at a fixed frame height, scaling the message region to suit the
+    // template when the source is decoded at a different resolution
+    void setReferenceHeight(int height) { refHeight = height; }
+
+    // Whether anything Ross-like was visible on the last analysed frame
+    bool candidate() const { return !last.pts.empty(); }
+
+    void reset() { seen = 0; last = RossMatch(); }
+    int seenFrames() const { return seen; }
+    // Source frames the message was up for, as of the last reported death
+    int deathFrames() const { return lastDeath; }
+
+    // Details of the last analysed frame, for debugging output
+    const cv::Mat& lastRegion() const { return last.msg; }
+    const std::vector<cv::Point>& lastMatches() const { return last.pts; }
+    bool lastAligned() const { return last.aligned; }
+    cv::Point leftCenter() const { return last.lcenter; }
+    cv::Point rightCenter() const { return last.rcenter; }
+
+    const cv::Mat& rossTemplate() const { return templ; }
+
+    // Frames on which the tracking window alone found both Rosses
+    unsigned long trackedFrames() const { return trackHits; }
+
+private:
+    void findRosses(RossMatch& out, const RossMatch *prev) const;
+
+    cv::Mat templ, coarseTempl;
+    int minFrames, maxFrames;
+    int seen;
+    int lastDeath;
+    bool fast;
+    int refHeight;
+
+    unsigned long trackHits;
+    RossMatch last;
+};
+
+#endif
@@ -0,0 +1,114 @@
+#include "events.hpp"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <signal.h>
+#include <sys/time.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+static double wallTime() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+EventChannel::EventChannel() : fd(-1) {
+    const char *path = getenv(EVENTS_ENV);
+    if(path == NULL || *path == '\0')
+        return;
+
+    struct sockaddr_un addr;
+    if(strlen(path) >= sizeof(addr.sun_path))
+        return;
+    memset(&addr, 0, sizeof(addr));
+    addr.sun_family = AF_UNIX;
+    strcpy(addr.sun_path, path);
+
+    fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if(fd < 0)
+        return;
+    if(connect(fd, (struct sockaddr *)&addr, sizeof(addr)) < 0) {
+        close(fd);
+        fd = -1;
+        return;
+    }
+    // A bot that goes away should end the analyser quietly, not kill it
+    signal(SIGPIPE, SIG_IGN);
+}
+
+EventChannel::~EventChannel() {
+    if(fd >= 0)
+        close(fd);
+}
+
+void EventChannel::send(uint8_t type, uint64_t frame, const void *body,
+        uint32_t size) {
+    unsigned char buf[64];
+    double now = wallTime();
+    uint32_t length = 1 + sizeof(now) + sizeof(frame) + size;
+
+    unsigned char *p = buf;
+    memcpy(p, &length, sizeof(length)); p += sizeof(length);
+    *p++ = type;
+    memcpy(p, &now, sizeof(now)); p += sizeof(now);
+    memcpy(p, &frame, sizeof(frame)); p += sizeof(frame);
+    if(size > 0)
+        memcpy(p, body, size);
+    p += size;
+
+    size_t off = 0, total = p - buf;
+    while(off < total) {
+        ssize_t n = write(fd, buf + off, total - off);
+        if(n < 0 && errno == EINTR)
+            continue;
+        if(n <= 0) {
+            close(fd);
+            fd = -1;
+            return;
+        }
+        off += n;
+    }
+}
+
+void EventChannel::starting() {
+    if(fd < 0) {
+        printf("[sentinel] system starting\n");
+        fflush(stdout);
+        return;
+    }
+    send(EV_STARTING, 0, NULL, 0);
+}
+
+void EventChannel::died(uint64_t frame, uint32_t duration) {
+    if(fd < 0) {
+        printf("[sentinel] died\n");
+        fflush(stdout);
+        return;
+    }
+    send(EV_DIED, frame, &duration, sizeof(duration));
+}
+
+void EventChannel::stats(uint64_t frame, float fps, float lag, float decodeMs,
+        float matchMs, float sourceFps) {
+    if(fd < 0) {
+        printf("[sentinel] run fps=%.2f decode=%.2fms match=%.2fms\n",
+                fps, decodeMs, matchMs);
+        fflush(stdout);
+        return;
+    }
+    float body[5] = { fps, lag, decodeMs, matchMs, sourceFps };
+    send(EV_STATS, frame, body, sizeof(body));
+}
+
+void EventChannel::ended(uint64_t frame) {
+    if(fd < 0) {
+        printf("[sentinel] stream ended\n");
+        fflush(stdout);
+        return;
+    }
+    send(EV_ENDED, frame, NULL, 0);
+}
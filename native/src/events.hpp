@@ -0,0 +1,46 @@
+#ifndef MORBIDCV_EVENTS_HPP
+#define MORBIDCV_EVENTS_HPP
+
+#include <stdint.h>
+
+// Environment variable naming the Unix socket the bot listens on
+#define EVENTS_ENV "MORBIDCV_EVENTS"
+
+// Event types, mirrored in src/events.py
+#define EV_STARTING 1
+#define EV_DIED 2
+#define EV_STATS 3
+#define EV_ENDED 4
+
+// Sends analyser events to the bot as length-prefixed binary records:
+//
+//   uint32 length of the rest, uint8 type, double wall clock time,
+//   uint64 source frame index, then a type-specific body
+//
+// died:  uint32 source frames the message was up for
+// stats: float fps since the last report, float seconds behind live,
+//        float decode ms, float match ms, float source frame rate
+//
+// All fields are little-endian (host order on every platform we build for).
+// Without a socket to talk to, the same events are printed as the old
+// "[sentinel]" text lines so the analyser can still be run by hand.
+class EventChannel {
+public:
+    EventChannel();
+    ~EventChannel();
+
+    bool connected() const { return fd >= 0; }
+
+    void starting();
+    void died(uint64_t frame, uint32_t duration);
+    void stats(uint64_t frame, float fps, float lag, float decodeMs,
+            float matchMs, float sourceFps);
+    void ended(uint64_t frame);
+
+private:
+    void send(uint8_t type, uint64_t frame, const void *body, uint32_t size);
+
+    int fd;
+};
+
+#endif
@@ -1,65 +1,106 @@
 #include <stdio.h>
+#include <string.h>
+#include <stdlib.h>
 #include "opencv2/opencv.hpp"
 #include <vector>
 
+#include "detector.hpp"
+#include "pipeline.hpp"
+#include "events.hpp"
+
 using namespace std;
 using namespace cv;
 
 //#define VIDEO_DEBUG
-#define SENTINEL_ENABLE
-
-/*
-#define MIN_ROSS_FRAMES 45
-#define MAX_ROSS_FRAMES 70
-#define FRAME_DIVISOR 1
-*/
-#define FRAME_DIVISOR 3
-#define MIN_ROSS_FRAMES (30 / FRAME_DIVISOR)
-#define MAX_ROSS_FRAMES (900 / FRAME_DIVISOR)
-
-// Frame positioning constants
-#define MSG_REGION_START_X 0.14
-#define MSG_REGION_START_Y 0.4
-#define MSG_REGION_END_X 0.85
-#define MSG_REGION_END_Y 0.65
-
-void fastMultiMatch(const Mat& img, const Mat& templ, vector<Point>& results, double thresh) {
-    // perform template matching
-    Mat res = Mat::zeros(img.size() + Size(1,1) - templ.size(), CV_32FC1);
-
-    matchTemplate(img, templ, res, CV_TM_CCORR_NORMED);
-    threshold(res, res, 0.9, 1, CV_THRESH_TOZERO);
-
-    Point minloc, maxloc;
-    double minval, maxval;
-    while(true) {
-        minMaxLoc(res, &minval, &maxval, &minloc, &maxloc);
-
-        if(maxval >= thresh) {
-            // extract best values
-            results.push_back(maxloc);
-            floodFill(res, maxloc, Scalar(0), 0, Scalar(.1), Scalar(1.));
-        } else {
-            break;
+
+// Source frames between FPS reports
+#define REPORT_FRAMES 30
+
+// Wall clock seconds minus stream seconds processed so far
+static double lagBehind(unsigned long processed, double time, double sourceFps) {
+    double lag = time - processed / sourceFps;
+    return lag > 0 ? lag : 0;
+}
+
+// Frame rate is measured since the previous report, so slowdowns show up
+// straight away instead of being averaged over the whole run
+static void reportStats(EventChannel& events, unsigned long processed,
+        double time, double sourceFps, unsigned long analysed,
+        double decodeTime, double matchTime, unsigned long& lastProcessed,
+        double& lastTime) {
+    if(analysed == 0)
+        analysed = 1;
+    double interval = time - lastTime;
+    double fps = interval > 0 ? (processed - lastProcessed) / interval : 0;
+    events.stats(processed, fps, lagBehind(processed, time, sourceFps),
+            1000 * decodeTime / analysed, 1000 * matchTime / analysed,
+            sourceFps);
+    lastProcessed = processed;
+    lastTime = time;
+}
+
+// Pipelined main loop: decoding and matching overlap on separate threads
+static void runPipelined(VideoCapture& input, RossDetector& detector,
+        FrameSampler& sampler, int threads, EventChannel& events,
+        double sourceFps) {
+    Pipeline pipe(input, detector, sampler, threads);
+
+    int64 start = getTickCount();
+    unsigned long index = 0, analysed = 0, lastReport = 0;
+    double lastTime = 0;
+    bool died;
+    while(pipe.next(index, died)) {
+        analysed++;
+        if(died)
+            events.died(index, detector.deathFrames());
+        if(index / REPORT_FRAMES != lastReport / REPORT_FRAMES) {
+            unsigned long prev = lastReport;
+            lastReport = index;
+            double time = (getTickCount() - start) / getTickFrequency();
+            reportStats(events, index, time, sourceFps, analysed,
+                    pipe.decodeSeconds(), pipe.matchSeconds(), prev, lastTime);
         }
     }
+    events.ended(index);
 }
 
 int main(int argc, char **argv) {
-    if(argc != 2) {
+    // usage: morbidcv [--fast] [--divisor N] [--idle-divisor N]
+    //                 [--ref-height H] [--threads N] <video>
+    bool fast = false;
+    int divisor = FRAME_DIVISOR, idleDivisor = 0, refHeight = 0, threads = 0;
+    const char *source = NULL;
+    for(int i = 1; i < argc; i++) {
+        if(strcmp(argv[i], "--fast") == 0)
+            fast = true;
+        else if(strcmp(argv[i], "--divisor") == 0 && i + 1 < argc)
+            divisor = atoi(argv[++i]);
+        else if(strcmp(argv[i], "--idle-divisor") == 0 && i + 1 < argc)
+            idleDivisor = atoi(argv[++i]);
+        else if(strcmp(argv[i], "--ref-height") == 0 && i + 1 < argc)
+            refHeight = atoi(argv[++i]);
+        else if(strcmp(argv[i], "--threads") == 0 && i + 1 < argc)
+            threads = atoi(argv[++i]);
+        else if(source == NULL)
+            source = argv[i];
+        else
+            return -1;
+    }
+    if(source == NULL || divisor < 1) {
         // takes video file as argument
         return -1;
     }
 
     // open video capture device
-    VideoCapture input(argv[1]);
+    VideoCapture input(source);
     if(!input.isOpened())
         return -1;
 
     // read the template file
     Mat rossTemplate = imread("bobross.png", 1);
-    int rossWidth = rossTemplate.cols,
-        rossHeight = rossTemplate.rows;
+    RossDetector detector(rossTemplate, MIN_ROSS_FRAMES, MAX_ROSS_FRAMES, fast);
+    detector.setReferenceHeight(refHeight);
+    FrameSampler sampler(divisor, idleDivisor);
 
 #ifdef VIDEO_DEBUG
     // iterate through frames
@@ -67,94 +108,79 @@ int main(int argc, char **argv) {
 
     moveWindow("image", 1940, 10);
 #endif
-#ifdef SENTINEL_ENABLE
-    printf("[sentinel] system starting\n");
-    fflush(stdout);
-#endif
+    EventChannel events;
+    events.starting();
 
-    Mat msg, health, frame;
-    int seen_frames = 0;
+    // Stream rate, for working out how far behind live we are
+    double sourceFps = input.get(CV_CAP_PROP_FPS);
+    if(!(sourceFps > 0 && sourceFps < 1000))
+        sourceFps = 30;
+
+    if(threads > 0) {
+        runPipelined(input, detector, sampler, threads, events, sourceFps);
+        return 0;
+    }
 
-    unsigned long processed = 0;
-    double time = 0;
+    Mat msg, frame;
+
+    unsigned long processed = 0, analysed = 0, lastReport = 0;
+    double time = 0, decodeTime = 0, matchTime = 0;
+    unsigned long reported = 0;
+    double reportedTime = 0;
     unsigned long int lastTicks = getTickCount();
     unsigned long int lastDrawTicks = getTickCount();
     unsigned int updateMod = 10;
     int deaths = 0;
-    while(input.read(frame)) { // process frames 
+    while(true) { // process frames 
+        int64 decodeStart = getTickCount();
+        if(!input.grab()) break;
         processed++;
         time += (getTickCount()-lastTicks)/getTickFrequency();
         lastTicks = getTickCount();
-        if(processed % FRAME_DIVISOR != 0) continue;
-
-        Size imsize = frame.size();
 
-        // figure out crop boundaries
-        int msg_starty = imsize.height * MSG_REGION_START_Y,
-            msg_endy = imsize.height * MSG_REGION_END_Y;
+        // skipped frames are only grabbed, never converted to a Mat
+        bool sampled = sampler.sample();
+        if(sampled && !input.retrieve(frame)) break;
+        decodeTime += (getTickCount()-decodeStart)/getTickFrequency();
 
-        // extract important regions
-        msg = frame(Rect(
-                    imsize.width    * MSG_REGION_START_X,
-                    imsize.height   * MSG_REGION_START_Y,
-                    imsize.width    * (MSG_REGION_END_X - MSG_REGION_START_X),
-                    imsize.height   * (MSG_REGION_END_Y - MSG_REGION_START_Y)));
+        if(processed / REPORT_FRAMES != lastReport / REPORT_FRAMES) {
+            lastReport = processed;
+            reportStats(events, processed, time, sourceFps, analysed,
+                    decodeTime, matchTime, reported, reportedTime);
+        }
+        if(!sampled) continue;
 
-        vector<Point> pts;
-        fastMultiMatch(msg, rossTemplate, pts, 0.1);
+        int64 matchStart = getTickCount();
+        bool died = detector.feed(frame, sampler.step());
+        matchTime += (getTickCount()-matchStart)/getTickFrequency();
+        analysed++;
+        sampler.update(detector.candidate() || detector.seenFrames() > 0);
+        int seen_frames = detector.seenFrames();
+        msg = detector.lastRegion();
 
 #ifdef VIDEO_DEBUG
-        for(Point p : pts) {
+        for(Point p : detector.lastMatches()) {
             rectangle(msg, p, Point(p.x + rossTemplate.cols,
                         p.y + rossTemplate.rows), Scalar(0,255,0), 1);
             p.y -= 2;
             putText(msg, "BOB ROSS", p, FONT_HERSHEY_SIMPLEX, 0.5, Scalar(0,255,0));
         }
-#endif
-
-        int finish = 0;
-        if(pts.size() == 2) {
-            // identify left and right points
-            Point left, right;
-            if(pts[0].x < pts[1].x) {
-                left = pts[0];
-                right = pts[1];
-            } else {
-                left = pts[1];
-                right = pts[0];
-            }
-            Point lcenter = Point(left.x + (rossWidth/2), left.y + (rossHeight/2)),
-                  rcenter = Point(right.x + (rossWidth/2), right.y + (rossHeight/2));
-
-            // make sure the Rosses are aligned by comparing their X and Y distances 
-            if((rcenter-lcenter).y < 8) {
-                seen_frames++;
-#ifdef VIDEO_DEBUG
-                circle(msg, lcenter, 8, Scalar(0,255,0));
-                circle(msg, rcenter, 8, Scalar(0,0,255));
-                line(msg, lcenter, rcenter, Scalar(0,255,255));
-
-                double ird = norm(lcenter - rcenter);
-                char buf[64];
-                snprintf(buf, 64, "IRD: %.3lf SF: %d", ird, seen_frames);
-                putText(msg, buf, Point(0, msg.rows-4), FONT_HERSHEY_SIMPLEX, 0.5, Scalar(0,255,0));
-#endif
-            } else {
-                finish = 1;
-            }
-        } else {
-            finish = 1;
+        if(detector.lastAligned()) {
+            Point lcenter = detector.leftCenter(),
+                  rcenter = detector.rightCenter();
+            circle(msg, lcenter, 8, Scalar(0,255,0));
+            circle(msg, rcenter, 8, Scalar(0,0,255));
+            line(msg, lcenter, rcenter, Scalar(0,255,255));
+
+            double ird = norm(lcenter - rcenter);
+            char buf[64];
+            snprintf(buf, 64, "IRD: %.3lf SF: %d", ird, seen_frames);
+            putText(msg, buf, Point(0, msg.rows-4), FONT_HERSHEY_SIMPLEX, 0.5, Scalar(0,255,0));
         }
+#endif
 
-        if(finish == 1) {
-            if(seen_frames > MIN_ROSS_FRAMES && seen_frames < MAX_ROSS_FRAMES) {
-                seen_frames = -999999999;
-                printf("[sentinel] died\n");
-                fflush(stdout);
-            } else {
-                seen_frames = 0;
-            }
-        }
+        if(died)
+            events.died(processed, detector.deathFrames());
 
 #ifdef VIDEO_DEBUG
         if((processed % updateMod == 0) || (seen_frames > 0)) {
@@ -188,19 +214,10 @@ int main(int argc, char **argv) {
                 break;
             }
         }
-#endif
-#ifdef SENTINEL_ENABLE
-        if(processed % 30 == 0) {
-            printf("[sentinel] run fps=%.2f\n", (processed / time));
-            fflush(stdout);
-        }
 #endif
     }
 
-#ifdef SENTINEL_ENABLE
-    printf("[sentinel] stream ended\n");
-    fflush(stdout);
-#endif
+    events.ended(processed);
 
     return 0;
 }
@@ -0,0 +1,123 @@
+#include "pipeline.hpp"
+
+using namespace std;
+using namespace cv;
+
+Pipeline::Pipeline(VideoCapture& input, RossDetector& detector,
+        FrameSampler& sampler, int threads)
+    : input(input), detector(detector), sampler(sampler),
+      ring(threads * 2 + 2), decodeSeq(0), matchSeq(0), consumeSeq(0),
+      grabbed(0), eof(false), stopping(false), decodeTime(0), matchTime(0) {
+    decoder = thread(&Pipeline::decodeLoop, this);
+    for(int i = 0; i < threads; i++)
+        matchers.push_back(thread(&Pipeline::matchLoop, this));
+}
+
+Pipeline::~Pipeline() {
+    {
+        lock_guard<mutex> lk(lock);
+        stopping = true;
+    }
+    cond.notify_all();
+    decoder.join();
+    for(thread& t : matchers)
+        t.join();
+}
+
+void Pipeline::decodeLoop() {
+    unique_lock<mutex> lk(lock);
+    while(true) {
+        Slot& s = ring[decodeSeq % ring.size()];
+        cond.wait(lk, [&]{ return stopping || s.state == FREE; });
+        if(stopping)
+            break;
+        lk.unlock();
+
+        // grab until the sampler picks a frame; only that one is converted
+        int64 start = getTickCount();
+        bool ok = true;
+        int step = 1;
+        while(true) {
+            if(!input.grab()) {
+                ok = false;
+                break;
+            }
+            grabbed++;
+            lock_guard<mutex> slk(samplerLock);
+            if(sampler.sample()) {
+                step = sampler.step();
+                break;
+            }
+        }
+        if(ok)
+            ok = input.retrieve(s.frame);
+        double elapsed = (getTickCount() - start) / getTickFrequency();
+
+        lk.lock();
+        decodeTime += elapsed;
+        if(!ok) {
+            eof = true;
+            cond.notify_all();
+            break;
+        }
+        s.index = grabbed;
+        s.step = step;
+        s.state = DECODED;
+        decodeSeq++;
+        cond.notify_all();
+    }
+}
+
+void Pipeline::matchLoop() {
+    unique_lock<mutex> lk(lock);
+    while(true) {
+        cond.wait(lk, [&]{ return stopping || eof || matchSeq < decodeSeq; });
+        if(stopping || matchSeq >= decodeSeq)
+            break;
+        Slot& s = ring[matchSeq % ring.size()];
+        matchSeq++;
+        s.state = MATCHING;
+        lk.unlock();
+
+        int64 start = getTickCount();
+        detector.match(s.frame, s.result);
+        double elapsed = (getTickCount() - start) / getTickFrequency();
+
+        lk.lock();
+        matchTime += elapsed;
+        s.state = MATCHED;
+        cond.notify_all();
+    }
+}
+
+bool Pipeline::next(unsigned long& index, bool& died) {
+    unique_lock<mutex> lk(lock);
+    Slot& s = ring[consumeSeq % ring.size()];
+    cond.wait(lk, [&]{ return s.state == MATCHED || (eof && consumeSeq >= decodeSeq); });
+    if(s.state != MATCHED)
+        return false;
+    lk.unlock();
+
+    died = detector.advance(s.result, s.step);
+    {
+        lock_guard<mutex> slk(samplerLock);
+        sampler.update(detector.candidate() || detector.seenFrames() > 0);
+    }
+    index = s.index;
+
+    lk.lock();
+    s.state = FREE;
+    consumeSeq++;
+    cond.notify_all();
+    return true;
+}
+
+double Pipeline::decodeSeconds() {
+    lock_guard<mutex> lk(lock);
+    return decodeTime;
+}
+
+double Pipeline::matchSeconds() {
+    lock_guard<mutex> lk(lock);
+    return matchTime;
+}
@@ -0,0 +1,61 @@
+#ifndef MORBIDCV_PIPELINE_HPP
+#define MORBIDCV_PIPELINE_HPP
+
+#include "opencv2/opencv.hpp"
+#include <vector>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+
+#include "detector.hpp"
+
+// Decodes on one thread into a bounded ring of reusable frame buffers while
+// one or more threads match them. Results come back out of next() in frame
+// order so the detector's state machine sees the same sequence as the
+// serial loop. Tracking between frames is not used, since neighbouring frames
+// are matched concurrently.
+class Pipeline {
+public:
+    Pipeline(cv::VideoCapture& input, RossDetector& detector,
+            FrameSampler& sampler, int threads);
+    ~Pipeline();
+
+    // Advances to the next analysed frame. Returns false at end of stream.
+    bool next(unsigned long& index, bool& died);
+
+    // Total seconds spent decoding (including skipped frames) and matching
+    double decodeSeconds();
+    double matchSeconds();
+
+private:
+    enum SlotState { FREE, DECODED, MATCHING, MATCHED };
+
+    struct Slot {
+        Slot() : state(FREE), index(0), step(1) {}
+
+        SlotState state;
+        cv::Mat frame;
+        RossMatch result;
+        unsigned long index;
+        int step;
+    };
+
+    void decodeLoop();
+    void matchLoop();
+
+    cv::VideoCapture& input;
+    RossDetector& detector;
+    FrameSampler& sampler;
+
+    std::vector<Slot> ring;
+    std::mutex lock, samplerLock;
+    std::condition_variable cond;
+    unsigned long decodeSeq, matchSeq, consumeSeq, grabbed;
+    bool eof, stopping;
+    double decodeTime, matchTime;
+
+    std::thread decoder;
+    std::vector<std::thread> matchers;
+};
+
+#endif
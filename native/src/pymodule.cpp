@@ -0,0 +1,249 @@
+// Python bindings for the death detector. Frames are passed in through the
+// buffer protocol (e.g. a NumPy array from cv2.VideoCapture.read()) and
+// wrapped in a cv::Mat without copying.
+//
+// feed() releases the GIL while it matches, so one Detector must only be fed
+// from one thread at a time; a second concurrent feed(), reset() or
+// __init__() raises RuntimeError rather than corrupting its state. Separate
+// Detectors may be fed in parallel.
+#include <Python.h>
+#include <string.h>
+
+#include "detector.hpp"
+
+using namespace cv;
+
+typedef struct {
+    PyObject_HEAD
+    RossDetector *detector;
+    FrameSampler *sampler;
+    unsigned long frames;
+    int busy; // inside feed() without the GIL
+} DetectorObject;
+
+static void Detector_dealloc(DetectorObject *self) {
+    delete self->detector;
+    delete self->sampler;
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *Detector_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    DetectorObject *self = (DetectorObject *)type->tp_alloc(type, 0);
+    if(self != NULL) {
+        self->detector = NULL;
+        self->sampler = NULL;
+        self->frames = 0;
+        self->busy = 0;
+    }
+    return (PyObject *)self;
+}
+
+static int Detector_init(DetectorObject *self, PyObject *args, PyObject *kwds) {
+    static const char *kwlist[] = {"template", "divisor", "min_frames",
+        "max_frames", "fast", "idle_divisor", "ref_height", NULL};
+    const char *path = "bobross.png";
+    int divisor = FRAME_DIVISOR, minFrames = MIN_ROSS_FRAMES,
+        maxFrames = MAX_ROSS_FRAMES, fast = 0, idleDivisor = 0, refHeight = 0;
+    if(!PyArg_ParseTupleAndKeywords(args, kwds, "|siiipii", (char **)kwlist,
+                &path, &divisor, &minFrames, &maxFrames, &fast, &idleDivisor,
+                &refHeight))
+        return -1;
+    if(self->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "detector is being fed");
+        return -1;
+    }
+    if(divisor < 1) {
+        PyErr_SetString(PyExc_ValueError, "divisor must be at least 1");
+        return -1;
+    }
+
+    Mat templ = imread(path, 1);
+    if(templ.empty()) {
+        PyErr_Format(PyExc_IOError, "unable to read template %s", path);
+        return -1;
+    }
+
+    delete self->detector;
+    delete self->sampler;
+    self->detector = new RossDetector(templ, minFrames, maxFrames, fast != 0);
+    self->detector->setReferenceHeight(refHeight);
+    self->sampler = new FrameSampler(divisor, idleDivisor);
+    self->frames = 0;
+    return 0;
+}
+
+// Wraps a C-contiguous HxWx3 uint8 buffer as a BGR Mat sharing its memory
+static bool frameFromBuffer(Py_buffer *view, Mat& frame) {
+    if(view->ndim != 3 || view->shape[2] != 3) {
+        PyErr_SetString(PyExc_ValueError, "frame must have shape (height, width, 3)");
+        return false;
+    }
+    if(view->format != NULL && strcmp(view->format, "B") != 0) {
+        PyErr_SetString(PyExc_ValueError, "frame must be uint8");
+        return false;
+    }
+    if(view->strides[2] != 1 || view->strides[1] != 3) {
+        PyErr_SetString(PyExc_ValueError, "frame rows must be contiguous");
+        return false;
+    }
+    frame = Mat((int)view->shape[0], (int)view->shape[1], CV_8UC3, view->buf,
+            (size_t)view->strides[0]);
+    return true;
+}
+
+static PyObject *Detector_feed(DetectorObject *self, PyObject *args, PyObject *kwds) {
+    static const char *kwlist[] = {"frame", "timestamp", NULL};
+    PyObject *obj, *ts = Py_None;
+    if(!PyArg_ParseTupleAndKeywords(args, kwds, "O|O", (char **)kwlist, &obj, &ts))
+        return NULL;
+    if(self->detector == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "detector not initialised");
+        return NULL;
+    }
+    // Checked and set while holding the GIL, so this can't race
+    if(self->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "detector is already being fed from another thread");
+        return NULL;
+    }
+
+    unsigned long index = self->frames++;
+    if(!self->sampler->sample())
+        Py_RETURN_NONE;
+
+    Py_buffer view;
+    if(PyObject_GetBuffer(obj, &view, PyBUF_STRIDES | PyBUF_FORMAT) < 0)
+        return NULL;
+    Mat frame;
+    if(!frameFromBuffer(&view, frame)) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+
+    // Matching doesn't touch any Python objects, so let other threads run
+    bool died;
+    self->busy = 1;
+    Py_BEGIN_ALLOW_THREADS
+    died = self->detector->feed(frame, self->sampler->step());
+    self->sampler->update(self->detector->candidate() ||
+            self->detector->seenFrames() > 0);
+    Py_END_ALLOW_THREADS
+    self->busy = 0;
+    PyBuffer_Release(&view);
+
+    if(!died)
+        Py_RETURN_NONE;
+    return Py_BuildValue("(skO)", "died", index, ts);
+}
+
+static PyObject *Detector_reset(DetectorObject *self, PyObject *unused) {
+    if(self->busy) {
+        PyErr_SetString(PyExc_RuntimeError, "detector is being fed");
+        return NULL;
+    }
+    if(self->detector != NULL)
+        self->detector->reset();
+    self->frames = 0;
+    Py_RETURN_NONE;
+}
+
+static PyObject *Detector_get_seen(DetectorObject *self, void *closure) {
+    return PyLong_FromLong(self->detector ? self->detector->seenFrames() : 0);
+}
+
+static PyObject *Detector_get_interval(DetectorObject *self, void *closure) {
+    return PyLong_FromLong(self->sampler ? self->sampler->interval() : 0);
+}
+
+static PyObject *Detector_get_frames(DetectorObject *self, void *closure) {
+    return PyLong_FromUnsignedLong(self->frames);
+}
+
+static PyMethodDef Detector_methods[] = {
+    {"feed", (PyCFunction)Detector_feed, METH_VARARGS | METH_KEYWORDS,
+        "feed(frame, timestamp=None) -> ('died', frame_index, timestamp) or None"},
+    {"reset", (PyCFunction)Detector_reset, METH_NOARGS,
+        "Forget any partially seen death message"},
+    {NULL}
+};
+
+static PyGetSetDef Detector_getset[] = {
+    {(char *)"seen_frames", (getter)Detector_get_seen, NULL,
+        (char *)"Consecutive sampled frames with aligned Rosses", NULL},
+    {(char *)"interval", (getter)Detector_get_interval, NULL,
+        (char *)"Current sampling interval in source frames", NULL},
+    {(char *)"frames", (getter)Detector_get_frames, NULL,
+        (char *)"Frames fed so far, including skipped ones", NULL},
+    {NULL}
+};
+
+static PyTypeObject DetectorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "morbidcv.Detector",
+};
+
+static PyObject *py_fast_multi_match(PyObject *self, PyObject *args) {
+    PyObject *imgObj, *templObj;
+    double thresh = 0.1;
+    if(!PyArg_ParseTuple(args, "OO|d", &imgObj, &templObj, &thresh))
+        return NULL;
+
+    Py_buffer imgView, templView;
+    if(PyObject_GetBuffer(imgObj, &imgView, PyBUF_STRIDES | PyBUF_FORMAT) < 0)
+        return NULL;
+    if(PyObject_GetBuffer(templObj, &templView, PyBUF_STRIDES | PyBUF_FORMAT) < 0) {
+        PyBuffer_Release(&imgView);
+        return NULL;
+    }
+
+    PyObject *result = NULL;
+    Mat img, templ;
+    if(frameFromBuffer(&imgView, img) && frameFromBuffer(&templView, templ)) {
+        std::vector<Point> pts;
+        Py_BEGIN_ALLOW_THREADS
+        fastMultiMatch(img, templ, pts, thresh);
+        Py_END_ALLOW_THREADS
+
+        result = PyList_New(pts.size());
+        for(size_t i = 0; result != NULL && i < pts.size(); i++)
+            PyList_SET_ITEM(result, i, Py_BuildValue("(ii)", pts[i].x, pts[i].y));
+    }
+    PyBuffer_Release(&templView);
+    PyBuffer_Release(&imgView);
+    return result;
+}
+
+static PyMethodDef module_methods[] = {
+    {"fast_multi_match", py_fast_multi_match, METH_VARARGS,
+        "fast_multi_match(image, template, thresh=0.1) -> [(x, y), ...]"},
+    {NULL}
+};
+
+static struct PyModuleDef morbidcv_module = {
+    PyModuleDef_HEAD_INIT,
+    "morbidcv",
+    "Bob Ross death message detector",
+    -1,
+    module_methods,
+};
+
+PyMODINIT_FUNC PyInit_morbidcv(void) {
+    DetectorType.tp_basicsize = sizeof(DetectorObject);
+    DetectorType.tp_dealloc = (destructor)Detector_dealloc;
+    DetectorType.tp_flags = Py_TPFLAGS_DEFAULT;
+    DetectorType.tp_doc = "Detector(template='bobross.png', divisor=3, min_frames=30, max_frames=900, fast=False, idle_divisor=0, ref_height=0)";
+    DetectorType.tp_methods = Detector_methods;
+    DetectorType.tp_getset = Detector_getset;
+    DetectorType.tp_init = (initproc)Detector_init;
+    DetectorType.tp_new = Detector_new;
+    if(PyType_Ready(&DetectorType) < 0)
+        return NULL;
+
+    PyObject *m = PyModule_Create(&morbidcv_module);
+    if(m == NULL)
+        return NULL;
+
+    Py_INCREF(&DetectorType);
+    PyModule_AddObject(m, "Detector", (PyObject *)&DetectorType);
+    PyModule_AddIntConstant(m, "FRAME_DIVISOR", FRAME_DIVISOR);
+    return m;
+}
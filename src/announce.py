@@ -0,0 +1,111 @@
+import functools
+
+# Death announcements: counts in words, and the spaced-out shouting used in
+# spaced_text mode ("O N E H U N D R E D B O Y S"). Every render is cached,
+# since the same counts come up again and again across channels.
+#
+#   python3 -m src.announce [counts]    micro-benchmark
+
+CACHE_SIZE = 4096
+
+ONES = ('', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight',
+                'nine', 'ten', 'eleven', 'twelve', 'thirteen', 'fourteen', 'fifteen',
+                'sixteen', 'seventeen', 'eighteen', 'nineteen')
+TENS = ('', '', 'twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy',
+                'eighty', 'ninety')
+# Short scale names, one per power of a thousand. Counts past the last are
+# told in multiples of it ("one thousand vigintillion").
+SCALES = ('', 'thousand', 'million', 'billion', 'trillion', 'quadrillion',
+                'quintillion', 'sextillion', 'septillion', 'octillion', 'nonillion',
+                'decillion', 'undecillion', 'duodecillion', 'tredecillion',
+                'quattuordecillion', 'quindecillion', 'sexdecillion', 'septendecillion',
+                'octodecillion', 'novemdecillion', 'vigintillion')
+
+def group_words(n):
+        # 1 to 999
+        parts = []
+        if n >= 100:
+                parts += [ONES[n // 100], 'hundred']
+                n %= 100
+        if n >= 20:
+                parts.append(TENS[n // 10])
+                n %= 10
+        if n:
+                parts.append(ONES[n])
+        return ' '.join(parts)
+
+# Every three-digit group, worked out once
+GROUPS = ('zero',) + tuple(group_words(n) for n in range(1, 1000))
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def words(n):
+        if n < 0:
+                return 'minus ' + words(-n)
+        if n < 1000:
+                return GROUPS[n]
+        parts = []
+        for scale in SCALES[:-1]:
+                n, g = divmod(n, 1000)
+                if g:
+                        parts.append(GROUPS[g] + ' ' + scale if scale else GROUPS[g])
+                if not n:
+                        break
+        if n:
+                parts.append(words(n) + ' ' + SCALES[-1])
+        return ' '.join(reversed(parts))
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def shout(n, tail):
+        return ' '.join(words(n).upper().replace(' ', '')) + tail
+
+# One way of announcing a count. The suffix is spaced out when the template
+# is made, so a render is one cached lookup.
+class Template:
+        __slots__ = ('tail',)
+
+        def __init__(self, suffix=None):
+                self.tail = None if suffix is None else ' ' + ' '.join(suffix)
+
+        def render(self, n):
+                if self.tail is None:
+                        return str(n)
+                return shout(n, self.tail)
+
+PLAIN = Template()
+BOYS = Template('BOYS')
+HAPPY = Template('HAPPYLITTLEACCIDENTS')
+
+def template(spaced, happy=False):
+        if not spaced:
+                return PLAIN
+        return HAPPY if happy else BOYS
+
+def clear():
+        words.cache_clear()
+        shout.cache_clear()
+
+def benchmark(counts):
+        import time
+        print('%-6s %12s %12s' % ('', 'cold us', 'cached us'))
+        for name, t in (('plain', PLAIN), ('boys', BOYS), ('happy', HAPPY)):
+                clear()
+                res = []
+                for _ in range(2):
+                        start = time.perf_counter()
+                        for n in counts:
+                                t.render(n)
+                        res.append(1e6 * (time.perf_counter() - start) / len(counts))
+                print('%-6s %12.2f %12.2f' % (name, res[0], res[1]))
+
+        big = [10**k + k for k in range(18, 120, 3)]
+        clear()
+        start = time.perf_counter()
+        for n in big:
+                BOYS.render(n)
+        print('past quadrillion: %.2f us per announcement, cold' %
+                        (1e6 * (time.perf_counter() - start) / len(big)))
+
+if __name__ == '__main__':
+        import sys
+        n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+        benchmark(list(range(n)))
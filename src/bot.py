@@ -1,77 +1,82 @@
 from irc import bot
 import logging, importlib, time
 import random, traceback, os, os.path
-import queue, threading
+import threading
+import concurrent.futures
 
-ERR_MSG = 'An error occurred in "%s" and it has been disabled. The MAGIC WORD is "%s".'
-
-class MessageBus:
-        def __init__(self):
-                self.members = []
+from . import dispatch, twitch, outgoing, routing, supervisor, shard, config
+from . import metrics, profiler, lifecycle
+from .bus import MessageBus
 
-        def post(self, src, msg, args, kwargs):
-                for m in self.members:
-                        if m is src:
-                                continue
-                        m.bus_handle(msg, args, kwargs)
-        
-        def register(self, mod):
-                self.members.append(mod)
-
-        def unregister(self, mod):
-                if mod in self.members:
-                        self.members.remove(mod)
-
-class OutgoingQueue(threading.Thread):
-        def __init__(self, sink):
-                threading.Thread.__init__(self)
-                self.daemon = True
-
-                self.sink = sink
-                self.queue = queue.Queue()
-
-        def run(self):
-                times = []
-                while True:
-                        x = self.queue.get()
-
-                        # Remove entries over 30 seconds old
-                        while len(times) > 18:
-                                time.sleep(times[0] - (time.time() - 30))
-                                while times[0] < (time.time() - 30):
-                                        times.pop(0)
-                        time.append(time.time())
-                        self.sink.privmsg(*x)
-        
-        def privmsg(self, chan, msg):
-                self.queue.put((chan, msg))
+ERR_MSG = 'An error occurred in "%s" and it has been disabled. The MAGIC WORD is "%s".'
+STATS_MSG = ('[metacmd] %s: depth=%d handled=%d dropped=%d '
+                'wait=%.1fms run=%.1fms max=%.1fms')
+CACHE_MSG = ('[metacmd] channel cache: entries=%d hits=%d misses=%d '
+                'fetches=%d batches=%d')
+BUS_MSG = '[metacmd] bus %s: %s'
+SEND_MSG = ('[metacmd] send queue: pending=%d sent=%d merged=%d stale=%d '
+                'full=%d wait=%s')
+
+PROFILE_MSG = '[metacmd] Profile of %d samples written to %s'
+RESOURCE_MSG = ('[metacmd] %s: modules=%d instances=%d threads=%d processes=%d '
+                'retired=%d queued=%d')
+RESOURCE_TOTAL_MSG = ('[metacmd] resources: channels=%d instances=%d threads=%d '
+                'processes=%d retired=%d objects=%d rss=%.1fMB')
+RESOURCE_LIST = 10 # channels listed by a bare "resources"
+
+STARTUP_WORKERS = 8
+
+MESSAGES = metrics.counter('messages_received', 'Chat messages received',
+                ('channel',))
+ROUTE_TIME = metrics.histogram('route_seconds',
+                'Time spent parsing and routing a chat message')
+HANDLER_TIME = metrics.histogram('handler_seconds',
+                'Time spent in a module handler for a chat message',
+                ('module', 'handler'))
+HANDLER_ERRORS = metrics.counter('handler_errors', 'Module handlers that raised',
+                ('module',))
+
+# Stands in for the send queue while a module is built for a hot swap: the
+# instance it replaces has already announced itself
+class MutedSender:
+        def privmsg(self, *args, **kwargs):
+                pass
 
 class Bot(bot.SingleServerIRCBot):
-        def __init__(self, conf):
+        def __init__(self, conf, channels=None, link=None):
+                started = time.time()
                 self.conf = conf
-
-                # Construct mapping between channels and loadable modules
-                self.tojoin_channels = list(filter(lambda x: x[0] == '#',
-                        conf.sections()))
-                self.chan_modules = {} # Maps channel to list of module objects
+                self.link = link # shard.ShardLink when running as a shard
+                self.chan_conf = config.ChannelConfig(conf)
+
+                # Construct mapping between channels and loadable modules.
+                # A shard only serves the channels it was given.
+                if channels is None:
+                        channels = self.chan_conf.channels
+                self.tojoin_channels = list(channels)
+                self.chan_modules = {} # Maps channel to list of module names
                 self.chan_mod_instances = {} # Maps channel to {modname->instance}
-                self.modules = {} # Maps modname to module objects
+                self.modules = {} # Maps modname to module objects, imported on first use
+                self.module_lock = threading.Lock()
+                self.import_times = {} # modname -> seconds spent importing
                 self.chan_bus = {} # maps channel to bus object
+                self.chan_routes = {} # maps channel to CommandTable
+                self.swaps = {} # channel -> module names being hot swapped
+                self.held_chat = {} # channel -> chat buffered during a swap
+
+                # Per-channel workers so slow modules don't stall the reactor
+                qsize = conf.getint('Connection', 'dispatch_queue',
+                                fallback=dispatch.QUEUE_SIZE)
+                self.dispatcher = dispatch.Dispatcher(qsize)
 
                 for c in self.tojoin_channels:
-                        # Create the channel's bus
-                        self.chan_bus[c] = MessageBus()
-
-                        # Try to load a module if it isn't already available
-                        mods = self.conf.get(c, 'modules').split(',')
-                        for m in mods:
-                                if m in self.modules:
-                                        continue
-                                modpath = 'src.modules.%s' % m
-                                self.modules[m] = importlib.import_module(modpath)
-                                logging.info("Loaded module: %s", m)
-                        self.chan_modules[c] = list(
-                                        map(lambda x: self.modules[x], mods))
+                        # Create the channel's bus, delivering on its worker
+                        self.chan_bus[c] = MessageBus(self.dispatcher.worker(c))
+                        twitch.channels.watch(c)
+
+                        # Modules are imported when the channel starts
+                        self.chan_modules[c] = list(self.chan_conf.modules.get(c, []))
+                        self.chan_mod_instances[c] = {}
 
                 # Establish connection to IRC server
                 srv = conf.get('Connection', 'server')
@@ -81,120 +86,392 @@ class Bot(bot.SingleServerIRCBot):
 
                 self.admins = conf.get('Connection', 'sys_admins').strip().split(',')
 
+                # JOINs are rate limited separately from chat
+                self.join_limit = conf.getint('Connection', 'join_limit',
+                                fallback=shard.JOIN_LIMIT)
+                self.join_window = conf.getint('Connection', 'join_window',
+                                fallback=shard.JOIN_WINDOW)
+                self.join_bucket = outgoing.TokenBucket(self.join_limit, self.join_window)
+                self.join_lock = threading.Lock()
+
+                # Machine-wide limits for video analysers
+                if conf.has_section('Supervisor'):
+                        sconf = conf['Supervisor']
+                        supervisor.analysers.configure(
+                                max_streams=sconf.getint('max_streams', supervisor.MAX_STREAMS),
+                                niceness=sconf.getint('niceness', supervisor.NICENESS),
+                                load_limit=sconf.getfloat('load_limit', supervisor.LOAD_LIMIT),
+                                pin=sconf.getboolean('pin_cpus', True),
+                                slot_offset=sconf.getint('slot_offset', 0),
+                                total_slots=sconf.getint('total_slots', None),
+                                stop_timeout=sconf.getfloat('stop_timeout', supervisor.STOP_TIMEOUT),
+                                output_lines=sconf.getint('output_lines', supervisor.OUTPUT_LINES))
+
+                # Keep channel metadata warm so the chat path never waits on it
+                twitch.channels.start()
+
                 logging.info("Connecting to %s:%d user %s", srv, port, user)
 
                 srv = bot.ServerSpec(srv, port,
                                 conf.get('Connection', 'oauth_password'))
                 bot.SingleServerIRCBot.__init__(self, [srv], user, user)
 
-        def load_module(self, mod, chan):
-                # Load the module if needed
-                if mod not in self.modules:
-                        # Load the module if necessary
-                        pth = 'src.modules.%s' % mod
-                        self.modules[mod] = importlib.import_module(pth)
-                        logging.info("Loaded module: %s" % mod)
+                # All outgoing chat is paced through the send queue
+                self.outgoing = outgoing.OutgoingQueue(self.connection)
+                self.outgoing.start()
+
+                # Module constructors may do I/O, so they run off the reactor
+                self.startup_pool = concurrent.futures.ThreadPoolExecutor(
+                                STARTUP_WORKERS)
+
+                if self.link is not None:
+                        self.link.attach(self)
+
+                # Optional local metrics endpoint; shards each take the next port
+                listen = conf.get('Metrics', 'listen', fallback=None) \
+                                if conf.has_section('Metrics') else None
+                if listen:
+                        if self.link is not None:
+                                listen = shard.shard_address(listen, self.link.index)
+                        metrics.serve(listen)
+                metrics.gauge('dispatch_queue_depth', 'Work items waiting per channel',
+                                ('channel',), lambda: dict(((c,), st['depth'])
+                                        for c, st in self.dispatcher.stats().items()))
+                metrics.gauge('send_queue_pending', 'Chat messages waiting to be sent',
+                                (), lambda: {(): self.outgoing.stats()['pending']})
+
+                logging.info("Bot set up for %d channels in %.3fs",
+                                len(self.tojoin_channels), time.time() - started)
+
+        def get_module(self, name):
+                # Imported once, by whichever channel needs it first
+                with self.module_lock:
+                        mod = self.modules.get(name)
+                        if mod is None:
+                                start = time.time()
+                                mod = importlib.import_module('src.modules.%s' % name)
+                                self.import_times[name] = time.time() - start
+                                self.modules[name] = mod
+                                logging.info("Loaded module: %s in %.3fs", name,
+                                                self.import_times[name])
+                        return mod
 
+        def load_module(self, mod, chan):
                 # Plug the module into this channel
                 modname = mod
-                mod = self.modules[mod]
-                if mod not in self.chan_mod_instances[chan]:
-                        # Instantiate the module
-                        conf = self.get_module_conf(chan, mod)
-                        cbus = self.chan_bus[chan]
-                        inst = mod.ModuleMain(cbus, self.connection, chan, conf)
-                        cbus.register(inst)
-                        self.chan_modules[chan].append(mod)
+                if modname not in self.chan_mod_instances.setdefault(chan, {}):
+                        # Instantiate the module, importing it if necessary
+                        inst = self.create_instance(modname, chan)
+                        self.chan_bus[chan].register(inst)
+                        self.chan_modules[chan].append(modname)
                         self.chan_mod_instances[chan][modname] = inst
-                        time.sleep(2)
+                        self.chan_routes[chan] = self.chan_routes.get(chan,
+                                        routing.CommandTable()).add(modname, inst)
                         if not self.quiet:
-                                self.connection.privmsg(chan, "Module loaded: %s" % modname)
+                                self.outgoing.privmsg(chan, "Module loaded: %s" % modname,
+                                                outgoing.PRIO_BULK)
                 else:
                         if not self.quiet:
-                                self.connection.privmsg(chan, "Module already loaded: %s" % modname)
-
-        def unload_module(self, mod, chan):
-                if mod not in self.modules:
+                                self.outgoing.privmsg(chan, "Module already loaded: %s" % modname,
+                                                outgoing.PRIO_BULK)
+
+        def create_instance(self, mname, chan, sender=None):
+                mod = self.get_module(mname)
+                start = time.time()
+                conf = self.get_module_conf(chan, mod)
+                inst = mod.ModuleMain(self.chan_bus[chan], sender or self.outgoing,
+                                chan, conf)
+                lifecycle.resources.add(chan, inst)
+                logging.info("Started %s for %s in %.3fs",
+                                mname, chan, time.time() - start)
+                return inst
+
+        def unload_module(self, mname, chan):
+                if mname not in self.modules:
                         return
-                mname = mod
-                mod = self.modules[mod]
                 if chan != None:
                         # Only unload from this channel
-                        self.chan_modules[chan].remove(mod)
+                        self.unload_from(mname, chan)
+                else:
+                        # Everywhere, each on its own channel's worker
+                        users = [c for c in self.tojoin_channels
+                                        if mname in self.chan_modules.get(c, ())]
+                        for u in users:
+                                self.dispatcher.submit_control(u, self.unload_from, mname, u)
 
-                        inst = self.chan_mod_instances[chan][mname]
+        def unload_from(self, mname, chan):
+                if mname not in self.chan_modules.get(chan, ()):
+                        return
+                self.chan_modules[chan].remove(mname)
+                if mname in self.chan_mod_instances[chan]:
+                        self.stop_instance(chan, mname)
+                if chan in self.chan_routes:
+                        self.chan_routes[chan] = self.chan_routes[chan].remove(mname)
+                if not self.quiet:
+                        self.outgoing.privmsg(chan, "Module unloaded: %s" % mname,
+                                        outgoing.PRIO_BULK)
+
+        def stop_instance(self, chan, mname):
+                inst = self.chan_mod_instances[chan].pop(mname)
+                self.chan_bus[chan].unregister(inst)
+                try:
                         if hasattr(inst, 'shutdown'):
                                 inst.shutdown()
-                        self.chan_bus[chan].unregister(inst)
-                        del self.chan_mod_instances[chan][mname]
-                        if not self.quiet:
-                                self.connection.privmsg(chan, "Module unloaded: %s" % mname)
-                else:
-                        users = list(filter(lambda x: mod in self.chan_modules[x],
-                                self.tojoin_channels))
-                        for u in users:
-                                self.chan_modules[u].remove(mod)
-                                inst = self.chan_mod_instances[u][mname]
-                                if hasattr(inst, 'shutdown'):
-                                        inst.shutdown()
-                                del self.chan_mod_instances[u][mname]
-                                self.chan_bus[chan].unregister(inst)
-                        if not self.quiet:
-                                self.connection.privmsg(u, "Module unloaded: %s" % mname)
+                except Exception:
+                        logging.exception("Error shutting down %s for %s", mname, chan)
+                lifecycle.resources.retire(chan, inst)
 
         def reload_module(self, mod):
+                # Reloads the code, then swaps every running instance for one
+                # built from the new code and the old instance's state. Raises
+                # if the new code fails to import; the old code keeps running.
                 if mod not in self.modules:
-                        return
-                
-                # Shut down module instances
-                users = list(filter(lambda x: mod in self.chan_modules[x],
-                        self.tojoin_channels))
-                self.unload_module(mod)
+                        return False
+                users = [c for c in self.tojoin_channels
+                                if mod in self.chan_mod_instances.get(c, {})]
 
-                importlib.reload(self.modules[mod])
                 importlib.invalidate_caches()
+                importlib.reload(self.modules[mod])
 
                 for u in users:
-                        self.load_module(mod, u)
+                        self.dispatcher.submit_control(u, self.begin_swap, mod, u)
+                return True
+
+        def begin_swap(self, mname, chan):
+                # On the channel's worker. From here until finish_swap, chat and
+                # bus deliveries for the channel are held rather than handled.
+                old = self.chan_mod_instances[chan].get(mname)
+                swaps = self.swaps.setdefault(chan, set())
+                if old is None or mname in swaps:
+                        return
+                if not swaps:
+                        self.held_chat[chan] = []
+                        self.chan_bus[chan].hold()
+                swaps.add(mname)
+
+                state = old.snapshot()
+                fut = self.startup_pool.submit(self.build_swap, mname, chan, state)
+                fut.add_done_callback(lambda f: self.swap_built(mname, chan, old, f))
+
+        def build_swap(self, mname, chan, state):
+                inst = self.create_instance(mname, chan, MutedSender())
+                inst.restore(state)
+                inst.conn = self.outgoing
+                return inst
+
+        def swap_built(self, mname, chan, old, fut):
+                # The swap must finish or the channel stays held, so this goes
+                # through the control lane, which is never shed. A channel
+                # parted meanwhile has no worker; finish_swap then only shuts
+                # the new instance down, and can do that from here.
+                w = self.dispatcher.find(chan)
+                if w is None or w is threading.current_thread():
+                        self.finish_swap(mname, chan, old, fut)
+                else:
+                        w.submit_control(self.finish_swap, mname, chan, old, fut)
+
+        def finish_swap(self, mname, chan, old, fut):
+                swaps = self.swaps.get(chan)
+                if swaps is None or mname not in swaps:
+                        # The channel was torn down while this was building
+                        if fut.exception() is None:
+                                inst = fut.result()
+                                if hasattr(inst, 'shutdown'):
+                                        inst.shutdown()
+                                lifecycle.resources.retire(chan, inst)
+                        return
+
+                try:
+                        inst = fut.result()
+                except Exception:
+                        magic = self.dump_exception()
+                        self.outgoing.privmsg(chan, ERR_MSG % (mname, magic),
+                                        outgoing.PRIO_HIGH)
+                        inst = None
+
+                if inst is not None:
+                        # Swap bus membership and routes in one step as far as
+                        # any message is concerned: nothing runs until resume
+                        bus = self.chan_bus[chan]
+                        bus.unregister(old)
+                        lifecycle.resources.retire(chan, old)
+                        bus.register(inst)
+                        self.chan_mod_instances[chan][mname] = inst
+                        self.chan_routes[chan] = self.chan_routes[chan].remove(
+                                        mname).add(mname, inst)
+                        if not self.quiet:
+                                self.outgoing.privmsg(chan, "Module reloaded: %s" % mname,
+                                                outgoing.PRIO_BULK)
+
+                swaps.discard(mname)
+                if not swaps:
+                        del self.swaps[chan]
+                        self.resume(chan)
+
+        def resume(self, chan):
+                held = self.held_chat.pop(chan, [])
+                self.chan_bus[chan].release()
+                for args in held:
+                        self.handle_pubmsg(*args)
 
         def get_module_conf(self, chan, mod):
-                confdict = {}
-                for k in self.conf.options(chan):
-                        prefix = mod.CONFIG_PREFIX
-                        if not k.startswith(prefix + '_'):
-                                continue
-                        val = self.conf.get(chan, k)
-                        confdict[k[len(prefix)+1:]] = val
-                return confdict
+                return self.chan_conf.module_conf(chan, mod.CONFIG_PREFIX)
 
         def on_endofmotd(self, conn, evt):
                 logging.debug("Connected to server. MOTD ended.")
 
-                for c in self.tojoin_channels:
+                # Membership events tell us where we're a moderator
+                self.connection.cap('REQ', ':twitch.tv/membership')
+                joiner = threading.Thread(target=self.join_channels,
+                                name='joiner')
+                joiner.daemon = True
+                joiner.start()
+
+        def join_channels(self):
+                # Paced so a large channel list stays within the JOIN limit
+                for c in list(self.tojoin_channels):
+                        while True:
+                                wait = self.join_delay()
+                                if wait <= 0:
+                                        break
+                                time.sleep(wait)
                         self.connection.join(c)
 
+        def join_delay(self):
+                # Takes a JOIN token if one is free, else says how long to wait
+                with self.join_lock:
+                        wait = self.join_bucket.delay(time.time())
+                        if wait <= 0:
+                                self.join_bucket.take()
+                        return wait
+
+        def on_mode(self, conn, evt):
+                chan = evt.target
+                args = evt.arguments
+                if len(args) < 2 or args[1] != conn.get_nickname():
+                        return
+                if args[0] == '+o':
+                        self.outgoing.set_moderator(chan, True)
+                elif args[0] == '-o':
+                        self.outgoing.set_moderator(chan, False)
+
         def on_endofnames(self, conn, evt):
                 chan = evt.arguments[0]
                 logging.debug("Joined channel: %s", chan)
 
-                # Initialize channel modules
-                chanmods = self.chan_modules[chan]
-                instances = {}
-                for mod in chanmods:
-                        mname = mod.__name__.split('.')[-1]
+                # Start modules on the channel's worker, ahead of any chat that
+                # is already queued.
+                self.dispatcher.submit_control(chan, self.start_channel, chan)
 
-                        # Build config dict
-                        confdict = self.get_module_conf(chan, mod)
+        def start_channel(self, chan):
+                start = time.time()
 
-                        # Instantiate the module
-                        cbus = self.chan_bus[chan]
-                        instances[mname] = mod.ModuleMain(cbus, conn, chan, confdict)
-                        cbus.register(instances[mname])
-                        time.sleep(2)
-                self.chan_mod_instances[chan] = instances
-                logging.info("Created all modules for channel: %s", chan)
+                # Instantiate the channel's modules concurrently. Any loaded
+                # before the channel started are already running.
+                instances = self.chan_mod_instances.setdefault(chan, {})
+                futures = []
+                for mname in self.chan_modules[chan]:
+                        if mname in instances:
+                                continue
+                        fut = self.startup_pool.submit(self.create_instance, mname, chan)
+                        futures.append((mname, fut))
 
-                conn.privmsg(chan, 'Bot ready. Modules loaded: %s' % (' '.join(instances.keys())))
+                for mname, fut in futures:
+                        try:
+                                instances[mname] = fut.result()
+                        except Exception:
+                                magic = self.dump_exception()
+                                self.outgoing.privmsg(chan, ERR_MSG % (mname, magic),
+                                                outgoing.PRIO_HIGH)
+                                continue
+                        self.chan_bus[chan].register(instances[mname])
+                self.chan_routes[chan] = routing.CommandTable(instances)
+                logging.info("Created all modules for channel %s in %.3fs",
+                                chan, time.time() - start)
+
+                self.outgoing.privmsg(chan, 'Bot ready. Modules loaded: %s' % (' '.join(instances.keys())),
+                                outgoing.PRIO_BULK)
+
+        def stop_channel(self, chan):
+                # On the channel's worker. Shuts down every module instance and
+                # lets go of the analysers they shared; the channel starts
+                # afresh on its next NAMES.
+                for mname in list(self.chan_mod_instances.get(chan, {})):
+                        self.stop_instance(chan, mname)
+                self.chan_routes.pop(chan, None)
+                self.swaps.pop(chan, None)
+                self.held_chat.pop(chan, None)
+                if chan in self.chan_bus:
+                        self.chan_bus[chan].release()
+                lifecycle.resources.teardown(chan)
+
+        def part_channel(self, chan):
+                # On the channel's worker. Leaves for good: nothing about the
+                # channel is kept, and it isn't rejoined on reconnect.
+                self.stop_channel(chan)
+                if chan in self.tojoin_channels:
+                        self.tojoin_channels.remove(chan)
+                self.chan_modules.pop(chan, None)
+                self.chan_mod_instances.pop(chan, None)
+                self.chan_bus.pop(chan, None)
+                twitch.channels.unwatch(chan)
+                self.outgoing.set_moderator(chan, False)
+                self.dispatcher.stop(chan)
+                self.connection.part(chan)
+                if self.link is not None:
+                        self.link.parted(chan)
+
+        def join_channel(self, chan):
+                # Joins at runtime with the channel's configured modules, if any
+                if chan in self.tojoin_channels:
+                        return False
+                self.tojoin_channels.append(chan)
+                if self.link is not None:
+                        self.link.joined(chan)
+                self.chan_bus[chan] = MessageBus(self.dispatcher.worker(chan))
+                self.chan_modules[chan] = list(self.chan_conf.modules.get(chan, []))
+                self.chan_mod_instances[chan] = {}
+                twitch.channels.watch(chan)
+                wait = self.join_delay()
+                if wait > 0:
+                        dispatch.timers.call_later(wait, self.join_later, chan)
+                else:
+                        self.connection.join(chan)
+                return True
+
+        def join_later(self, chan):
+                wait = self.join_delay()
+                if wait > 0:
+                        dispatch.timers.call_later(wait, self.join_later, chan)
+                elif chan in self.tojoin_channels:
+                        self.connection.join(chan)
+
+        def on_part(self, conn, evt):
+                # Parted by the server rather than by us; rejoined on reconnect
+                chan = evt.target
+                if evt.source.nick == conn.get_nickname() and chan in self.chan_routes:
+                        self.dispatcher.submit_control(chan, self.stop_channel, chan)
+
+        def on_disconnect(self, conn, evt):
+                # Everything is rebuilt when the channels are joined again
+                logging.info("Disconnected; stopping all channels")
+                for c in list(self.chan_mod_instances):
+                        self.dispatcher.submit_control(c, self.stop_channel, c)
+
+        def resources(self, chan=None):
+                # Per channel counts of what is resident, for the diagnostic
+                tracked = lifecycle.resources.report()
+                depth = self.dispatcher.stats()
+                chans = [chan] if chan is not None else \
+                                sorted(set(self.tojoin_channels) | set(tracked))
+                res = {}
+                for c in chans:
+                        t = tracked.get(c, {})
+                        res[c] = (len(self.chan_modules.get(c, ())),
+                                        t.get('instances', 0), t.get('threads', 0),
+                                        t.get('processes', 0), t.get('retired', 0),
+                                        depth.get(c, {}).get('depth', 0))
+                return res
 
         def dump_exception(self):
                 if not os.path.exists('crash_logs'):
@@ -208,37 +485,105 @@ class Bot(bot.SingleServerIRCBot):
                 chan = evt.target
                 src = evt.source[:evt.source.find('!')]
                 content = evt.arguments[0]
+                if chan not in self.chan_bus:
+                        return # parted; don't bring its worker back
+                MESSAGES.inc(chan)
+
+                # Hand off to the channel's worker; messages stay in order
+                # within a channel while channels run in parallel.
+                self.dispatcher.submit(chan, self.handle_pubmsg, conn, chan,
+                                src, content)
+
+        def handle_pubmsg(self, conn, chan, src, content):
+                held = self.held_chat.get(chan)
+                if held is not None:
+                        held.append((conn, chan, src, content))
+                        return
 
-                if(content.startswith("!mbt")):
+                # Tokenised once and shared by every module handling it
+                start = time.perf_counter()
+                cmd = routing.parse(content)
+                if cmd is not None and cmd.name == 'mbt':
                     self.process_metacommand(chan, src, content)
                     return
 
-                cmi = self.chan_mod_instances[chan]
-                for iname in cmi.keys():
-                        inst = cmi[iname]
-                        try:
-                                inst.on_message(src, content)
-                        except Exception as e:
-                                magic = self.dump_exception()
-                                conn.privmsg(chan, ERR_MSG % (iname, magic))
-
-        def process_metacommand(self, chan, src, content):
+                table = self.chan_routes.get(chan)
+                if table is None:
+                        return
+                handlers = table.lookup(cmd.name) if cmd is not None else ()
+                ROUTE_TIME.observe(time.perf_counter() - start)
+
+                for iname, inst in table.passive:
+                        self.run_handler(chan, iname, inst.on_message, src, content)
+
+                for iname, handler in handlers:
+                        self.run_handler(chan, iname, handler, src, cmd.args,
+                                        cmd.content, src)
+
+        def run_handler(self, chan, iname, handler, *args):
+                try:
+                        with HANDLER_TIME.time(iname, handler.__name__):
+                                handler(*args)
+                except Exception as e:
+                        HANDLER_ERRORS.inc(iname)
+                        magic = self.dump_exception()
+                        self.outgoing.privmsg(chan, ERR_MSG % (iname, magic),
+                                        outgoing.PRIO_HIGH)
+
+        def meta_reply(self, chan, msg):
+            self.outgoing.privmsg(chan, msg, outgoing.PRIO_HIGH)
+
+        def metrics(self):
+            # Summary for the coordinator's combined stats
+            workers = self.dispatcher.stats().values()
+            st = self.outgoing.stats()
+            return {
+                'channels': len(self.chan_routes),
+                'connected': self.connection.is_connected(),
+                'handled': sum(w['handled'] for w in workers),
+                'dropped': sum(w['dropped'] for w in workers),
+                'sent': st['sent'],
+                'pending': st['pending'],
+                'analysers': len(supervisor.analysers.stats()),
+            }
+
+        def process_metacommand(self, chan, src, content, reply=None):
+            if reply is None:
+                origin = chan
+                reply = lambda msg: self.meta_reply(origin, msg)
             if src not in self.admins:
-                self.conn.privmsg(chan, '[metacmd] You do not have system-level access')
+                reply('[metacmd] You do not have system-level access')
                 return
             parts = content.split(' ')[1:]
             if len(parts) == 0:
-                self.conn.privmsg(chan, '[metacmd] No operation specified')
+                reply('[metacmd] No operation specified')
                 return
             cmd = parts[0]
+            target = None
+            if cmd in ('load', 'unload', 'reload', 'part', 'resources') and \
+                    parts[-1].startswith('#'):
+                # Aimed at another channel, possibly served by another shard
+                target = parts.pop()
+                if target not in self.tojoin_channels:
+                    if self.link is None:
+                        reply('[metacmd] Not in channel %s' % target)
+                    else:
+                        self.link.forward(chan, target, src,
+                                ' '.join(['!mbt'] + parts + [target]))
+                    return
+                if target != chan:
+                    # Run it again on the target's own worker, like its chat
+                    self.dispatcher.submit_control(target, self.process_metacommand,
+                            target, src, content, reply)
+                    return
             if cmd == 'unload':
                 if len(parts) < 2:
-                    self.conn.privmsg(chan, '[metacmd] Must specify module')
+                    reply('[metacmd] Must specify module')
                     return
                 opts = parts[2:]
                 for i in opts:
                     if i not in ['force']:
-                        self.conn.privmsg(chan, '[metacmd] Unknown option: %s' % i)
+                        reply('[metacmd] Unknown option: %s' % i)
 
                 if 'force' in opts:
                     self.unload_module(parts[1], None)
@@ -246,12 +591,78 @@ class Bot(bot.SingleServerIRCBot):
                     self.unload_module(parts[1], chan)
             if cmd == 'reload':
                 if len(parts) != 2:
-                    self.conn.privmsg(chan, '[metacmd] Must specify module')
+                    reply('[metacmd] Must specify module')
                     return
-                self.unload_module(parts[1], chan)
-                self.load_module(parts[1], chan)
+                try:
+                    if not self.reload_module(parts[1]):
+                        reply('[metacmd] Module not loaded: %s' % parts[1])
+                except Exception:
+                    magic = self.dump_exception()
+                    reply('[metacmd] Reload of %s failed; the running version stays. '
+                        'The MAGIC WORD is "%s".' % (parts[1], magic))
             if cmd == 'load':
                 if len(parts) != 2:
-                    self.conn.privmsg(chan, '[metacmd] Must specify module')
+                    reply('[metacmd] Must specify module')
                     return
                 self.load_module(parts[1], chan)
+            if cmd == 'part':
+                if target is None:
+                    reply('[metacmd] Must specify channel')
+                    return
+                reply('[metacmd] Leaving %s' % chan)
+                self.dispatcher.submit_control(chan, self.part_channel, chan)
+            if cmd == 'join':
+                if len(parts) != 2 or not parts[1].startswith('#'):
+                    reply('[metacmd] Must specify channel')
+                    return
+                if self.join_channel(parts[1].lower()):
+                    reply('[metacmd] Joining %s' % parts[1].lower())
+                else:
+                    reply('[metacmd] Already in %s' % parts[1].lower())
+            if cmd == 'resources':
+                res = self.resources(target)
+                if target is None:
+                    totals = [sum(r[i] for r in res.values()) for i in range(5)]
+                    reply(RESOURCE_TOTAL_MSG % (len(res), totals[1],
+                        threading.active_count(), totals[3], totals[4],
+                        lifecycle.object_count(), lifecycle.rss_mb()))
+                    # The channels holding the most, leaks first
+                    res = dict(sorted(res.items(), key=lambda kv: (-kv[1][4],
+                        -kv[1][2], -kv[1][3], -kv[1][1]))[:RESOURCE_LIST])
+                for c, r in res.items():
+                    reply(RESOURCE_MSG % ((c,) + r))
+            if cmd == 'profile':
+                try:
+                    secs = float(parts[1]) if len(parts) > 1 else 30
+                except ValueError:
+                    reply('[metacmd] Usage: profile [seconds]')
+                    return
+                done = lambda path, n: reply(PROFILE_MSG % (n, path))
+                if profiler.start(secs, done):
+                    reply('[metacmd] Profiling for %gs' % min(secs, profiler.MAX_SECONDS))
+                else:
+                    reply('[metacmd] A profile is already running')
+            if cmd == 'stats' and parts[1:] == ['all']:
+                if self.link is not None:
+                    self.link.collect(chan)
+                else:
+                    m = self.metrics()
+                    reply(shard.TOTAL_MSG % (1, 1, m['channels'], m['handled'],
+                        m['dropped'], m['sent'], m['pending'], m['analysers']))
+            elif cmd == 'stats':
+                for c, st in sorted(self.dispatcher.stats().items()):
+                    reply(STATS_MSG % (c, st['depth'],
+                        st['handled'], st['dropped'], 1000*st['avg_wait'],
+                        1000*st['avg_run'], 1000*st['max_run']))
+                st = twitch.channels.stats()
+                reply(CACHE_MSG % (st['entries'],
+                    st['hits'], st['misses'], st['fetches'], st['batches']))
+                st = self.outgoing.stats()
+                waits = ' '.join('p%d=%.1f/%.1fs' % (p, avg, mx)
+                    for p, (avg, mx) in sorted(st['wait'].items()))
+                reply(SEND_MSG % (st['pending'], st['sent'],
+                    st['merged'], st['dropped_stale'], st['dropped_full'], waits))
+                st = self.chan_bus[chan].topic_stats()
+                topics = ' '.join('%s=%d/%.1fms' % (t, v['delivered'], 1000*v['avg'])
+                    for t, v in sorted(st.items()))
+                reply(BUS_MSG % (chan, topics or 'idle'))
@@ -0,0 +1,135 @@
+import threading, collections, time, logging
+
+from . import modules, metrics
+
+WILDCARD = '*'
+
+DELIVERY_TIME = metrics.histogram('bus_delivery_seconds',
+                'Time from posting a bus message until every handler has run',
+                ('topic',))
+HANDLER_TIME = metrics.histogram('bus_handler_seconds',
+                'Time spent in one module handling a bus message',
+                ('module', 'topic'))
+
+def subscriptions(mod):
+        # Topics a module handles, derived from its busmsg_ methods. Modules
+        # that override bus_handle themselves get everything.
+        cls = type(mod)
+        if getattr(cls, 'bus_handle', None) is not modules.CommandModule.bus_handle:
+                return {WILDCARD: lambda msg, args, kwargs: mod.bus_handle(msg, args, kwargs)}
+        subs = {}
+        for attr in dir(cls):
+                if attr.startswith('busmsg_'):
+                        subs[attr[7:]] = getattr(mod, attr)
+        return subs
+
+class TopicStats:
+        __slots__ = ('delivered', 'queued', 'total', 'max')
+
+        def __init__(self):
+                self.delivered = 0
+                self.queued = 0
+                self.total = 0.0
+                self.max = 0.0
+
+# Per-channel message bus. Subscribers are indexed by topic when they
+# register. Posts from the channel's own worker are delivered synchronously;
+# posts from any other thread are queued onto that worker so module handlers
+# never run concurrently. While a module is being swapped out, deliveries
+# are held and replayed in order once the new instance is registered.
+class MessageBus:
+        def __init__(self, worker=None):
+                self.worker = worker
+                self.lock = threading.Lock()
+                self.members = {} # module -> {topic: handler}
+                self.topics = {} # topic -> {module: handler}
+                self.stats = collections.defaultdict(TopicStats)
+                self.held = None # deliveries waiting out a hot swap
+
+        def register(self, mod):
+                subs = subscriptions(mod)
+                with self.lock:
+                        self.members[mod] = subs
+                        for topic, handler in subs.items():
+                                # Copy on write so deliveries in flight can
+                                # iterate without holding the lock
+                                handlers = dict(self.topics.get(topic, {}))
+                                handlers[mod] = handler
+                                self.topics[topic] = handlers
+
+        def unregister(self, mod):
+                with self.lock:
+                        subs = self.members.pop(mod, None)
+                        if subs is None:
+                                return
+                        for topic in subs:
+                                handlers = dict(self.topics[topic])
+                                del handlers[mod]
+                                if handlers:
+                                        self.topics[topic] = handlers
+                                else:
+                                        del self.topics[topic]
+
+        def post(self, src, msg, args, kwargs, queued=None):
+                if queued is None:
+                        queued = (self.worker is not None and
+                                        threading.current_thread() is not self.worker)
+                if queued and self.worker is not None:
+                        self.stats[msg].queued += 1
+                        # Bus events come from timers, analysers and other
+                        # modules, never from chat; they are never shed
+                        self.worker.submit_control(self.deliver, src, msg, args,
+                                        kwargs, time.time())
+                else:
+                        self.deliver(src, msg, args, kwargs, time.time())
+
+        def hold(self):
+                # Only called on the channel's worker, like deliver itself
+                if self.held is None:
+                        self.held = []
+
+        def release(self):
+                held, self.held = self.held, None
+                for item in held or ():
+                        try:
+                                self.deliver(*item)
+                        except Exception:
+                                logging.exception("Error replaying held bus message %s",
+                                                item[1])
+
+        def deliver(self, src, msg, args, kwargs, posted):
+                if self.held is not None:
+                        self.held.append((src, msg, args, kwargs, posted))
+                        return
+                handlers = self.topics.get(msg)
+                wildcard = self.topics.get(WILDCARD)
+                try:
+                        if handlers:
+                                for m, h in handlers.items():
+                                        if m is not src:
+                                                with HANDLER_TIME.time(m.name, msg):
+                                                        h(*args, **kwargs)
+                        if wildcard:
+                                for m, h in wildcard.items():
+                                        if m is not src:
+                                                with HANDLER_TIME.time(m.name, msg):
+                                                        h(msg, args, kwargs)
+                finally:
+                        elapsed = time.time() - posted
+                        DELIVERY_TIME.observe(elapsed, msg)
+                        st = self.stats[msg]
+                        st.delivered += 1
+                        st.total += elapsed
+                        st.max = max(st.max, elapsed)
+
+        def topic_stats(self):
+                res = {}
+                for topic, st in list(self.stats.items()):
+                        n = max(st.delivered, 1)
+                        res[topic] = {
+                                'delivered': st.delivered,
+                                'queued': st.queued,
+                                'avg': st.total / n,
+                                'max': st.max,
+                        }
+                return res
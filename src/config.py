@@ -0,0 +1,22 @@
+# Channel sections of the config, parsed once at startup. Module options are
+# written as <prefix>_<key>; every possible prefix of each option is indexed,
+# so a module's settings are a single lookup however long the section is.
+class ChannelConfig:
+        def __init__(self, conf):
+                self.channels = [s for s in conf.sections() if s[0] == '#']
+                self.modules = {} # channel -> [module name]
+                self.options = {} # channel -> {prefix -> {key -> value}}
+
+                for c in self.channels:
+                        self.modules[c] = [m.strip() for m in
+                                        conf.get(c, 'modules').split(',') if m.strip()]
+                        index = self.options[c] = {}
+                        for k, v in conf.items(c):
+                                pos = k.find('_')
+                                while pos > 0:
+                                        index.setdefault(k[:pos], {})[k[pos+1:]] = v
+                                        pos = k.find('_', pos + 1)
+
+        def module_conf(self, chan, prefix):
+                # A fresh dict each time; modules may keep and modify theirs
+                return dict(self.options.get(chan, {}).get(prefix, {}))
@@ -0,0 +1,217 @@
+import collections, threading, time, logging, heapq, itertools
+
+from . import metrics
+
+QUEUE_SIZE = 256
+WARN_INTERVAL = 10 # seconds between warnings about a full queue
+
+WAIT_TIME = metrics.histogram('dispatch_wait_seconds',
+                'Time work items spend queued for a channel worker')
+RUN_TIME = metrics.histogram('dispatch_run_seconds',
+                'Time channel workers spend running a work item')
+DROPPED = metrics.counter('dispatch_dropped', 'Work items dropped on a full queue')
+
+# Single worker thread per channel, while separate channels proceed in
+# parallel. Chat goes through a bounded queue that sheds load when full.
+# Control work (bus events such as detected deaths, channel lifecycle,
+# metacommands) has its own lane that is never shed and runs ahead of chat.
+# Within each lane items run strictly in the order they were submitted.
+class ChannelWorker(threading.Thread):
+        def __init__(self, chan, size=QUEUE_SIZE):
+                threading.Thread.__init__(self, name='dispatch-' + chan)
+                self.daemon = True
+
+                self.chan = chan
+                self.size = size
+                self.cond = threading.Condition()
+                self.chat = collections.deque()
+                self.control = collections.deque()
+                self.stopping = False
+                self.warned = 0.0
+                self.unwarned = 0 # drops since the last warning
+
+                # Statistics
+                self.handled = 0
+                self.dropped = 0
+                self.wait_total = 0.0
+                self.run_total = 0.0
+                self.run_max = 0.0
+
+        def submit(self, fn, *args):
+                # Never blocks: producers such as the IRC reactor serve every
+                # channel, so a flooded channel sheds its own load instead
+                with self.cond:
+                        if len(self.chat) < self.size:
+                                self.chat.append((time.time(), fn, args))
+                                self.cond.notify()
+                                return True
+                        self.dropped += 1
+                        self.unwarned += 1
+                        now = time.time()
+                        warn = now - self.warned >= WARN_INTERVAL
+                        if warn:
+                                n, self.unwarned = self.unwarned, 0
+                                self.warned = now
+                DROPPED.inc()
+                if warn:
+                        logging.warning("Dispatch queue full for %s, dropped %d work items",
+                                        self.chan, n)
+                return False
+
+        def submit_control(self, fn, *args):
+                with self.cond:
+                        self.control.append((time.time(), fn, args))
+                        self.cond.notify()
+                return True
+
+        def stop(self):
+                # Safe from the worker itself, and with full queues
+                with self.cond:
+                        self.stopping = True
+                        self.cond.notify()
+
+        def next_item(self):
+                with self.cond:
+                        while not (self.stopping or self.control or self.chat):
+                                self.cond.wait()
+                        if self.stopping:
+                                return None
+                        return (self.control or self.chat).popleft()
+
+        def run(self):
+                while True:
+                        item = self.next_item()
+                        if item is None:
+                                break
+                        queued, fn, args = item
+                        start = time.time()
+                        try:
+                                fn(*args)
+                        except Exception:
+                                logging.exception("Unhandled error in dispatch for %s",
+                                                self.chan)
+                        end = time.time()
+                        # Don't keep the item alive while waiting for the
+                        # next, or a swapped-out module looks leaked
+                        item = fn = args = None
+
+                        elapsed = end - start
+                        WAIT_TIME.observe(start - queued)
+                        RUN_TIME.observe(elapsed)
+                        self.handled += 1
+                        self.wait_total += start - queued
+                        self.run_total += elapsed
+                        self.run_max = max(self.run_max, elapsed)
+
+        def stats(self):
+                n = max(self.handled, 1)
+                return {
+                        'depth': len(self.chat) + len(self.control),
+                        'handled': self.handled,
+                        'dropped': self.dropped,
+                        'avg_wait': self.wait_total / n,
+                        'avg_run': self.run_total / n,
+                        'max_run': self.run_max,
+                }
+
+class Dispatcher:
+        def __init__(self, size=QUEUE_SIZE):
+                self.size = size
+                self.workers = {} # Maps channel to ChannelWorker
+                self.lock = threading.Lock()
+
+        def worker(self, chan):
+                with self.lock:
+                        w = self.workers.get(chan)
+                        if w is None:
+                                w = ChannelWorker(chan, self.size)
+                                w.start()
+                                self.workers[chan] = w
+                        return w
+
+        def find(self, chan):
+                # The channel's worker if it has one; never starts one
+                with self.lock:
+                        return self.workers.get(chan)
+
+        def submit(self, chan, fn, *args):
+                return self.worker(chan).submit(fn, *args)
+
+        def submit_control(self, chan, fn, *args):
+                return self.worker(chan).submit_control(fn, *args)
+
+        def stop(self, chan):
+                with self.lock:
+                        w = self.workers.pop(chan, None)
+                if w is not None:
+                        w.stop()
+
+        def stop_all(self):
+                with self.lock:
+                        workers = list(self.workers.values())
+                        self.workers = {}
+                for w in workers:
+                        w.stop()
+
+        def stats(self):
+                with self.lock:
+                        workers = list(self.workers.items())
+                return dict((c, w.stats()) for c, w in workers)
+
+class Timer:
+        __slots__ = ('when', 'fn', 'args', 'cancelled')
+
+        def __init__(self, when, fn, args):
+                self.when = when
+                self.fn = fn
+                self.args = args
+                self.cancelled = False
+
+        def cancel(self):
+                self.cancelled = True
+
+# One thread running delayed calls in deadline order, so nothing has to
+# sleep on a thread that has other work to do. Calls should be short; long
+# work belongs on a channel worker (submit it from the timer).
+class Timers(threading.Thread):
+        def __init__(self):
+                threading.Thread.__init__(self, name='timers')
+                self.daemon = True
+
+                self.cond = threading.Condition()
+                self.heap = [] # (when, seq, Timer)
+                self.seq = itertools.count()
+                self.started = False
+
+        def call_later(self, delay, fn, *args):
+                t = Timer(time.monotonic() + delay, fn, args)
+                with self.cond:
+                        if not self.started:
+                                self.started = True
+                                self.start()
+                        heapq.heappush(self.heap, (t.when, next(self.seq), t))
+                        self.cond.notify()
+                return t
+
+        def pending(self):
+                with self.cond:
+                        return sum(1 for e in self.heap if not e[2].cancelled)
+
+        def run(self):
+                while True:
+                        with self.cond:
+                                while True:
+                                        now = time.monotonic()
+                                        if self.heap and self.heap[0][0] <= now:
+                                                t = heapq.heappop(self.heap)[2]
+                                                break
+                                        self.cond.wait(self.heap[0][0] - now
+                                                        if self.heap else None)
+                        if t.cancelled:
+                                continue
+                        try:
+                                t.fn(*t.args)
+                        except Exception:
+                                logging.exception("Unhandled error in timer")
+
+timers = Timers()
@@ -0,0 +1,54 @@
+import socket, struct, collections, os
+
+# Binary event protocol spoken by the analyser, see native/src/events.hpp.
+# Each record is a uint32 length followed by that many bytes: a uint8 type,
+# a double wall clock time, a uint64 source frame index and a type-specific
+# body. Everything is little-endian.
+
+ENV_VAR = 'MORBIDCV_EVENTS'
+
+STARTING = 1
+DIED = 2
+STATS = 3
+ENDED = 4
+
+LENGTH = struct.Struct('<I')
+HEADER = struct.Struct('<BdQ')
+BODIES = {
+        DIED: struct.Struct('<I'), # source frames the message was up for
+        STATS: struct.Struct('<fffff'), # fps, lag, decode ms, match ms, source fps
+}
+MAX_RECORD = 256
+
+Event = collections.namedtuple('Event', ['type', 'time', 'frame', 'data'])
+
+def listen(path):
+        # Socket the analyser connects back to; path goes in its environment
+        if os.path.exists(path):
+                os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(1)
+        return sock
+
+def decode(record):
+        kind, ts, frame = HEADER.unpack_from(record)
+        body = BODIES.get(kind)
+        data = body.unpack_from(record, HEADER.size) if body is not None else ()
+        return Event(kind, ts, frame, data)
+
+def split(buf):
+        # Takes every complete record off the front of buf, a bytearray filled
+        # from a non-blocking socket, and returns their Events. A partial
+        # record is left for the next read.
+        evs = []
+        while len(buf) >= LENGTH.size:
+                n = LENGTH.unpack_from(buf)[0]
+                if n < HEADER.size or n > MAX_RECORD:
+                        raise ValueError('Bad event record length %d' % n)
+                end = LENGTH.size + n
+                if len(buf) < end:
+                        break
+                evs.append(decode(bytes(buf[LENGTH.size:end])))
+                del buf[:end]
+        return evs
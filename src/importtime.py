@@ -0,0 +1,56 @@
+import subprocess, sys, os, os.path, configparser
+
+# Import-time profile of the bot and its modules, using the interpreter's own
+# -X importtime instrumentation in a fresh process.
+#
+#   python3 -m src.importtime [config.cfg] [entries to show]
+
+DEFAULT_TOP = 25
+
+def configured_modules(path):
+        conf = configparser.ConfigParser()
+        conf.read(path)
+        mods = set()
+        for s in conf.sections():
+                if s[0] == '#' and conf.has_option(s, 'modules'):
+                        mods.update(m.strip() for m in conf.get(s, 'modules').split(',')
+                                        if m.strip())
+        return sorted(mods)
+
+def profile(imports):
+        code = '; '.join('import %s' % m for m in imports)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                        cwd=root, stderr=subprocess.PIPE, universal_newlines=True)
+
+        entries = [] # (self us, cumulative us, name)
+        for line in proc.stderr.splitlines():
+                if not line.startswith('import time:'):
+                        continue
+                fields = line[len('import time:'):].split('|')
+                try:
+                        own, cumulative = int(fields[0]), int(fields[1])
+                except ValueError:
+                        continue # the header line
+                entries.append((own, cumulative, fields[2].rstrip()))
+        return proc.returncode, entries
+
+def report(imports, top=DEFAULT_TOP):
+        rc, entries = profile(imports)
+        if rc != 0:
+                print("Importing failed; run with python3 -X importtime to see why")
+        print("%-8s %-10s %s" % ('self ms', 'total ms', 'module'))
+        for own, cumulative, name in sorted(entries, key=lambda e: -e[1])[:top]:
+                print("%7.1f %9.1f  %s" % (own / 1000, cumulative / 1000, name))
+        total = sum(e[0] for e in entries)
+        print("%d modules imported in %.1fms" % (len(entries), total / 1000))
+
+if __name__ == '__main__':
+        path = sys.argv[1] if len(sys.argv) > 1 else 'config.cfg'
+        top = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_TOP
+        imports = ['src.bot'] + ['src.modules.%s' % m for m in configured_modules(path)]
+        print("Startup imports (before any channel starts):")
+        report(['src.bot'], top)
+        print()
+        print("Including configured modules: %s" % ', '.join(imports[1:]))
+        report(imports, top)
@@ -0,0 +1,137 @@
+import threading, weakref, logging, gc, os, resource
+
+STOP_TIMEOUT = 5 # seconds a process gets to exit on SIGTERM
+
+# Everything one owner holds: module instances, threads and subprocesses.
+# Held weakly, so tracking never keeps anything alive. Objects that have been torn down move to `retired`; anything still
+# there a while later is being kept alive by something and has leaked.
+class ChannelResources:
+        __slots__ = ('chan', 'instances', 'threads', 'processes', 'retired')
+
+        def __init__(self, chan):
+                self.chan = chan
+                self.instances = weakref.WeakSet()
+                self.threads = weakref.WeakSet()
+                self.processes = weakref.WeakSet()
+                self.retired = weakref.WeakSet()
+
+        def empty(self):
+                return not (self.instances or self.threads or self.processes
+                                or self.retired)
+
+def kind(obj):
+        if isinstance(obj, threading.Thread):
+                return 'threads'
+        if hasattr(obj, 'pid') and hasattr(obj, 'poll'):
+                return 'processes'
+        return 'instances'
+
+def object_count():
+        return len(gc.get_objects())
+
+def rss_mb():
+        try:
+                with open('/proc/self/statm') as f:
+                        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+        except (OSError, ValueError):
+                return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Tracks what every channel owns, so a part, unload or disconnect can take
+# all of it down, and so leftovers can be reported. Resources shared between
+# channels (one analyser serving every channel watching a stream) are held
+# under their own key; each channel using one subscribes to it, and is
+# answerable for it in reports until it lets go.
+class Lifecycle:
+        def __init__(self):
+                self.lock = threading.Lock()
+                self.channels = {} # chan -> ChannelResources
+                self.shared = {} # key -> ChannelResources
+                self.subscriptions = {} # chan -> {key: release}
+
+        def track(self, table, owner, obj):
+                with self.lock:
+                        res = table.get(owner)
+                        if res is None:
+                                res = table[owner] = ChannelResources(owner)
+                        getattr(res, kind(obj)).add(obj)
+
+        def forget(self, table, owner, obj):
+                with self.lock:
+                        res = table.get(owner)
+                        if res is None:
+                                return
+                        getattr(res, kind(obj)).discard(obj)
+                        res.retired.add(obj)
+
+        def add(self, chan, obj):
+                self.track(self.channels, chan, obj)
+
+        def retire(self, chan, obj):
+                self.forget(self.channels, chan, obj)
+
+        def add_shared(self, key, obj):
+                self.track(self.shared, key, obj)
+
+        def retire_shared(self, key, obj):
+                self.forget(self.shared, key, obj)
+
+        def subscribe(self, chan, key, release):
+                # release() lets go of the shared resource, should the channel
+                # be torn down while still holding it
+                with self.lock:
+                        self.subscriptions.setdefault(chan, {})[key] = release
+
+        def unsubscribe(self, chan, key):
+                with self.lock:
+                        subs = self.subscriptions.get(chan)
+                        if subs is not None:
+                                subs.pop(key, None)
+                                if not subs:
+                                        del self.subscriptions[chan]
+
+        def teardown(self, chan):
+                # Lets go of everything the channel shares once its modules
+                # have shut down. Analysers are shared: releasing them only
+                # asks their I/O loop to stop them, and never blocks.
+                with self.lock:
+                        releases = list(self.subscriptions.pop(chan, {}).values())
+
+                for release in releases:
+                        try:
+                                release()
+                        except Exception:
+                                logging.exception("Error releasing a shared resource of %s", chan)
+
+        def counts(self, r):
+                return {
+                        'instances': len(r.instances),
+                        'threads': sum(1 for t in r.threads if t.is_alive()),
+                        'processes': sum(1 for p in r.processes if p.poll() is None),
+                        'retired': len(r.retired),
+                }
+
+        def report(self):
+                # chan -> counts of what is resident, including the shared
+                # resources the channel subscribes to. Owners with nothing
+                # left are forgotten here.
+                gc.collect()
+                res = {}
+                with self.lock:
+                        for table in (self.channels, self.shared):
+                                for owner, r in list(table.items()):
+                                        if r.empty():
+                                                del table[owner]
+                        for chan, r in self.channels.items():
+                                res[chan] = self.counts(r)
+                        for chan, subs in self.subscriptions.items():
+                                c = res.setdefault(chan, dict.fromkeys(
+                                                ('instances', 'threads', 'processes', 'retired'), 0))
+                                for key in subs:
+                                        r = self.shared.get(key)
+                                        if r is None:
+                                                continue
+                                        for k, v in self.counts(r).items():
+                                                c[k] += v
+                return res
+
+resources = Lifecycle()
@@ -0,0 +1,553 @@
+import argparse, array, collections, configparser, importlib, json, logging
+import os, os.path
+import random, resource, socket, sys, tempfile, threading, time
+
+from . import outgoing, lifecycle
+
+# Chat-load simulator for the bot core. A stand-in IRC server on localhost
+# plays synthetic or recorded chat into a real Bot over a real connection, so
+# on_pubmsg, routing, metacommands, modules, the bus and the send queue all
+# run as they do in production. Everything the bot sends back is captured.
+#
+#   python3 -m src.loadtest --channels 20 --rate 200 --duration 60
+#   python3 -m src.loadtest --replay chat.log --speed 4 --json run.json
+#   python3 -m src.loadtest --flood --unlimited --json new.json --baseline old.json
+#
+# Recorded chat is one message per line: "<seconds> <#channel> <nick> <text>".
+# Every message is sent under a unique nick ("<nick>_<seq>"), which is how a
+# reply is traced back to the message that caused it. Results written with
+# --json can be compared against an earlier run with --baseline; the exit
+# status is 1 if throughput, latency or memory growth regressed.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = 'tmi.twitch.tv'
+NICK = 'loadbot'
+ADMIN = 'admin'
+
+TICK = 0.01
+READY_TIMEOUT = 600
+DRAIN_TIMEOUT = 60
+
+# Twitch's own limits, which the send queue and the joiner must stay under
+CHAT_WINDOW = 30
+CHAT_LIMIT = 20
+MOD_CHAT_LIMIT = 100
+JOIN_WINDOW = 10
+JOIN_LIMIT = 20
+
+WORDS = ('kappa pog lul gg wp rip nice run boss again why chat hype clip '
+                'lag dead no way omg lets go monkaS wow').split()
+META = ('!mbt stats',)
+
+# How far a result may move against the baseline before it counts as a
+# regression
+TOLERANCE = {'throughput': 0.10, 'p50': 0.25, 'p99': 0.25, 'rss_growth_mb': 0.25}
+MIN_LATENCY = 0.001 # latency changes below this are noise
+MIN_GROWTH = 2.0 # MB
+
+DEFAULT_TEMPLATE = {
+        'modules': 'deathcounter',
+        'death_admins': ADMIN,
+        'death_spaced_text': 'false',
+}
+
+def base_nick(nick):
+        return nick.rpartition('_')[0] or nick
+
+def seq_of(nick):
+        try:
+                return int(nick.rpartition('_')[2])
+        except ValueError:
+                return None
+
+def percentile(values, p):
+        if not values:
+                return 0.0
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+# Admin checks by the bot see unique nicks; match them on the recorded name
+class Nicks:
+        def __init__(self, names):
+                self.names = set(names)
+
+        def __contains__(self, nick):
+                return nick in self.names or base_nick(nick) in self.names
+
+        def __iter__(self):
+                return iter(self.names)
+
+# Traffic is a list of (offset seconds, channel, nick, text), sorted by offset
+def synthetic(channels, rate, duration, commands, command_ratio, meta_ratio,
+                seed):
+        rng = random.Random(seed)
+        total = int(rate * duration)
+        traffic = []
+        for i in range(total):
+                chan = rng.choice(channels)
+                r = rng.random()
+                if r < meta_ratio:
+                        nick, text = ADMIN, rng.choice(META)
+                elif r < meta_ratio + command_ratio and commands:
+                        nick, text = 'viewer', rng.choice(commands)
+                else:
+                        nick = 'viewer'
+                        text = ' '.join(rng.choice(WORDS)
+                                        for _ in range(rng.randint(1, 8)))
+                traffic.append((i / rate, chan, nick, text))
+        return traffic
+
+def recorded(path, speed):
+        traffic = []
+        with open(path, encoding='utf-8') as f:
+                for line in f:
+                        parts = line.rstrip('\r\n').split(' ', 3)
+                        if len(parts) < 4 or not parts[1].startswith('#'):
+                                continue
+                        traffic.append((float(parts[0]) / speed, parts[1].lower(),
+                                        parts[2], parts[3]))
+        traffic.sort(key=lambda t: t[0])
+        if traffic:
+                start = traffic[0][0]
+                traffic = [(t - start, c, n, m) for t, c, n, m in traffic]
+        return traffic
+
+# Sliding-window check of what the bot sends against Twitch's limits
+class RateCheck:
+        def __init__(self, window, limit):
+                self.window = window
+                self.limit = limit
+                self.times = collections.deque()
+                self.violations = 0
+
+        def add(self, now):
+                self.times.append(now)
+                while self.times[0] < now - self.window:
+                        self.times.popleft()
+                if len(self.times) > self.limit:
+                        self.violations += 1
+
+# Just enough of Twitch's IRC server for the bot: registration, the
+# membership capability, JOIN with a NAMES reply, and PRIVMSG both ways.
+class ChatServer(threading.Thread):
+        def __init__(self, traffic, moderator):
+                threading.Thread.__init__(self, name='chat-server')
+                self.daemon = True
+
+                self.traffic = traffic
+                self.moderator = moderator
+                self.listener = socket.socket()
+                self.listener.bind(('127.0.0.1', 0))
+                self.listener.listen(1)
+                self.port = self.listener.getsockname()[1]
+                self.conn = None
+                self.wlock = threading.Lock()
+                self.go = threading.Event()
+
+                # Send time of every message, by sequence number. Allocated up
+                # front so it doesn't count as growth in the bot.
+                self.sent_at = array.array('d', bytes(8 * len(traffic)))
+                self.sent = 0
+                self.feed_done = None
+
+                self.joined = set()
+                self.replies = 0
+                self.on_reply = None
+                self.chat = RateCheck(CHAT_WINDOW, CHAT_LIMIT)
+                self.mod_chat = RateCheck(CHAT_WINDOW, MOD_CHAT_LIMIT)
+                self.joins = RateCheck(JOIN_WINDOW, JOIN_LIMIT)
+
+        def write(self, lines):
+                data = ''.join(l + '\r\n' for l in lines).encode('utf-8')
+                with self.wlock:
+                        self.conn.sendall(data)
+
+        def run(self):
+                self.conn, _ = self.listener.accept()
+                self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                feeder = threading.Thread(target=self.feed, name='chat-feed')
+                feeder.daemon = True
+                feeder.start()
+
+                buf = b''
+                while True:
+                        data = self.conn.recv(65536)
+                        if not data:
+                                break
+                        buf += data
+                        *lines, buf = buf.split(b'\r\n')
+                        for line in lines:
+                                self.handle(line.decode('utf-8', 'replace'))
+
+        def handle(self, line):
+                now = time.perf_counter()
+                cmd, _, rest = line.partition(' ')
+                if cmd == 'NICK':
+                        self.write([':%s 001 %s :Welcome, GLHF!' % (HOST, NICK),
+                                        ':%s 376 %s :>' % (HOST, NICK)])
+                elif cmd == 'CAP':
+                        self.write([':%s CAP * ACK %s' % (HOST, rest.split(' ', 1)[1])])
+                elif cmd == 'JOIN':
+                        for chan in rest.split(','):
+                                self.joins.add(now)
+                                self.joined.add(chan)
+                                lines = [':%s!%s@%s.%s JOIN %s' % (NICK, NICK, NICK, HOST, chan),
+                                                ':%s 353 %s = %s :%s' % (HOST, NICK, chan, NICK),
+                                                ':%s 366 %s %s :End of /NAMES list' % (HOST, NICK, chan)]
+                                if self.moderator:
+                                        lines.append(':jtv MODE %s +o %s' % (chan, NICK))
+                                self.write(lines)
+                elif cmd == 'PING':
+                        self.write(['PONG %s' % rest])
+                elif cmd == 'PRIVMSG':
+                        chan, _, text = rest.partition(' :')
+                        self.mod_chat.add(now)
+                        if not self.moderator:
+                                self.chat.add(now)
+                        self.replies += 1
+                        if self.on_reply is not None:
+                                self.on_reply(now, chan, text)
+
+        def feed(self):
+                self.go.wait()
+                start = time.perf_counter()
+                i, n = 0, len(self.traffic)
+                while i < n:
+                        now = time.perf_counter() - start
+                        lines = []
+                        while i < n and self.traffic[i][0] <= now:
+                                _, chan, nick, text = self.traffic[i]
+                                nick = '%s_%d' % (nick, i)
+                                lines.append(':%s!%s@%s.%s PRIVMSG %s :%s' % (
+                                                nick, nick, nick, HOST, chan, text))
+                                self.sent_at[i] = time.perf_counter()
+                                i += 1
+                        if lines:
+                                self.write(lines)
+                                self.sent = i
+                        if i < n:
+                                time.sleep(max(0, min(TICK, self.traffic[i][0] - now)))
+                self.feed_done = time.perf_counter()
+
+# Runs the bot against the server and works out where each reply came from.
+# Replies are traced through the send queue by (channel, text), following
+# keyed messages that replace an earlier one still waiting to be sent, and
+# matched in order once the queue hands them to the connection.
+class LoadTest:
+        def __init__(self, conf, traffic, moderator=False, unlimited=False):
+                self.traffic = traffic
+                self.server = ChatServer(traffic, moderator)
+                self.server.on_reply = self.reply_seen
+                conf['Connection']['port'] = str(self.server.port)
+
+                self.lock = threading.Lock()
+                self.local = threading.local()
+                self.waiting = collections.defaultdict(list) # (chan, text) -> [seq]
+                self.keyed = {} # (chan, key) -> text last queued with that key
+                self.in_flight = collections.defaultdict(collections.deque) # (chan, text) -> [[seq]]
+                self.latencies = []
+                self.unprompted = 0
+                self.processed = 0
+                self.last_processed = None
+
+                from . import bot
+                self.server.start()
+                self.bot = bot.Bot(conf)
+                self.bot.admins = Nicks(self.bot.admins)
+                if unlimited:
+                        # Measure the bot rather than Twitch's rate limits
+                        self.bot.outgoing.mod_bucket = outgoing.TokenBucket(10**9)
+                        self.bot.outgoing.normal_bucket = outgoing.TokenBucket(10**9)
+                self.hook()
+
+        def hook(self):
+                handle_pubmsg = self.bot.handle_pubmsg
+                queue = self.bot.outgoing
+                privmsg, pop = queue.privmsg, queue.pop
+
+                def traced_pubmsg(conn, chan, src, content):
+                        self.local.seq = seq_of(src)
+                        try:
+                                handle_pubmsg(conn, chan, src, content)
+                        finally:
+                                self.local.seq = None
+                                with self.lock:
+                                        self.processed += 1
+                                        self.last_processed = time.perf_counter()
+
+                # Both run under the queue's own lock, so the bookkeeping
+                # always agrees with what is pending
+                def traced_privmsg(chan, msg, priority=outgoing.PRIO_NORMAL, key=None):
+                        seq = getattr(self.local, 'seq', None)
+                        with queue.cond, self.lock:
+                                if key is not None:
+                                        old = self.keyed.get((chan, key))
+                                        if old is not None and old != msg:
+                                                moved = self.waiting.pop((chan, old), None)
+                                                if moved:
+                                                        self.waiting[(chan, msg)].extend(moved)
+                                        self.keyed[(chan, key)] = msg
+                                if seq is not None:
+                                        self.waiting[(chan, msg)].append(seq)
+                                privmsg(chan, msg, priority, key)
+
+                def traced_pop(m):
+                        with self.lock:
+                                seqs = self.waiting.pop((m.chan, m.text), [])
+                                self.in_flight[(m.chan, m.text)].append(seqs)
+                        pop(m)
+
+                self.bot.handle_pubmsg = traced_pubmsg
+                queue.privmsg = traced_privmsg
+                queue.pop = traced_pop
+
+        def reply_seen(self, now, chan, text):
+                with self.lock:
+                        q = self.in_flight.get((chan, text))
+                        seqs = q.popleft() if q else None
+                        if not q:
+                                self.in_flight.pop((chan, text), None)
+                        if not seqs:
+                                self.unprompted += 1
+                                return
+                        for s in seqs:
+                                self.latencies.append(now - self.server.sent_at[s])
+
+        def wait_ready(self, channels):
+                deadline = time.time() + READY_TIMEOUT
+                while time.time() < deadline:
+                        if all(c in self.bot.chan_routes for c in channels):
+                                return True
+                        time.sleep(0.1)
+                return False
+
+        def dropped(self):
+                return sum(st['dropped'] for st in self.bot.dispatcher.stats().values())
+
+        def run(self, drain=DRAIN_TIMEOUT):
+                runner = threading.Thread(target=self.bot.start, name='bot')
+                runner.daemon = True
+                runner.start()
+
+                channels = sorted(set(t[1] for t in self.traffic))
+                if not self.wait_ready(channels):
+                        raise RuntimeError('Channels did not start within %ds' % READY_TIMEOUT)
+                # Startup chatter isn't part of the measurement
+                time.sleep(0.5)
+                with self.lock:
+                        self.latencies = []
+                        self.unprompted = 0
+                replies_before = self.server.replies
+                dropped_before = self.dropped()
+                rss_start = lifecycle.rss_mb()
+
+                self.server.go.set()
+                start = time.perf_counter()
+                n = len(self.traffic)
+                deadline = None
+                while True:
+                        time.sleep(TICK)
+                        with self.lock:
+                                done = self.processed + self.dropped() - dropped_before >= n
+                        if self.server.feed_done is None:
+                                continue
+                        if deadline is None:
+                                deadline = time.perf_counter() + drain
+                        idle = done and self.bot.outgoing.stats()['pending'] == 0
+                        if idle or time.perf_counter() > deadline:
+                                break
+                # Let the last reply reach the server
+                time.sleep(0.2)
+                rss_end = lifecycle.rss_mb()
+
+                with self.lock:
+                        lat = sorted(self.latencies)
+                        unanswered = sum(len(v) for v in self.waiting.values()) + \
+                                        sum(len(s) for q in self.in_flight.values() for s in q)
+                        processed = self.processed
+                        elapsed = (self.last_processed or start) - start
+                        unprompted = self.unprompted
+                feed = self.server.feed_done - start
+                out = self.bot.outgoing.stats()
+                return {
+                        'channels': len(channels),
+                        'messages': n,
+                        'offered_rate': n / feed if feed > 0 else 0.0,
+                        'processed': processed,
+                        'dropped': self.dropped() - dropped_before,
+                        'throughput': processed / elapsed if elapsed > 0 else 0.0,
+                        'replies': self.server.replies - replies_before,
+                        'answered': len(lat),
+                        'unanswered': unanswered,
+                        'unprompted': unprompted,
+                        'merged': out['merged'],
+                        'send_dropped': out['dropped_stale'] + out['dropped_full'],
+                        'p50': percentile(lat, 50),
+                        'p90': percentile(lat, 90),
+                        'p99': percentile(lat, 99),
+                        'max': lat[-1] if lat else 0.0,
+                        'rss_start_mb': rss_start,
+                        'rss_end_mb': rss_end,
+                        'rss_growth_mb': rss_end - rss_start,
+                        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                        'chat_violations': self.server.chat.violations,
+                        'mod_chat_violations': self.server.mod_chat.violations,
+                        'join_violations': self.server.joins.violations,
+                }
+
+def make_config(channels, template_path=None):
+        templates = []
+        if template_path:
+                tconf = configparser.ConfigParser()
+                tconf.read(template_path)
+                templates = [dict(tconf.items(s)) for s in tconf.sections() if s[0] == '#']
+        if not templates:
+                templates = [DEFAULT_TEMPLATE]
+
+        conf = configparser.ConfigParser()
+        conf['Connection'] = {
+                'server': '127.0.0.1',
+                'port': '0',
+                'username': NICK,
+                'oauth_password': 'oauth:loadtest',
+                'debug': 'false',
+                'quiet': 'true',
+                'sys_admins': ADMIN,
+        }
+        for i, c in enumerate(channels):
+                conf[c] = templates[i % len(templates)]
+        return conf
+
+def channel_commands(conf, channels):
+        # Every command the configured modules answer, with no arguments
+        from . import routing, config
+        cc = config.ChannelConfig(conf)
+        names = set()
+        for c in channels:
+                names.update(cc.modules.get(c, ()))
+        cmds = set()
+        for m in names:
+                mod = importlib.import_module('src.modules.%s' % m)
+                cmds.update(routing.class_commands(mod.ModuleMain))
+        return sorted('!' + c for c in cmds)
+
+def offline_twitch(channels):
+        # Channel metadata comes from the cache alone; nothing goes to Twitch
+        from . import twitch
+        twitch.channels.ttl = float('inf')
+        twitch.channels.refresher = threading.current_thread()
+        for c in channels:
+                name = twitch.channel_name(c)
+                twitch.channels.store(name, {'name': name, 'game': 'Load Test'})
+
+def compare(result, baseline):
+        regressions = []
+        lines = []
+        for key, tol in sorted(TOLERANCE.items()):
+                old, new = baseline.get(key), result.get(key)
+                if old is None or new is None:
+                        continue
+                if key == 'throughput':
+                        worse = new < old * (1 - tol)
+                elif key == 'rss_growth_mb':
+                        worse = new > max(old, 0) * (1 + tol) + MIN_GROWTH
+                else:
+                        worse = new > old * (1 + tol) + MIN_LATENCY
+                lines.append('%-14s %12.4f %12.4f%s' % (key, old, new,
+                                '  REGRESSION' if worse else ''))
+                if worse:
+                        regressions.append(key)
+        for key in ('chat_violations', 'mod_chat_violations', 'join_violations'):
+                if result.get(key, 0) > baseline.get(key, 0):
+                        lines.append('%-14s %12d %12d  REGRESSION' % (key[:14],
+                                        baseline.get(key, 0), result[key]))
+                        regressions.append(key)
+        return regressions, lines
+
+def report(res):
+        print('%d messages over %d channels, offered at %.1f/s' % (
+                        res['messages'], res['channels'], res['offered_rate']))
+        print('processed %d (%.1f msg/s), dropped %d' % (
+                        res['processed'], res['throughput'], res['dropped']))
+        print('replies %d: answered %d, unanswered %d, unprompted %d' % (
+                        res['replies'], res['answered'], res['unanswered'],
+                        res['unprompted']))
+        print('send queue: merged %d, dropped %d' % (res['merged'], res['send_dropped']))
+        print('latency ms: p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % tuple(
+                        1000 * res[k] for k in ('p50', 'p90', 'p99', 'max')))
+        print('memory MB: start %.1f  end %.1f  growth %.1f  peak %.1f' % (
+                        res['rss_start_mb'], res['rss_end_mb'], res['rss_growth_mb'],
+                        res['peak_rss_mb']))
+        print('rate limit violations: chat %d  moderator chat %d  join %d' % (
+                        res['chat_violations'], res['mod_chat_violations'],
+                        res['join_violations']))
+
+def main():
+        ap = argparse.ArgumentParser()
+        ap.add_argument('--channels', type=int, default=10)
+        ap.add_argument('--rate', type=float, default=100,
+                        help='synthetic messages per second, across all channels')
+        ap.add_argument('--duration', type=float, default=30)
+        ap.add_argument('--commands', type=float, default=0.2,
+                        help='fraction of synthetic messages that are module commands')
+        ap.add_argument('--meta', type=float, default=0.01,
+                        help='fraction of synthetic messages that are metacommands')
+        ap.add_argument('--seed', type=int, default=1)
+        ap.add_argument('--flood', action='store_true',
+                        help='send everything at once to find the most the bot can take')
+        ap.add_argument('--replay', help='recorded chat to play instead')
+        ap.add_argument('--speed', type=float, default=1.0,
+                        help='playback speed for --replay')
+        ap.add_argument('--config', help='take channel sections from this config')
+        ap.add_argument('--moderator', action='store_true',
+                        help='make the bot a moderator in every channel')
+        ap.add_argument('--unlimited', action='store_true',
+                        help='lift the send rate limits to measure the bot alone')
+        ap.add_argument('--drain', type=float, default=DRAIN_TIMEOUT,
+                        help='seconds to wait for replies after the feed ends')
+        ap.add_argument('--json', help='write results here')
+        ap.add_argument('--baseline', help='compare against results from --json')
+        ap.add_argument('--verbose', action='store_true')
+        args = ap.parse_args()
+
+        logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+        if args.replay:
+                traffic = recorded(args.replay, args.speed)
+                channels = sorted(set(t[1] for t in traffic))
+        else:
+                channels = ['#load%03d' % i for i in range(args.channels)]
+        conf = make_config(channels, args.config)
+        if not args.replay:
+                traffic = synthetic(channels, args.rate, args.duration,
+                                channel_commands(conf, channels), args.commands,
+                                args.meta, args.seed)
+        if not traffic:
+                sys.exit('No traffic to play')
+        if args.flood:
+                traffic = [(0.0, c, n, m) for _, c, n, m in traffic]
+
+        # The bot writes its database and crash logs to the working directory
+        cwd = os.getcwd()
+        sys.path.insert(0, ROOT)
+        os.chdir(tempfile.mkdtemp(prefix='loadtest-'))
+        offline_twitch(channels)
+
+        res = LoadTest(conf, traffic, args.moderator, args.unlimited).run(args.drain)
+        res['args'] = vars(args)
+        report(res)
+
+        if args.json:
+                with open(os.path.join(cwd, args.json), 'w') as f:
+                        json.dump(res, f, indent=1, sort_keys=True)
+        if args.baseline:
+                with open(os.path.join(cwd, args.baseline)) as f:
+                        regressions, lines = compare(res, json.load(f))
+                print()
+                print('%-14s %12s %12s' % ('', 'baseline', 'this run'))
+                for l in lines:
+                        print(l)
+                if regressions:
+                        sys.exit(1)
+
+if __name__ == '__main__':
+        main()
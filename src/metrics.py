@@ -0,0 +1,177 @@
+import threading, bisect, time, logging, os
+import http.server, socketserver
+
+# In-process metrics in the Prometheus text exposition format. Metrics are
+# created once at import time by the code they instrument; recording a value
+# is a dictionary lookup and a couple of additions under a lock.
+
+PREFIX = 'morbidbot_'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(names, values):
+        if not names:
+                return ''
+        return '{%s}' % ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\')
+                        .replace('"', '\\"').replace('\n', '\\n'))
+                        for n, v in zip(names, values))
+
+class Counter:
+        kind = 'counter'
+
+        def __init__(self, name, doc, labels=()):
+                self.name = PREFIX + name + '_total'
+                self.doc = doc
+                self.labels = tuple(labels)
+                self.lock = threading.Lock()
+                self.values = {} # label values -> count
+
+        def inc(self, *labels, n=1):
+                with self.lock:
+                        self.values[labels] = self.values.get(labels, 0) + n
+
+        def samples(self):
+                with self.lock:
+                        items = sorted(self.values.items())
+                for lv, v in items:
+                        yield self.name, format_labels(self.labels, lv), v
+
+class Histogram:
+        kind = 'histogram'
+
+        def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+                self.name = PREFIX + name
+                self.doc = doc
+                self.labels = tuple(labels)
+                self.buckets = tuple(buckets)
+                self.lock = threading.Lock()
+                self.values = {} # label values -> [bucket counts..., sum, count]
+
+        def observe(self, value, *labels):
+                i = bisect.bisect_left(self.buckets, value)
+                with self.lock:
+                        v = self.values.get(labels)
+                        if v is None:
+                                v = self.values[labels] = [0] * (len(self.buckets) + 2)
+                        if i < len(self.buckets):
+                                v[i] += 1
+                        v[-2] += value
+                        v[-1] += 1
+
+        def time(self, *labels):
+                return Timer(self, labels)
+
+        def samples(self):
+                with self.lock:
+                        items = sorted((lv, list(v)) for lv, v in self.values.items())
+                names = self.labels + ('le',)
+                for lv, v in items:
+                        cumulative = 0
+                        for b, n in zip(self.buckets, v):
+                                cumulative += n
+                                yield (self.name + '_bucket',
+                                                format_labels(names, lv + ('%g' % b,)), cumulative)
+                        yield (self.name + '_bucket',
+                                        format_labels(names, lv + ('+Inf',)), v[-1])
+                        yield self.name + '_sum', format_labels(self.labels, lv), v[-2]
+                        yield self.name + '_count', format_labels(self.labels, lv), v[-1]
+
+class Timer:
+        __slots__ = ('hist', 'labels', 'start')
+
+        def __init__(self, hist, labels):
+                self.hist = hist
+                self.labels = labels
+
+        def __enter__(self):
+                self.start = time.perf_counter()
+                return self
+
+        def __exit__(self, *exc):
+                self.hist.observe(time.perf_counter() - self.start, *self.labels)
+
+# Values read when the endpoint is scraped, for things that already keep
+# their own statistics. fn returns {label values: value}.
+class Gauge:
+        kind = 'gauge'
+
+        def __init__(self, name, doc, labels, fn):
+                self.name = PREFIX + name
+                self.doc = doc
+                self.labels = tuple(labels)
+                self.fn = fn
+
+        def samples(self):
+                for lv, v in sorted(self.fn().items()):
+                        yield self.name, format_labels(self.labels, lv), v
+
+class Registry:
+        def __init__(self):
+                self.lock = threading.Lock()
+                self.metrics = []
+
+        def add(self, metric):
+                with self.lock:
+                        self.metrics.append(metric)
+                return metric
+
+        def render(self):
+                with self.lock:
+                        metrics = list(self.metrics)
+                out = []
+                for m in metrics:
+                        out.append('# HELP %s %s' % (m.name, m.doc))
+                        out.append('# TYPE %s %s' % (m.name, m.kind))
+                        try:
+                                for name, labels, value in m.samples():
+                                        out.append('%s%s %s' % (name, labels, repr(float(value))))
+                        except Exception:
+                                logging.exception("Unable to collect metric %s", m.name)
+                return '\n'.join(out) + '\n'
+
+registry = Registry()
+
+def counter(name, doc, labels=()):
+        return registry.add(Counter(name, doc, labels))
+
+def histogram(name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        return registry.add(Histogram(name, doc, labels, buckets))
+
+def gauge(name, doc, labels, fn):
+        return registry.add(Gauge(name, doc, labels, fn))
+
+class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+                pass
+
+class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+def serve(listen):
+        # listen is host:port, or a filesystem path for a Unix socket
+        if listen.startswith('/') or listen.startswith('.'):
+                if os.path.exists(listen):
+                        os.unlink(listen)
+                server = UnixServer(listen, Handler)
+        else:
+                host, port = listen.rsplit(':', 1)
+                server = HTTPServer((host, int(port)), Handler)
+        t = threading.Thread(target=server.serve_forever, name='metrics')
+        t.daemon = True
+        t.start()
+        logging.info("Serving metrics on %s", listen)
+        return server
@@ -1,4 +1,10 @@
+from .. import outgoing, routing
+
+# Modules declare __slots__ for their own state too, so a channel's
+# instances stay small however many channels there are
 class CommandModule:
+        __slots__ = ('name', 'conf', 'chan', 'conn', 'bus', '__weakref__')
+
         def __init__(self, name, bus, conn, chan, conf):
                 self.name = name
                 self.conf = conf
@@ -6,30 +12,31 @@ class CommandModule:
                 self.conn = conn
                 self.bus = bus
 
-        def send(self, msg):
-                self.conn.privmsg(self.chan, msg)
+        def send(self, msg, priority=outgoing.PRIO_NORMAL, key=None):
+                self.conn.privmsg(self.chan, msg, priority, key)
 
         def error(self, msg):
-                self.status('error: {}'.format(msg))
+                self.status('error: {}'.format(msg), outgoing.PRIO_HIGH)
 
-        def status(self, msg):
-                self.send('[{}] {}'.format(self.name, msg))
+        def status(self, msg, priority=outgoing.PRIO_NORMAL):
+                self.send('[{}] {}'.format(self.name, msg), priority)
         
         def on_message(self, src, content):
-                content = content.strip()
-                words = content.split(' ')
-                if len(words) == 0:
+                cmd = routing.parse(content)
+                if cmd is None:
                         return
+                handler = routing.class_commands(type(self)).get(cmd.name)
+                if handler is not None:
+                        handler(self, src, cmd.args, cmd.content, src)
+        
+        def snapshot(self):
+                # State handed to the replacement instance on a hot reload.
+                # Anything returned here belongs to the new instance from then on.
+                return {}
 
-                cmd = words[0]
-                if cmd[0] != '!':
-                        return
-                cmd = words[0][1:]
+        def restore(self, state):
+                pass
 
-                if hasattr(self, 'cmd_'+cmd):
-                        getattr(self, 'cmd_'+cmd)(src, words[1:],
-                                        content[len(words[0]):].strip(), src)
-        
         def post(self, msg, *args, **kwargs):
                 self.bus.post(self, msg, args, kwargs)
 
@@ -1,48 +1,15 @@
-import requests, os, os.path
+import time
 
-from .. import modules
+from .. import modules, twitch, outgoing, storage, announce
 
 CONFIG_PREFIX = "death"
-TWITCH_API = 'https://api.twitch.tv/kraken/'
 AVERAGE_DEATHS = 731
-
-def print_num(n):
-        places = ['thousand', 'million', 'billion', 'trillion', 'quadrillion']
-        if n == 0:
-                return 'zero'
-        elif n < 100:
-                digits = ['one','two','three','four','five','six','seven',
-                                'eight','nine','ten','eleven','twelve',
-                                'thirteen','fourteen','fifteen','sixteen',
-                                'seventeen','eighteen','nineteen']
-                tens = ['twenty','thirty','forty','fifty','sixty','seventy',
-                                'eighty','ninety']
-                if n <= len(digits):
-                        return digits[n-1]
-                else:
-                        tens = tens[(n // 10)-2]
-                        if n % 10 == 0:
-                                return tens
-                        ones = digits[n % 10 - 1]
-                        return tens + ' ' + ones
-        elif n < 1000:
-                hundreds = print_num(n // 100)
-                parts = [hundreds, 'hundred']
-                if (n % 100) != 0:
-                        parts.append(print_num(n % 100))
-                return ' '.join(parts)
-        else:
-                parts = []
-                idx = 0
-                while(n > 0):
-                        if(idx > 0):
-                                parts.append(places[idx-1])
-                        parts.append(print_num(n % 1000))
-                        n //= 1000
-                        idx += 1
-                return ' '.join(parts[::-1])
+SESSION_GAP = 4 * 3600 # offline gap that starts a new session
 
 class ModuleMain(modules.CommandModule):
+        __slots__ = ('admins', 'happy', 'template', 'deaths', 'enabled', 'store',
+                        'last_game', 'rip_enabled', 'session')
+
         def __init__(self, bus, conn, chan, conf):
                 modules.CommandModule.__init__(self, 'deathcounter', bus, conn, chan, conf)
 
@@ -51,26 +18,43 @@ class ModuleMain(modules.CommandModule):
                         self.happy = (self.conf['happy'].lower() == 'true')
                 else:
                         self.happy = False
+                spaced = self.conf.get('spaced_text', 'false').lower() == 'true'
+                self.template = announce.template(spaced, self.happy)
 
                 self.deaths = 0
                 self.enabled = False
+                self.store = storage.shared()
                 self.last_game = None
                 self.rip_enabled = True
+                sess = self.store.session(self.chan)
+                self.session = sess.id if sess else None
 
                 # Find the game being played
                 try:
                         game = self.get_game()
                         self.load_deaths(game)
+                except twitch.NotCached:
+                        pass # loaded on first use, once the cache has it
                 except IOError:
                         self.error('Unable to determine game. Death counter disabled.')
                         self.enabled = False
         
+        def snapshot(self):
+                return {
+                        'deaths': self.deaths,
+                        'enabled': self.enabled,
+                        'last_game': self.last_game,
+                        'rip_enabled': self.rip_enabled,
+                        'session': self.session,
+                }
+
+        def restore(self, state):
+                for k, v in state.items():
+                        setattr(self, k, v)
+
         def get_game(self):
-                hdrs = {'accept': 'application/vnd.twitchtv.v3+json'}
-                url = TWITCH_API+'channels/'+self.chan[1:]
-                r = requests.get(url, headers=hdrs)
-                r.raise_for_status()
-                return r.json()['game']
+                # Cached only; the refresher keeps it up to date
+                return twitch.channels.cached_game(self.chan)
         
         def update_game(self):
                 try:
@@ -86,43 +70,60 @@ class ModuleMain(modules.CommandModule):
         
         def load_deaths(self, game):
                 self.last_game = game
-
-                # Create user directory if it doesn't already exist
-                pth_game = game.replace('/', '\xff')
-                pth_chan = 'deaths_' + self.chan[1:]
-                if not os.path.exists(pth_chan):
-                        os.mkdir(pth_chan)
-                pth = os.path.join(pth_chan, pth_game)
+                if not game:
+                        # Twitch has no game for the channel; nothing to count against
+                        self.deaths = 0
+                        self.enabled = False
+                        self.status('No game set. Death counter disabled.', outgoing.PRIO_BULK)
+                        return
+                self.deaths = self.store.get(self.chan, game)
                 self.enabled = True
-
-                # Open the data file
-                try:
-                        with open(pth, 'r') as f:
-                                self.deaths = int(f.read())
-                except IOError as e:
-                        pass
-                except ValueError as e:
-                        pass
-                self.status('Death count for %s: %d' % (game, self.deaths))
+                self.status('Death count for %s: %d' % (game, self.deaths),
+                                outgoing.PRIO_BULK)
         
         def save_deaths(self):
-                pth_game = self.last_game.replace('/', '\xff')
-                pth_chan = 'deaths_' + self.chan[1:]
-                pth = os.path.join(pth_chan, pth_game)
-                with open(pth, 'w') as f:
-                        f.write(str(self.deaths))
+                # Written behind by the store; never blocks the chat thread
+                if not self.enabled:
+                        return
+                self.store.set(self.chan, self.last_game, self.deaths)
         
+        def current_session(self, now):
+                # Use the Twitch broadcast when we know it, otherwise start a
+                # new session after a long enough quiet period
+                stream = twitch.channels.stream(self.chan)
+                if stream is not None:
+                        return 'stream-%s' % stream['_id']
+                sess = self.store.session(self.chan)
+                if sess is None or now - sess.last > SESSION_GAP:
+                        return 'local-%d' % now
+                return sess.id
+
         def count_death(self):
-                self.deaths += 1
-                self.save_deaths()
+                now = time.time()
+                self.session = self.current_session(now)
+                self.deaths = self.store.record(self.chan, self.last_game,
+                                self.session, now)
                 return self.deaths
 
+        def average(self):
+                avg, chans = self.store.game_average(self.last_game)
+                if avg is None or chans < 2:
+                        return AVERAGE_DEATHS
+                return avg
+
         def busmsg_died(self):
                 self.count_one_death()
 
         def busmsg_monitor_stable(self, fps, fpsvar):
                 self.rip_enabled = False
 
+        def busmsg_monitor_slow(self, fps, source_fps):
+                # Detections lag and may be missed; let chat count deaths
+                self.rip_enabled = True
+
+        def busmsg_monitor_recovered(self, fps):
+                self.rip_enabled = False
+
         def busmsg_monitor_ending(self):
                 self.rip_enabled = True
 
@@ -131,17 +132,11 @@ class ModuleMain(modules.CommandModule):
                         return
                 if not self.enabled:
                         self.error('Death counter is currently disabled')
+                        return
 
                 n = self.count_death()
-                if self.conf['spaced_text'].lower() == 'true':
-                        disp = print_num(n).upper().replace(' ','')
-                        if self.happy:
-                            final = ' '.join(disp + 'HAPPYLITTLEACCIDENTS')
-                        else:
-                            final = ' '.join(disp + 'BOYS')
-                else:
-                        final = str(self.deaths)
-                self.send(final)
+                # A newer count supersedes one still waiting to be sent
+                self.send(self.template.render(n), key='count')
         
         def cmd_death(self, src, args, content, user):
                 if(len(args) == 0):
@@ -151,6 +146,9 @@ class ModuleMain(modules.CommandModule):
                         self.send("Error: !death requires module admin access")
                         return
                 if(args[0] == 'set' and len(args) == 2):
+                        if not self.enabled:
+                                self.error('Death counter is currently disabled')
+                                return
                         try:
                                 self.deaths = int(args[1])
                         except ValueError as e:
@@ -162,6 +160,7 @@ class ModuleMain(modules.CommandModule):
                         self.load_deaths(self.get_game())
                 elif args[0] == 'save':
                         self.save_deaths()
+                        self.store.flush()
                 else:
                         self.send("Error: Unknown subcommand '%s'" % args[0])
                         return
@@ -177,9 +176,40 @@ class ModuleMain(modules.CommandModule):
                         return
                 if not self.enabled:
                         self.error('Death counter is currently disabled')
+                        return
 
-                pct_avg = "{:.3f}% of average".format(100*(self.deaths / AVERAGE_DEATHS))
+                pct_avg = "{:.3f}% of average".format(100*(self.deaths / self.average()))
                 if self.happy:
-                    self.send("%s has had %d happy little accidents (%s)" % (self.chan, self.deaths, pct_avg)) 
+                    self.send("%s has had %d happy little accidents (%s)" % (self.chan, self.deaths, pct_avg), key='deaths')
                 else:
-                    self.send("%s has died %d times (%s)" % (self.chan, self.deaths, pct_avg)) 
+                    self.send("%s has died %d times (%s)" % (self.chan, self.deaths, pct_avg), key='deaths')
+
+        def session_stats(self):
+                sess = self.store.session(self.chan)
+                if sess is None or sess.id != self.current_session(time.time()):
+                        return None
+                return sess
+
+        def cmd_streamdeaths(self, src, args, content, user):
+                sess = self.session_stats()
+                n = sess.count if sess else 0
+                self.send("%s has died %d times this stream" % (self.chan, n),
+                                key='streamdeaths')
+
+        def cmd_deathrate(self, src, args, content, user):
+                now = time.time()
+                sess = self.session_stats()
+                rate = sess.rate(now) if sess else 0.0
+                hour = self.store.recent_deaths(self.chan, now)
+                self.send("%s is dying %.1f times per hour this stream (%d in the last hour)"
+                                % (self.chan, rate, hour), key='deathrate')
+
+        def cmd_avgdeaths(self, src, args, content, user):
+                if not self.update_game():
+                        return
+                avg, chans = self.store.game_average(self.last_game)
+                if avg is None:
+                        self.send("No deaths recorded for %s yet" % self.last_game)
+                        return
+                self.send("Average deaths in %s: %.1f across %d channels"
+                                % (self.last_game, avg, chans), key='avgdeaths')
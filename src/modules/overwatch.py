@@ -1,75 +1,127 @@
-import subprocess, requests, threading, re, logging, time
+import logging, time
 
-from .. import modules
+from .. import modules, twitch, outgoing, supervisor, dispatch, events, rolling
 
 CONFIG_PREFIX = "overwatch"
-TWITCH_API = 'https://api.twitch.tv/kraken/'
 CMD_TEMPLATE = ['livestreamer', '-nv', '--player-passthrough', 'rtmp',\
-                '--player', '{exec}', '{stream}', 'best']
-NOTIFY_TAG = "[sentinel] "
-FPS_LINE_RE = re.compile('run fps=([0-9.]+)')
+                '--player', '{exec}', '{stream}', '{quality}']
 VARIANCE_THRESHOLD = 2
+FPS_WINDOW = 30 # reports averaged before announcing a stable rate
+HEALTH_WINDOW = 10 # reports averaged when checking for slowdowns
+SLOW_RATIO = 0.95 # share of the source rate below which we fall behind live
+RECOVER_RATIO = 0.99
 VAS_PREFIX = "Video analysis subsystem "
 
 time_delay = 1.5
 
-# Reader process to translate subprocess events into msgbus calls
-def subproc_reader(proc, mbus):
-        fpsen = []
-        while True:
-                line = proc.stdout.readline()
-                if line == '':
-                        break
-                line = line.strip()
-                if not line.startswith(NOTIFY_TAG):
-                        continue
-                line = line[len(NOTIFY_TAG):]
-                if line == 'system starting':
-                        mbus.post(None, 'monitor_starting', [], {})
-                        continue
-                m = FPS_LINE_RE.match(line)
-                if m:
-                        if fpsen is None:
-                                continue
-                        fpsen.append(float(m.group(1)))
-                        fpsen = fpsen[-30:]
-                        if len(fpsen) < 30:
-                                continue
-                        mean = sum(fpsen)/len(fpsen)
-                        variance = sum(map(lambda x: (x-mean)**2, fpsen))/len(fpsen)
-                        mbus.post(None, 'monitor_stable', (mean, variance), {})
-                        fpsen = None
-                        continue
-                if line == 'died':
-                        time.sleep(time_delay)
-                        mbus.post(None, 'died', [], {})
-                        continue
-                logging.warning("Unknown procline: '%s'" % line)
-        mbus.post(None, 'monitor_ending', [], {})
+# Translates analyser events into msgbus calls, and keeps an eye on the
+# analyser's speed for as long as it runs
+class StreamReader:
+        __slots__ = ('mbus', 'fps', 'recent', 'frame_ms', 'stable', 'slow')
+
+        def __init__(self, mbus):
+                self.mbus = mbus
+                self.fps = rolling.RollingStats(FPS_WINDOW)
+                self.recent = rolling.RollingStats(HEALTH_WINDOW)
+                self.frame_ms = rolling.Histogram()
+                self.stable = False
+                self.slow = False
+
+        def handle(self, line):
+                # Only livestreamer's own chatter arrives as text now
+                logging.debug("Analyser output: %s", line.rstrip())
+
+        def handle_event(self, ev):
+                if ev.type == events.DIED:
+                        # Announce time_delay after the detection itself,
+                        # however long the event took to reach us
+                        delay = max(0.0, ev.time + time_delay - time.time())
+                        dispatch.timers.call_later(delay, self.mbus.post,
+                                        None, 'died', [], {})
+                elif ev.type == events.STATS:
+                        fps, behind, decode_ms, match_ms, source_fps = ev.data
+                        self.note_fps(fps, source_fps)
+                elif ev.type == events.STARTING:
+                        self.mbus.post(None, 'monitor_starting', [], {})
+
+        def note_fps(self, fps, source_fps):
+                if fps <= 0:
+                        return
+                self.fps.add(fps)
+                self.recent.add(fps)
+                # Each report covers the same number of source frames, so
+                # this is the mean frame time over that stretch
+                self.frame_ms.add(1000.0 / fps)
+
+                if not self.stable and self.fps.full():
+                        self.stable = True
+                        self.mbus.post(None, 'monitor_stable',
+                                        (self.fps.mean, self.fps.variance()), {})
+                if not self.recent.full():
+                        return
+                mean = self.recent.mean
+                if not self.slow and mean < source_fps * SLOW_RATIO:
+                        self.slow = True
+                        self.mbus.post(None, 'monitor_slow', (mean, source_fps), {})
+                elif self.slow and mean >= source_fps * RECOVER_RATIO:
+                        self.slow = False
+                        self.mbus.post(None, 'monitor_recovered', (mean,), {})
+
+        def finish(self):
+                self.mbus.post(None, 'monitor_ending', [], {})
 
 class ModuleMain(modules.CommandModule):
+        __slots__ = ('analyser', 'reader', 'stream', 'exec_cwd', 'admins',
+                        'executable', 'game', 'quality', 'source')
+
         def __init__(self, bus, conn, chan, conf):
                 modules.CommandModule.__init__(self, 'overwatch', bus, conn, chan, conf)
 
-                self.process = None
-                self.monitor = None
+                self.analyser = None
+                self.reader = None
+                self.stream = None # key of the shared pipeline we're watching
 
                 self.exec_cwd = self.conf['cwd']
                 self.admins = self.conf['admins'].split(',')
                 self.executable = self.conf['command']
                 self.game = self.conf['game']
+                # A lower quality stream is decoded at lower resolution; pair
+                # it with --ref-height in the command so the template still fits
+                self.quality = self.conf.get('quality', 'best')
+                # Co-streams and rebroadcasts name the channel (or URL) whose
+                # video they carry, and share its analyser
+                self.source = self.conf.get('source')
+
+        def snapshot(self):
+                # The running analyser carries on under the new instance
+                return {'analyser': self.analyser, 'reader': self.reader,
+                                'stream': self.stream}
+
+        def restore(self, state):
+                self.analyser = state['analyser']
+                self.reader = state['reader']
+                self.stream = state['stream']
+
+        def shutdown(self):
+                # Unloaded, parted or disconnected; the analyser goes with us
+                self.proc_terminate()
 
         def get_game(self):
-                hdrs = {'accept': 'application/vnd.twitchtv.v3+json'}
-                url = TWITCH_API+'channels/'+self.chan[1:]
-                r = requests.get(url, headers=hdrs)
-                r.raise_for_status()
-                return r.json()['game']
+                try:
+                        return twitch.channels.cached_game(self.chan)
+                except twitch.NotCached:
+                        return None
+
+        def source_url(self):
+                src = self.source or self.chan
+                if '/' in src:
+                        return src
+                return 'http://twitch.tv/{}'.format(src.lstrip('#').lower())
 
         def should_enable(self):
                 g = self.get_game()
                 logging.debug("Checking game: '{}' vs '{}'".format(g, self.game))
-                return g.lower() == self.game.lower()
+                return (g or '').lower() == self.game.lower()
 
         def cmd_vproc(self, src, args, content, user):
                 if user not in self.admins:
@@ -77,14 +129,35 @@ class ModuleMain(modules.CommandModule):
                 cmd = args[0]
                 args = args[1:]
                 if cmd == 'start':
-                        self.proc_begin('http://twitch.tv/{}'.format(self.chan[1:]))
+                        self.proc_begin(self.source_url())
                 elif cmd == 'stop':
                         self.proc_terminate()
                 elif cmd == 'status':
-                        if self.process:
-                                self.status('Video processing is online')
+                        if self.analyser:
+                                a = self.analyser
+                                self.status('Video processing is online ({:.2f} FPS, {:.1f}s behind live, '
+                                                'decode {:.1f}ms, match {:.1f}ms)'.format(a.fps, a.lag(),
+                                                a.decode_ms, a.match_ms))
                         else:
                                 self.status('Video processing is offline')
+                elif cmd == 'health':
+                        r = self.reader
+                        if r is None or r.fps.count == 0:
+                                self.status('No analyser statistics yet')
+                        else:
+                                self.status('{:.2f} FPS now, {:.2f} this session ({:.2f}-{:.2f}); '
+                                                'frame time p50 {:.1f}ms p99 {:.1f}ms; {}'.format(
+                                                r.recent.mean, r.fps.session_mean(), r.fps.min,
+                                                r.fps.max, r.frame_ms.percentile(50),
+                                                r.frame_ms.percentile(99),
+                                                'behind live' if r.slow else 'keeping up'))
+                elif cmd == 'streams':
+                        st = supervisor.analysers.stats()
+                        subs = supervisor.streams.stats()
+                        parts = ['{} {:.1f}fps/{:.0f}s x{}'.format(k, v['fps'], v['lag'],
+                                        len(subs.get(k, ()))) for k, v in sorted(st.items())]
+                        self.status('{}/{} analysers: {}'.format(len(st),
+                                supervisor.analysers.max_streams, ', '.join(parts) or 'none'))
                 elif cmd == 'delay':
                         if len(args) != 1:
                                 self.status("Usage: vproc delay [seconds]")
@@ -102,43 +175,62 @@ class ModuleMain(modules.CommandModule):
 
         def cmd_bigbro(self, src, args, content, user):
                 should = self.should_enable()
-                if self.process and not should:
+                if self.analyser and not should:
                         self.proc_terminate()
-                elif not self.process and should:
-                        self.proc_begin('http://twitch.tv/{}'.format(self.chan[1:]))
+                elif not self.analyser and should:
+                        self.proc_begin(self.source_url())
 
         def busmsg_monitor_starting(self):
-                self.status(VAS_PREFIX+"initializing")
+                self.status(VAS_PREFIX+"initializing", outgoing.PRIO_BULK)
 
         def busmsg_monitor_stable(self, fps, fpsvar):
                 TPL = "stable at {:.2f} FPS (variance {:.2f})"
-                self.status(VAS_PREFIX + TPL.format(fps, fpsvar))
+                self.status(VAS_PREFIX + TPL.format(fps, fpsvar), outgoing.PRIO_BULK)
+
+        def busmsg_monitor_slow(self, fps, source_fps):
+                TPL = "falling behind live ({:.2f} of {:.0f} FPS)"
+                self.status(VAS_PREFIX + TPL.format(fps, source_fps), outgoing.PRIO_BULK)
+
+        def busmsg_monitor_recovered(self, fps):
+                TPL = "back to real time ({:.2f} FPS)"
+                self.status(VAS_PREFIX + TPL.format(fps), outgoing.PRIO_BULK)
 
         def busmsg_monitor_ending(self):
-                self.process = None
-                self.status(VAS_PREFIX+"shut down")
+                self.analyser = None
+                self.reader = None
+                self.status(VAS_PREFIX+"shut down", outgoing.PRIO_BULK)
 
         def proc_terminate(self):
-                if not self.process:
+                # Leaves the shared pipeline, which stops once nobody watches it
+                if not self.analyser:
                         return
-                self.process.terminate()
-                self.process.wait()
-                self.process = None
-                self.monitor.join()
+                supervisor.streams.unsubscribe(self.stream, self.chan)
+                self.analyser = None
+                self.reader = None
+                self.stream = None
 
         def proc_begin(self, strm):
-                if self.process:
+                if self.analyser:
                         return
 
                 # Generate argument list
                 kwdict = {}
                 kwdict['exec'] = self.executable
                 kwdict['stream'] = strm
+                kwdict['quality'] = self.quality
 
                 args = list(map(lambda x: x.format(**kwdict), CMD_TEMPLATE))
-                self.process = subprocess.Popen(args, cwd=self.exec_cwd,
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                universal_newlines=True)
-                self.monitor = threading.Thread(target=subproc_reader,
-                                args=(self.process,self.bus))
-                self.monitor.start()
+                key = supervisor.source_key(strm, self.quality)
+                reader = StreamReader(self.bus)
+                try:
+                        stream, shared = supervisor.streams.subscribe(key, self.chan,
+                                        args, self.exec_cwd, reader)
+                except supervisor.Refused as e:
+                        self.error('Video processing unavailable: {}'.format(e))
+                        return
+                self.analyser = stream.analyser
+                self.reader = reader
+                self.stream = key
+                if shared:
+                        self.status(VAS_PREFIX + "sharing the running analysis of " + key,
+                                        outgoing.PRIO_BULK)
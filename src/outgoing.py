@@ -0,0 +1,220 @@
+import threading, collections, time, logging
+
+from . import metrics
+
+# Message priorities, lowest value is sent first
+PRIO_HIGH = 0    # metacommand and error replies
+PRIO_NORMAL = 1  # command replies
+PRIO_BULK = 2    # announcements
+PRIORITIES = (PRIO_HIGH, PRIO_NORMAL, PRIO_BULK)
+
+# Twitch allows 20 messages per 30 seconds, or 100 in channels where the bot
+# is a moderator. Leave one message of headroom in each.
+RATE_WINDOW = 30
+NORMAL_LIMIT = 19
+MOD_LIMIT = 99
+BURST_FRACTION = 0.25
+
+# Messages older than this are dropped rather than sent late
+MAX_AGE = {PRIO_HIGH: 120, PRIO_NORMAL: 45, PRIO_BULK: 20}
+MAX_PENDING = 32 # per channel
+
+SEND_WAIT = metrics.histogram('send_wait_seconds',
+                'Time chat messages wait in the send queue', ('priority',))
+MERGED = metrics.counter('send_merged', 'Messages merged into one already queued')
+DROPPED = metrics.counter('send_dropped', 'Messages dropped before sending',
+                ('reason',))
+
+# Token bucket sized so that no RATE_WINDOW ever exceeds the limit: the burst
+# plus everything refilled within one window adds up to exactly `limit`. A
+# limit of one leaves nothing to refill from, so it gets one per window.
+class TokenBucket:
+        def __init__(self, limit, window=RATE_WINDOW, burst=BURST_FRACTION):
+                if limit > 1:
+                        self.capacity = min(max(1, int(limit * burst)), limit - 1)
+                        self.rate = (limit - self.capacity) / window
+                else:
+                        self.capacity = 1
+                        self.rate = 1 / window
+                self.tokens = self.capacity
+                self.last = time.time()
+
+        def refill(self, now):
+                self.tokens = min(self.capacity,
+                                self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+        def delay(self, now):
+                self.refill(now)
+                if self.tokens >= 1:
+                        return 0
+                return (1 - self.tokens) / self.rate
+
+        def take(self):
+                self.tokens -= 1
+
+class Message:
+        __slots__ = ('chan', 'text', 'priority', 'key', 'queued')
+
+        def __init__(self, chan, text, priority, key):
+                self.chan = chan
+                self.text = text
+                self.priority = priority
+                self.key = key
+                self.queued = time.time()
+
+# Rate-limited send scheduler. Every outgoing chat line goes through here.
+# Pending messages are kept per priority and per channel; channels with
+# pending messages are served round-robin within a priority level.
+class OutgoingQueue(threading.Thread):
+        def __init__(self, sink, normal_limit=NORMAL_LIMIT, mod_limit=MOD_LIMIT):
+                threading.Thread.__init__(self, name='outgoing')
+                self.daemon = True
+
+                self.sink = sink
+                self.cond = threading.Condition()
+
+                # priority -> OrderedDict(chan -> deque of Message)
+                self.pending = dict((p, collections.OrderedDict())
+                                for p in PRIORITIES)
+                self.counts = collections.Counter() # chan -> pending count
+                self.moderated = set() # channels where the bot is a moderator
+
+                # Every message costs a moderator-rate token; messages to
+                # channels where we aren't a moderator also cost a normal one.
+                self.mod_bucket = TokenBucket(mod_limit)
+                self.normal_bucket = TokenBucket(normal_limit)
+
+                # Statistics
+                self.sent = 0
+                self.merged = 0
+                self.dropped_stale = 0
+                self.dropped_full = 0
+                self.wait_total = collections.Counter()
+                self.wait_max = collections.Counter()
+                self.sent_prio = collections.Counter()
+
+        def set_moderator(self, chan, is_mod):
+                with self.cond:
+                        if is_mod:
+                                self.moderated.add(chan)
+                        else:
+                                self.moderated.discard(chan)
+
+        def privmsg(self, chan, msg, priority=PRIO_NORMAL, key=None):
+                with self.cond:
+                        chans = self.pending[priority]
+
+                        # Merge with an identical or superseded message
+                        for m in chans.get(chan, ()):
+                                if m.text == msg or (key is not None
+                                                and m.key == key):
+                                        m.text = msg
+                                        self.merged += 1
+                                        MERGED.inc()
+                                        return
+
+                        if self.counts[chan] >= MAX_PENDING and not self.shed(chan):
+                                self.dropped_full += 1
+                                DROPPED.inc('full')
+                                return
+                        if chan not in chans:
+                                chans[chan] = collections.deque()
+                        chans[chan].append(Message(chan, msg, priority, key))
+                        self.counts[chan] += 1
+                        self.cond.notify()
+
+        def shed(self, chan):
+                # Make room by dropping the oldest bulk message for the channel
+                q = self.pending[PRIO_BULK].get(chan)
+                if not q:
+                        return False
+                q.popleft()
+                if not q:
+                        del self.pending[PRIO_BULK][chan]
+                self.counts[chan] -= 1
+                self.dropped_full += 1
+                DROPPED.inc('full')
+                return True
+
+        def peek(self, now):
+                # Returns the next message to send, discarding expired ones
+                for p in PRIORITIES:
+                        chans = self.pending[p]
+                        while chans:
+                                chan, q = next(iter(chans.items()))
+                                m = q[0]
+                                if now - m.queued <= MAX_AGE[p]:
+                                        return m
+                                self.pop(m)
+                                self.dropped_stale += 1
+                                DROPPED.inc('stale')
+                return None
+
+        def pop(self, m):
+                chans = self.pending[m.priority]
+                q = chans[m.chan]
+                q.popleft()
+                if q:
+                        chans.move_to_end(m.chan)
+                else:
+                        del chans[m.chan]
+                self.counts[m.chan] -= 1
+                if self.counts[m.chan] <= 0:
+                        del self.counts[m.chan]
+
+        def delay(self, m, now):
+                d = self.mod_bucket.delay(now)
+                if m.chan not in self.moderated:
+                        d = max(d, self.normal_bucket.delay(now))
+                return d
+
+        def run(self):
+                while True:
+                        with self.cond:
+                                while True:
+                                        now = time.time()
+                                        m = self.peek(now)
+                                        if m is None:
+                                                self.cond.wait()
+                                                continue
+                                        d = self.delay(m, now)
+                                        if d <= 0:
+                                                break
+                                        # Re-evaluate after waiting, in case
+                                        # something more urgent shows up
+                                        self.cond.wait(d)
+
+                                self.pop(m)
+                                self.mod_bucket.take()
+                                if m.chan not in self.moderated:
+                                        self.normal_bucket.take()
+
+                                wait = now - m.queued
+                                SEND_WAIT.observe(wait, m.priority)
+                                self.sent += 1
+                                self.sent_prio[m.priority] += 1
+                                self.wait_total[m.priority] += wait
+                                self.wait_max[m.priority] = max(
+                                                self.wait_max[m.priority], wait)
+
+                        try:
+                                self.sink.privmsg(m.chan, m.text)
+                        except Exception:
+                                logging.exception("Failed to send message to %s",
+                                                m.chan)
+
+        def stats(self):
+                with self.cond:
+                        wait = {}
+                        for p in PRIORITIES:
+                                n = max(self.sent_prio[p], 1)
+                                wait[p] = (self.wait_total[p] / n, self.wait_max[p])
+                        return {
+                                'pending': sum(self.counts.values()),
+                                'sent': self.sent,
+                                'merged': self.merged,
+                                'dropped_stale': self.dropped_stale,
+                                'dropped_full': self.dropped_full,
+                                'wait': wait,
+                        }
@@ -0,0 +1,68 @@
+import sys, threading, time, collections, os, os.path
+
+# Sampling profiler for the whole bot. Every interval it records the stack of
+# every other thread; the result is written in the folded format that
+# flamegraph.pl and speedscope read ("thread;outer;...;inner count").
+
+INTERVAL = 0.005
+MAX_SECONDS = 300
+PROFILE_DIR = 'profiles'
+
+def frame_name(frame):
+        code = frame.f_code
+        return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno)
+
+class Profiler(threading.Thread):
+        def __init__(self, seconds, on_done, interval=INTERVAL, outdir=PROFILE_DIR):
+                threading.Thread.__init__(self, name='profiler')
+                self.daemon = True
+
+                self.seconds = min(seconds, MAX_SECONDS)
+                self.on_done = on_done # called with (path, samples)
+                self.interval = interval
+                self.outdir = outdir
+                self.stacks = collections.Counter()
+                self.samples = 0
+
+        def sample(self):
+                names = dict((t.ident, t.name) for t in threading.enumerate())
+                me = threading.get_ident()
+                for ident, frame in sys._current_frames().items():
+                        if ident == me:
+                                continue
+                        stack = []
+                        while frame is not None:
+                                stack.append(frame_name(frame))
+                                frame = frame.f_back
+                        stack.append(names.get(ident, 'thread-%d' % ident))
+                        self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+        def run(self):
+                end = time.monotonic() + self.seconds
+                while time.monotonic() < end:
+                        self.sample()
+                        time.sleep(self.interval)
+
+                if not os.path.exists(self.outdir):
+                        os.mkdir(self.outdir)
+                path = os.path.join(self.outdir, 'profile-%s-%d.folded' % (
+                                time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+                with open(path, 'w') as f:
+                        for stack, n in self.stacks.most_common():
+                                f.write('%s %d\n' % (stack, n))
+                self.on_done(path, self.samples)
+
+_running = None
+_running_lock = threading.Lock()
+
+def start(seconds, on_done):
+        # Only one profile at a time; returns False if one is running
+        global _running
+        with _running_lock:
+                if _running is not None and _running.is_alive():
+                        return False
+                _running = Profiler(seconds, on_done)
+                _running.start()
+                return True
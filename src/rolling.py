@@ -0,0 +1,85 @@
+import math
+
+# Constant time statistics over the last `size` samples. Mean and variance
+# are kept with Welford's method, adjusted as samples leave the ring, so
+# nothing is ever recomputed from scratch. Session-wide totals are kept
+# alongside.
+class RollingStats:
+        __slots__ = ('size', 'ring', 'pos', 'n', 'mean', 'm2', 'count', 'total',
+                        'min', 'max')
+
+        def __init__(self, size):
+                self.size = size
+                self.ring = [0.0] * size
+                self.pos = 0
+                self.n = 0
+                self.mean = 0.0
+                self.m2 = 0.0
+
+                self.count = 0
+                self.total = 0.0
+                self.min = None
+                self.max = None
+
+        def add(self, x):
+                if self.n < self.size:
+                        self.n += 1
+                        delta = x - self.mean
+                        self.mean += delta / self.n
+                        self.m2 += delta * (x - self.mean)
+                else:
+                        old = self.ring[self.pos]
+                        mean = self.mean + (x - old) / self.n
+                        self.m2 += (x - old) * (x - mean + old - self.mean)
+                        self.mean = mean
+                self.ring[self.pos] = x
+                self.pos = (self.pos + 1) % self.size
+
+                self.count += 1
+                self.total += x
+                self.min = x if self.min is None else min(self.min, x)
+                self.max = x if self.max is None else max(self.max, x)
+
+        def full(self):
+                return self.n == self.size
+
+        def variance(self):
+                if self.n == 0:
+                        return 0.0
+                return max(self.m2, 0.0) / self.n
+
+        def session_mean(self):
+                return self.total / self.count if self.count else 0.0
+
+# Log-bucketed histogram for percentiles of positive values. Adding is a
+# single increment; a percentile walks the buckets, which only happens on
+# request. Values are accurate to within one bucket (RATIO).
+class Histogram:
+        __slots__ = ('buckets', 'count')
+        RATIO = 1.05
+        FLOOR = 0.1
+
+        def __init__(self):
+                self.buckets = {}
+                self.count = 0
+
+        def bucket(self, x):
+                if x <= self.FLOOR:
+                        return 0
+                return int(math.log(x / self.FLOOR, self.RATIO)) + 1
+
+        def add(self, x):
+                b = self.bucket(x)
+                self.buckets[b] = self.buckets.get(b, 0) + 1
+                self.count += 1
+
+        def percentile(self, p):
+                if self.count == 0:
+                        return 0.0
+                rank = p / 100 * self.count
+                seen = 0
+                for b in sorted(self.buckets):
+                        seen += self.buckets[b]
+                        if seen >= rank:
+                                return self.FLOOR * self.RATIO ** b
+                return self.FLOOR * self.RATIO ** max(self.buckets)
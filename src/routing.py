@@ -0,0 +1,68 @@
+import collections
+
+from . import modules
+
+Command = collections.namedtuple('Command', ['name', 'args', 'content'])
+
+def parse(content):
+        # Cheap rejection for the common case of ordinary chat
+        if content[:1] != '!':
+                content = content.lstrip()
+                if content[:1] != '!':
+                        return None
+        content = content.rstrip()
+        words = content.split(' ')
+        return Command(words[0][1:], words[1:], content[len(words[0]):].strip())
+
+_class_commands = {}
+
+def class_commands(cls):
+        # Maps command name to the unbound cmd_ function, computed once per class
+        cmds = _class_commands.get(cls)
+        if cmds is None:
+                cmds = {}
+                for attr in dir(cls):
+                        if attr.startswith('cmd_') and callable(getattr(cls, attr)):
+                                cmds[attr[4:]] = getattr(cls, attr)
+                _class_commands[cls] = cmds
+        return cmds
+
+def wants_all_messages(inst):
+        # Modules that override on_message see every line, not just commands
+        return type(inst).on_message is not modules.CommandModule.on_message
+
+# Per-channel routing table from command name to bound handlers. Tables are
+# rebuilt when modules are added or removed and swapped in whole, so readers
+# never see a partially updated table.
+class CommandTable:
+        def __init__(self, instances=None):
+                self.instances = collections.OrderedDict(instances or {})
+                self.routes = {}
+                self.passive = ()
+                self.rebuild()
+
+        def rebuild(self):
+                routes = {}
+                passive = []
+                for iname, inst in self.instances.items():
+                        if wants_all_messages(inst):
+                                passive.append((iname, inst))
+                                continue
+                        for name, fn in class_commands(type(inst)).items():
+                                routes.setdefault(name, []).append(
+                                                (iname, fn.__get__(inst)))
+                self.routes = dict((k, tuple(v)) for k, v in routes.items())
+                self.passive = tuple(passive)
+
+        def add(self, iname, inst):
+                instances = collections.OrderedDict(self.instances)
+                instances[iname] = inst
+                return CommandTable(instances)
+
+        def remove(self, iname):
+                instances = collections.OrderedDict(self.instances)
+                instances.pop(iname, None)
+                return CommandTable(instances)
+
+        def lookup(self, name):
+                return self.routes.get(name, ())
@@ -0,0 +1,290 @@
+import multiprocessing, multiprocessing.connection, threading, configparser
+import logging, math, os, time, itertools
+
+from . import supervisor
+
+# Twitch allows 20 JOINs per 10 seconds for an account, shared by all of its
+# connections. Each shard gets an equal part of that.
+JOIN_LIMIT = 20
+JOIN_WINDOW = 10
+CHANNELS_PER_SHARD = 100
+
+RESTART_DELAY = 5
+COLLECT_TIMEOUT = 5
+
+SHARD_MSG = ('[metacmd] shard %d: channels=%d connected=%s handled=%d '
+                'dropped=%d sent=%d pending=%d analysers=%d')
+TOTAL_MSG = ('[metacmd] %d/%d shards: channels=%d handled=%d dropped=%d '
+                'sent=%d pending=%d analysers=%d')
+
+def conf_dict(conf):
+        # Plain dict form of the config, to rebuild it in a shard process
+        return dict((s, dict(conf.items(s, raw=True))) for s in conf.sections())
+
+def split_channels(channels, shards):
+        # Round-robin over the sorted list keeps shard sizes within one
+        parts = [[] for i in range(shards)]
+        for i, c in enumerate(sorted(channels)):
+                parts[i % shards].append(c)
+        return parts
+
+def shard_count(conf, nchannels):
+        sconf = conf['Sharding']
+        n = sconf.get('shards', 'auto')
+        if n == 'auto':
+                n = os.cpu_count() or 1
+        else:
+                n = int(n)
+        per = sconf.getint('channels_per_shard', CHANNELS_PER_SHARD)
+        n = min(max(n, math.ceil(nchannels / per)), nchannels)
+        # Every shard needs a JOIN budget of at least two to pace itself
+        limit = sconf.getint('join_limit', JOIN_LIMIT)
+        return max(1, min(n, limit // 2))
+
+def shard_address(listen, index):
+        # Per-shard variant of a host:port or Unix socket path
+        if listen.startswith('/') or listen.startswith('.'):
+                return '%s.%d' % (listen, index)
+        host, port = listen.rsplit(':', 1)
+        return '%s:%d' % (host, int(port) + index)
+
+def sharded(conf):
+        return conf.has_section('Sharding') and shard_count(conf,
+                        len(channel_sections(conf))) > 1
+
+def channel_sections(conf):
+        return [s for s in conf.sections() if s[0] == '#']
+
+def run_shard(index, nshards, confd, channels, control):
+        # Entry point of a shard process: an ordinary Bot restricted to its
+        # part of the channel list, talking to the coordinator over control
+        from . import bot
+        conf = configparser.ConfigParser()
+        conf.read_dict(confd)
+        b = bot.Bot(conf, channels=channels,
+                        link=ShardLink(index, nshards, control))
+        b.start()
+
+# Shard side of the control pipe. Requests from the coordinator are handled
+# on a reader thread; sends may come from any thread.
+class ShardLink:
+        def __init__(self, index, nshards, pipe):
+                self.index = index
+                self.nshards = nshards
+                self.pipe = pipe
+                self.lock = threading.Lock()
+                self.bot = None
+
+        def attach(self, bot):
+                self.bot = bot
+                t = threading.Thread(target=self.run, name='shard-control')
+                t.daemon = True
+                t.start()
+
+        def send(self, *msg):
+                with self.lock:
+                        self.pipe.send(msg)
+
+        def forward(self, origin, target, src, content):
+                self.send('forward', origin, target, src, content)
+
+        def collect(self, origin):
+                self.send('collect', origin)
+
+        def joined(self, chan):
+                self.send('joined', chan)
+
+        def parted(self, chan):
+                self.send('parted', chan)
+
+        def run(self):
+                while True:
+                        try:
+                                msg = self.pipe.recv()
+                        except EOFError:
+                                logging.warning("Lost the coordinator, shutting down shard")
+                                os._exit(1)
+                        kind = msg[0]
+                        if kind == 'meta':
+                                # Run where the target channel's own commands run
+                                _, reqid, target, src, content = msg
+                                self.bot.dispatcher.submit_control(target, self.run_meta,
+                                                reqid, target, src, content)
+                        elif kind == 'metrics':
+                                self.send('metrics', msg[1], self.index,
+                                                self.bot.metrics())
+                        elif kind == 'reply':
+                                _, origin, lines = msg
+                                for line in lines:
+                                        self.bot.meta_reply(origin, line)
+
+        def run_meta(self, reqid, target, src, content):
+                lines = []
+                self.bot.process_metacommand(target, src, content, lines.append)
+                self.send('done', reqid, lines)
+
+# Runs the bot as several shard processes, each with its own connection and
+# module set for a slice of the channels. The coordinator routes metacommands
+# aimed at channels on another shard, combines metrics, and restarts shards
+# that die.
+class Coordinator:
+        def __init__(self, conf):
+                self.conf = conf
+                channels = channel_sections(conf)
+                self.nshards = shard_count(conf, len(channels))
+                self.parts = split_channels(channels, self.nshards)
+                self.owner = {}
+                for i, part in enumerate(self.parts):
+                        for c in part:
+                                self.owner[c] = i
+
+                self.confd = conf_dict(conf)
+                sconf = conf['Sharding']
+                self.join_limit = sconf.getint('join_limit', JOIN_LIMIT)
+                self.join_window = sconf.getint('join_window', JOIN_WINDOW)
+
+                # Split account-wide and machine-wide limits between shards
+                self.confd['Connection']['join_limit'] = str(
+                                self.join_limit // self.nshards)
+                self.confd['Connection']['join_window'] = str(self.join_window)
+                sup = self.confd.setdefault('Supervisor', {})
+                total = int(sup.get('max_streams', supervisor.MAX_STREAMS))
+                sup['total_slots'] = str(max(total, 1))
+                # Exactly `total` between them, so the shards never run more
+                # analysers together than the machine-wide cap
+                self.streams = [total // self.nshards + (i < total % self.nshards)
+                                for i in range(self.nshards)]
+
+                self.procs = [None] * self.nshards
+                self.pipes = [None] * self.nshards
+                self.restart_at = {} # shard -> time it may be started again
+                self.pending = {} # request id -> [shard, origin, waiting, results, deadline]
+                self.reqids = itertools.count(1)
+
+        def spawn(self, i):
+                # Analysers of different shards get different CPU slots
+                confd = dict(self.confd)
+                confd['Supervisor'] = dict(confd['Supervisor'],
+                                max_streams=str(self.streams[i]),
+                                slot_offset=str(sum(self.streams[:i])))
+                ours, theirs = multiprocessing.Pipe()
+                p = multiprocessing.Process(target=run_shard, name='shard-%d' % i,
+                                args=(i, self.nshards, confd, self.parts[i], theirs))
+                p.start()
+                theirs.close()
+                self.procs[i] = p
+                self.pipes[i] = ours
+                logging.info("Started shard %d (pid %d) with %d channels", i,
+                                p.pid, len(self.parts[i]))
+
+        def start(self):
+                for i in range(self.nshards):
+                        self.spawn(i)
+                while True:
+                        ready = multiprocessing.connection.wait(
+                                        [p for p in self.pipes if p is not None] +
+                                        [p.sentinel for p in self.procs if p is not None], 1)
+                        for r in ready:
+                                if r in self.pipes:
+                                        self.receive(self.pipes.index(r))
+                        self.reap()
+                        self.expire()
+
+        def receive(self, i):
+                try:
+                        msg = self.pipes[i].recv()
+                except EOFError:
+                        self.pipes[i] = None
+                        return
+                kind = msg[0]
+                if kind == 'forward':
+                        _, origin, target, src, content = msg
+                        owner = self.owner.get(target)
+                        if owner is None or self.pipes[owner] is None:
+                                self.reply(i, origin, ['[metacmd] No shard serves %s' % target])
+                                return
+                        reqid = next(self.reqids)
+                        self.pending[reqid] = [i, origin, 1, [], time.time() + COLLECT_TIMEOUT]
+                        self.pipes[owner].send(('meta', reqid, target, src, content))
+                elif kind == 'joined':
+                        # Runtime joins and parts; a restarted shard rejoins
+                        # what it had
+                        chan = msg[1]
+                        self.owner[chan] = i
+                        if chan not in self.parts[i]:
+                                self.parts[i].append(chan)
+                elif kind == 'parted':
+                        chan = msg[1]
+                        if self.owner.get(chan) == i:
+                                del self.owner[chan]
+                        if chan in self.parts[i]:
+                                self.parts[i].remove(chan)
+                elif kind == 'collect':
+                        reqid = next(self.reqids)
+                        live = [j for j, p in enumerate(self.pipes) if p is not None]
+                        self.pending[reqid] = [i, msg[1], len(live), [],
+                                        time.time() + COLLECT_TIMEOUT]
+                        for j in live:
+                                self.pipes[j].send(('metrics', reqid))
+                elif kind == 'done':
+                        _, reqid, lines = msg
+                        req = self.pending.pop(reqid, None)
+                        if req is not None:
+                                self.reply(req[0], req[1], lines)
+                elif kind == 'metrics':
+                        _, reqid, index, metrics = msg
+                        req = self.pending.get(reqid)
+                        if req is None:
+                                return
+                        req[3].append((index, metrics))
+                        req[2] -= 1
+                        if req[2] <= 0:
+                                del self.pending[reqid]
+                                self.reply(req[0], req[1], self.summary(req[3]))
+
+        def reply(self, i, origin, lines):
+                if self.pipes[i] is not None:
+                        self.pipes[i].send(('reply', origin, lines))
+
+        def expire(self):
+                # Answer with whatever arrived from shards that stayed silent
+                now = time.time()
+                for reqid, req in list(self.pending.items()):
+                        if req[4] < now:
+                                del self.pending[reqid]
+                                self.reply(req[0], req[1], self.summary(req[3]) if req[3]
+                                                else ['[metacmd] Shard did not respond'])
+
+        def summary(self, results):
+                lines = []
+                tot = dict.fromkeys(('channels', 'handled', 'dropped', 'sent',
+                                'pending', 'analysers'), 0)
+                for index, m in sorted(results):
+                        lines.append(SHARD_MSG % (index, m['channels'], m['connected'],
+                                        m['handled'], m['dropped'], m['sent'],
+                                        m['pending'], m['analysers']))
+                        for k in tot:
+                                tot[k] += m[k]
+                lines.append(TOTAL_MSG % (len(results), self.nshards, tot['channels'],
+                                tot['handled'], tot['dropped'], tot['sent'],
+                                tot['pending'], tot['analysers']))
+                return lines
+
+        def reap(self):
+                now = time.time()
+                for i, p in enumerate(self.procs):
+                        if p is None:
+                                if self.restart_at.get(i, 0) <= now:
+                                        del self.restart_at[i]
+                                        self.spawn(i)
+                                continue
+                        if p.is_alive():
+                                continue
+                        p.join()
+                        logging.warning("Shard %d exited with %s, restarting in %ds",
+                                        i, p.exitcode, RESTART_DELAY)
+                        if self.pipes[i] is not None:
+                                self.pipes[i].close()
+                        self.pipes[i] = None
+                        self.procs[i] = None
+                        self.restart_at[i] = now + RESTART_DELAY
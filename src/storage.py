@@ -0,0 +1,341 @@
+import sqlite3, threading, collections, logging, time, os, os.path, sys
+
+DB_PATH = 'deaths.db'
+COMMIT_INTERVAL = 1.0
+REFRESH_INTERVAL = 60 # picking up counters other processes wrote
+RATE_WINDOW = 3600
+LEGACY_PREFIX = 'deaths_'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS deaths (
+        channel TEXT NOT NULL,
+        game TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (channel, game)
+);
+CREATE TABLE IF NOT EXISTS events (
+        channel TEXT NOT NULL,
+        game TEXT NOT NULL,
+        session TEXT NOT NULL,
+        ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_game ON events (channel, game, ts);
+CREATE INDEX IF NOT EXISTS events_by_session ON events (channel, session, ts);
+'''
+
+def connect(path):
+        db = sqlite3.connect(path)
+        # WAL keeps every commit atomic and lets readers run alongside the writer
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=FULL')
+        db.executescript(SCHEMA)
+        db.commit()
+        return db
+
+def check_key(chan, game):
+        # Rows the schema would reject are refused before they are queued,
+        # where the caller can still hear about it
+        if not (isinstance(chan, str) and chan and isinstance(game, str) and game):
+                raise ValueError('Bad death counter key %r' % ((chan, game),))
+
+class Session:
+        __slots__ = ('id', 'count', 'start', 'last')
+
+        def __init__(self, sid, count, start, last):
+                self.id = sid
+                self.count = count
+                self.start = start
+                self.last = last
+
+        def rate(self, now):
+                # Deaths per hour since the session started
+                hours = max(now - self.start, 60) / 3600
+                return self.count / hours
+
+# Death counters for every channel and game, held in memory and written behind
+# to a single SQLite file. Updates are coalesced per counter and committed in
+# one transaction per interval, so callers never wait on the disk.
+#
+# Every death is also kept as a timestamped event. The aggregates the chat
+# commands need (current session, deaths within the last hour, per-game
+# totals across channels) are maintained incrementally as deaths come in.
+class DeathStore(threading.Thread):
+        def __init__(self, path=DB_PATH, interval=COMMIT_INTERVAL):
+                threading.Thread.__init__(self, name='storage')
+                self.daemon = True
+
+                self.path = path
+                self.interval = interval
+                self.cond = threading.Condition()
+                self.pending = {} # (channel, game) -> count awaiting commit
+                self.pending_events = [] # (channel, game, session, ts)
+                self.flushed = 0 # generation numbers for flush()
+                self.written = 0
+
+                self.counts = {}
+                self.ours = set() # keys set here; the rest may be another process's
+                self.refreshed = time.time()
+                self.game_totals = {} # game -> [sum of counts, channels]
+                self.sessions = {} # channel -> latest Session
+                self.recent = {} # channel -> deque of timestamps in RATE_WINDOW
+                db = connect(path)
+                try:
+                        self.load(db)
+                finally:
+                        db.close()
+
+                # Statistics
+                self.commits = 0
+                self.rows = 0
+
+        def load(self, db):
+                for chan, game, count in db.execute(
+                                'SELECT channel, game, count FROM deaths'):
+                        self.update_count((chan, game), count)
+
+                for chan, sid, count, start, last in db.execute(
+                                'SELECT channel, session, COUNT(*), MIN(ts), MAX(ts) '
+                                'FROM events GROUP BY channel, session'):
+                        cur = self.sessions.get(chan)
+                        if cur is None or last > cur.last:
+                                self.sessions[chan] = Session(sid, count, start, last)
+
+                since = time.time() - RATE_WINDOW
+                for chan, ts in db.execute('SELECT channel, ts FROM events '
+                                'WHERE ts > ? ORDER BY ts', (since,)):
+                        self.recent.setdefault(chan, collections.deque()).append(ts)
+
+        def refresh(self, db):
+                # Shards share the database but each owns its channels. Their
+                # counters are read back now and then, so per-game averages
+                # cover every channel; our own are newer in memory.
+                rows = db.execute('SELECT channel, game, count FROM deaths').fetchall()
+                with self.cond:
+                        for chan, game, count in rows:
+                                if (chan, game) not in self.ours:
+                                        self.update_count((chan, game), count)
+                        self.refreshed = time.time()
+
+        def update_count(self, key, count):
+                old = self.counts.get(key, 0)
+                self.counts[key] = count
+                tot = self.game_totals.setdefault(key[1], [0, 0])
+                tot[0] += count - old
+                if old == 0 and count != 0:
+                        tot[1] += 1
+                elif old != 0 and count == 0:
+                        tot[1] -= 1
+
+        def get(self, chan, game):
+                with self.cond:
+                        return self.counts.get((chan, game), 0)
+
+        def set(self, chan, game, count):
+                check_key(chan, game)
+                with self.cond:
+                        self.ours.add((chan, game))
+                        self.update_count((chan, game), count)
+                        self.pending[(chan, game)] = count
+                        self.cond.notify()
+
+        def increment(self, chan, game, n=1):
+                check_key(chan, game)
+                with self.cond:
+                        count = self.counts.get((chan, game), 0) + n
+                        self.ours.add((chan, game))
+                        self.update_count((chan, game), count)
+                        self.pending[(chan, game)] = count
+                        self.cond.notify()
+                        return count
+
+        def record(self, chan, game, session, ts=None):
+                # Counts one death and keeps it in the history
+                check_key(chan, game)
+                if ts is None:
+                        ts = time.time()
+                with self.cond:
+                        sess = self.sessions.get(chan)
+                        if sess is None or sess.id != session:
+                                sess = self.sessions[chan] = Session(session, 0, ts, ts)
+                        sess.count += 1
+                        sess.last = ts
+
+                        recent = self.recent.setdefault(chan, collections.deque())
+                        recent.append(ts)
+                        self.trim(recent, ts)
+
+                        self.pending_events.append((chan, game, session, ts))
+                        return self.increment(chan, game)
+
+        def trim(self, recent, now):
+                while recent and recent[0] <= now - RATE_WINDOW:
+                        recent.popleft()
+
+        def session(self, chan):
+                with self.cond:
+                        return self.sessions.get(chan)
+
+        def recent_deaths(self, chan, now=None):
+                if now is None:
+                        now = time.time()
+                with self.cond:
+                        recent = self.recent.get(chan)
+                        if not recent:
+                                return 0
+                        self.trim(recent, now)
+                        return len(recent)
+
+        def game_average(self, game):
+                # Mean death count for a game over every channel that played it
+                with self.cond:
+                        tot = self.game_totals.get(game)
+                        if not tot or tot[1] == 0:
+                                return None, 0
+                        return tot[0] / tot[1], tot[1]
+
+        def flush(self, timeout=None):
+                # Blocks until everything set so far is on disk
+                with self.cond:
+                        self.flushed += 1
+                        target = self.flushed
+                        self.cond.notify_all()
+                        return self.cond.wait_for(lambda: self.written >= target,
+                                        timeout)
+
+        def run(self):
+                db = connect(self.path)
+                while True:
+                        with self.cond:
+                                if (not self.pending and not self.pending_events
+                                                and self.written >= self.flushed):
+                                        self.cond.wait(REFRESH_INTERVAL)
+                                # Give other updates a chance to join this
+                                # commit unless someone is waiting on a flush
+                                self.cond.wait_for(
+                                                lambda: self.written < self.flushed,
+                                                self.interval)
+                                batch = self.pending
+                                events = self.pending_events
+                                self.pending = {}
+                                self.pending_events = []
+                                target = self.flushed
+
+                        retry, retry_events = {}, []
+                        if batch or events:
+                                retry, retry_events = self.commit(db, batch, events)
+
+                        with self.cond:
+                                if retry or retry_events:
+                                        # Newer values set meanwhile win
+                                        for k, v in retry.items():
+                                                self.pending.setdefault(k, v)
+                                        self.pending_events[:0] = retry_events
+                                else:
+                                        self.written = max(self.written, target)
+                                self.cond.notify_all()
+                        if retry or retry_events:
+                                # Don't spin on a locked or full disk
+                                time.sleep(self.interval)
+                        elif time.time() - self.refreshed >= REFRESH_INTERVAL:
+                                try:
+                                        self.refresh(db)
+                                except sqlite3.Error:
+                                        logging.exception("Failed to read back death counters")
+
+        def write(self, db, rows, events):
+                with db:
+                        db.executemany('INSERT OR REPLACE INTO deaths '
+                                        '(channel, game, count) VALUES (?, ?, ?)', rows)
+                        db.executemany('INSERT INTO events '
+                                        '(channel, game, session, ts) VALUES (?, ?, ?, ?)', events)
+                self.commits += 1
+                self.rows += len(rows) + len(events)
+
+        def commit(self, db, batch, events):
+                # Writes one round in a single transaction, and returns what is
+                # left to retry. Transient errors (locked, disk full) leave the
+                # whole round for next time. If the database rejects a row, the
+                # round is written one row at a time so only that row is lost.
+                rows = [(c, g, n) for (c, g), n in batch.items()]
+                try:
+                        self.write(db, rows, events)
+                        return {}, []
+                except sqlite3.OperationalError:
+                        logging.exception("Failed to commit death counters")
+                        return batch, events
+                except sqlite3.Error:
+                        logging.exception("Death counters rejected, writing them one at a time")
+
+                retry, retry_events = {}, []
+                for row in rows:
+                        try:
+                                self.write(db, [row], ())
+                        except sqlite3.OperationalError:
+                                retry[row[:2]] = row[2]
+                        except sqlite3.Error:
+                                logging.error("Dropped unwritable death counter %r", row)
+                for ev in events:
+                        try:
+                                self.write(db, (), [ev])
+                        except sqlite3.OperationalError:
+                                retry_events.append(ev)
+                        except sqlite3.Error:
+                                logging.error("Dropped unwritable death event %r", ev)
+                return retry, retry_events
+
+def legacy_entries(root='.'):
+        # Yields (channel, game, count) from the old deaths_<chan>/<game> tree
+        for d in sorted(os.listdir(root)):
+                pth = os.path.join(root, d)
+                if not d.startswith(LEGACY_PREFIX) or not os.path.isdir(pth):
+                        continue
+                chan = '#' + d[len(LEGACY_PREFIX):]
+                for fname in sorted(os.listdir(pth)):
+                        game = fname.replace('\xff', '/')
+                        try:
+                                game.encode('utf-8')
+                        except UnicodeEncodeError:
+                                logging.warning("Skipping undecodable counter %r", fname)
+                                continue
+                        try:
+                                with open(os.path.join(pth, fname), 'r') as f:
+                                        count = int(f.read())
+                        except (IOError, ValueError):
+                                logging.warning("Skipping unreadable counter %s",
+                                                os.path.join(pth, fname))
+                                continue
+                        yield chan, game, count
+
+def migrate(store, root='.'):
+        n = 0
+        for chan, game, count in legacy_entries(root):
+                store.set(chan, game, count)
+                n += 1
+        return n
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(path=DB_PATH):
+        global _shared
+        with _shared_lock:
+                if _shared is None:
+                        fresh = not os.path.exists(path)
+                        _shared = DeathStore(path)
+                        _shared.start()
+                        if fresh:
+                                n = migrate(_shared)
+                                if n:
+                                        logging.info("Imported %d legacy death counters", n)
+                return _shared
+
+if __name__ == '__main__':
+        # python -m src.storage [legacy root] [database]
+        logging.getLogger().setLevel(logging.INFO)
+        root = sys.argv[1] if len(sys.argv) > 1 else '.'
+        path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+        store = DeathStore(path)
+        store.start()
+        n = migrate(store, root)
+        store.flush()
+        print("Imported %d counters into %s" % (n, path))
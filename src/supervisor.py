@@ -0,0 +1,595 @@
+import threading, logging, time, os, tempfile, selectors, heapq, itertools
+
+from . import events, metrics, lifecycle, outgoing, dispatch
+
+MAX_STREAMS = max(1, (os.cpu_count() or 1) // 2)
+NICENESS = 10
+LOAD_LIMIT = 0.9 # refuse new analysers above this load per core
+STOP_TIMEOUT = lifecycle.STOP_TIMEOUT # between SIGTERM and SIGKILL
+REAP_POLL = 0.5 # how often running analysers are checked for having exited
+READ_SIZE = 65536
+
+# Analyser output is only logged, so a chatty or broken pipeline is cut down
+# to size: long lines are truncated, and lines past the rate are dropped
+LINE_MAX = 1024
+OUTPUT_LINES = 100 # per OUTPUT_WINDOW seconds
+OUTPUT_WINDOW = 10
+
+BACKOFF_START = 2
+BACKOFF_MAX = 300
+MAX_RESTARTS = 5
+STABLE_RUN = 120 # a run this long resets the restart backoff
+
+OUTPUT_DROPPED = metrics.counter('analyser_output_dropped',
+                'Analyser output lines dropped as noise')
+KILLED = metrics.counter('analyser_killed', 'Analysers killed after ignoring SIGTERM')
+
+class Refused(Exception):
+        pass
+
+# A single thread serving the pipes and event sockets of every analyser
+# through a selector, along with their timeouts, restarts and reaping. Nothing
+# here blocks, so one stuck analyser can't hold up the others or the bot.
+# Analyser state only changes on this thread; others hand work over with
+# call_soon and call_later.
+class IOLoop(threading.Thread):
+        def __init__(self):
+                threading.Thread.__init__(self, name='analyser-io')
+                self.daemon = True
+                self.selector = selectors.DefaultSelector()
+                self.lock = threading.Lock()
+                self.heap = [] # (when, seq, fn, args)
+                self.seq = itertools.count()
+                self.started = False
+                self.pid = os.getpid()
+                self.wake_r, self.wake_w = os.pipe()
+                os.set_blocking(self.wake_r, False)
+                os.set_blocking(self.wake_w, False)
+                self.selector.register(self.wake_r, selectors.EVENT_READ, self.drain)
+
+        def call_later(self, delay, fn, *args):
+                with self.lock:
+                        if not self.started:
+                                self.started = True
+                                self.start()
+                        heapq.heappush(self.heap,
+                                        (time.monotonic() + delay, next(self.seq), fn, args))
+                if threading.current_thread() is not self:
+                        try:
+                                os.write(self.wake_w, b'.')
+                        except BlockingIOError:
+                                pass # a wakeup is already pending
+
+        def call_soon(self, fn, *args):
+                self.call_later(0, fn, *args)
+
+        def drain(self, mask):
+                try:
+                        while os.read(self.wake_r, 4096):
+                                pass
+                except BlockingIOError:
+                        pass
+
+        def register(self, fileobj, fn):
+                # fn(mask) runs whenever fileobj is readable
+                self.selector.register(fileobj, selectors.EVENT_READ, fn)
+
+        def unregister(self, fileobj):
+                try:
+                        self.selector.unregister(fileobj)
+                except (KeyError, ValueError):
+                        pass
+
+        def abandon(self):
+                # In a forked child, the parent's descriptors are only copies
+                self.selector.close()
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+
+        def due(self):
+                # Calls whose time has come, and how long until the next one
+                now = time.monotonic()
+                calls = []
+                with self.lock:
+                        while self.heap and self.heap[0][0] <= now:
+                                calls.append(heapq.heappop(self.heap))
+                        timeout = self.heap[0][0] - now if self.heap else None
+                return calls, timeout
+
+        def invoke(self, fn, *args):
+                try:
+                        fn(*args)
+                except Exception:
+                        logging.exception("Unhandled error in analyser I/O")
+
+        def run(self):
+                while True:
+                        calls, timeout = self.due()
+                        if calls:
+                                # They may have scheduled more; look again first
+                                for _, _, fn, args in calls:
+                                        self.invoke(fn, *args)
+                                continue
+                        for key, mask in self.selector.select(timeout):
+                                self.invoke(key.data, mask)
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def io_loop():
+        # The loop of this process, made on first use: shard processes are
+        # forked, and each needs its own thread, selector and wake pipe
+        global _loop
+        with _loop_lock:
+                if _loop is not None and _loop.pid != os.getpid():
+                        _loop.abandon()
+                        _loop = None
+                if _loop is None:
+                        _loop = IOLoop()
+                return _loop
+
+# One supervised analyser pipeline, driven from the I/O loop. Output lines go
+# to the handler, and the pipeline is restarted with exponential backoff if
+# it exits abnormally. Detections and statistics come back separately as
+# binary records over a Unix socket (see events.py) and go to on_event.
+class Analyser:
+        def __init__(self, sup, key, args, cwd, slot, on_line, on_exit, on_event):
+                self.sup = sup
+                self.key = key
+                self.args = args
+                self.cwd = cwd
+                self.slot = slot
+                self.on_line = on_line
+                self.on_exit = on_exit
+                self.on_event = on_event
+                self.events_path = sup.socket_path(slot)
+                self.loop = io_loop()
+
+                # The current run
+                self.process = None
+                self.listener = None
+                self.conn = None
+                self.out = bytearray() # partial output line
+                self.skipping = False # rest of a truncated line still to come
+                self.inbox = bytearray() # partial event record
+                self.output = outgoing.TokenBucket(sup.output_lines, OUTPUT_WINDOW)
+                self.dropped = 0
+
+                self.stopping = False
+                self.done = False
+                self.restarts = 0
+                self.backoff = BACKOFF_START
+
+                # Statistics for the current run, as reported by the analyser
+                self.started = None
+                self.reset_stats()
+
+        def reset_stats(self):
+                self.fps = 0.0
+                self.source_fps = 0.0
+                self.behind = 0.0
+                self.decode_ms = 0.0
+                self.match_ms = 0.0
+                self.reports = 0
+
+        def spawn(self):
+                import subprocess
+                env = dict(os.environ)
+                env[events.ENV_VAR] = self.events_path
+                proc = subprocess.Popen(self.args, cwd=self.cwd, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                bufsize=0)
+                self.confine(proc)
+                return proc
+
+        def confine(self, proc):
+                # Priority and CPUs are set from here rather than in the child
+                # before exec: preexec_fn can deadlock in a threaded parent.
+                # The pipeline's own children, started later, inherit both.
+                cpus = self.sup.cpus_for(self.slot)
+                try:
+                        nice = os.getpriority(os.PRIO_PROCESS, 0) + self.sup.niceness
+                        os.setpriority(os.PRIO_PROCESS, proc.pid, min(nice, 19))
+                        if cpus and hasattr(os, 'sched_setaffinity'):
+                                os.sched_setaffinity(proc.pid, cpus)
+                except ProcessLookupError:
+                        pass # already gone; reaped as usual
+                except OSError:
+                        logging.warning("Unable to set the priority or CPUs of the analyser for %s",
+                                        self.key, exc_info=True)
+
+        def deliver(self, fn, *args):
+                # Readers run module code before posting to channel workers,
+                # which never block; it still runs on the timer thread, so
+                # a slow reader can't hold up the I/O loop
+                dispatch.timers.call_later(0, fn, *args)
+
+        def launch(self):
+                if self.done:
+                        return
+                if self.stopping:
+                        self.finish()
+                        return
+                self.started = time.time()
+                self.reset_stats()
+                self.listener = events.listen(self.events_path)
+                self.listener.setblocking(False)
+                try:
+                        self.process = self.spawn()
+                except OSError:
+                        logging.exception("Unable to start analyser for %s", self.key)
+                        self.close_run()
+                        self.finish()
+                        return
+
+                lifecycle.resources.add_shared(self.key, self.process)
+                self.loop.register(self.listener, self.accept)
+                os.set_blocking(self.process.stdout.fileno(), False)
+                self.loop.register(self.process.stdout, self.read_output)
+                self.loop.call_later(REAP_POLL, self.check, self.process)
+
+        def accept(self, mask):
+                try:
+                        conn, _ = self.listener.accept()
+                except BlockingIOError:
+                        return
+                # One connection per run
+                self.loop.unregister(self.listener)
+                conn.setblocking(False)
+                self.conn = conn
+                self.loop.register(conn, self.read_events)
+
+        def read_events(self, mask):
+                try:
+                        data = self.conn.recv(READ_SIZE)
+                        if not data:
+                                self.close_events()
+                                return
+                        self.inbox += data
+                        evs = events.split(self.inbox)
+                except BlockingIOError:
+                        return
+                except (OSError, ValueError):
+                        logging.exception("Bad event stream from analyser for %s",
+                                        self.key)
+                        self.close_events()
+                        return
+                for ev in evs:
+                        if ev.type == events.STATS:
+                                self.note_stats(*ev.data)
+                        if self.on_event is not None:
+                                self.deliver(self.on_event, ev)
+
+        def read_output(self, mask):
+                proc = self.process
+                try:
+                        data = os.read(proc.stdout.fileno(), READ_SIZE)
+                except BlockingIOError:
+                        return
+                if not data:
+                        # Usually the process has gone with it
+                        self.loop.unregister(proc.stdout)
+                        if self.out and not self.skipping:
+                                self.line(self.out)
+                        self.out = bytearray()
+                        if proc.poll() is not None:
+                                self.exited(proc)
+                        return
+                self.out += data
+                lines = self.out.split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                        if self.skipping:
+                                self.skipping = False
+                                continue
+                        self.line(line)
+                if len(rest) > LINE_MAX:
+                        if not self.skipping:
+                                self.line(rest)
+                                self.skipping = True
+                        rest = bytearray()
+                self.out = rest
+
+        def line(self, raw):
+                if self.output.delay(time.time()) > 0:
+                        self.dropped += 1
+                        OUTPUT_DROPPED.inc()
+                        return
+                self.output.take()
+                if self.dropped:
+                        logging.info("Dropped %d lines of output from the analyser for %s",
+                                        self.dropped, self.key)
+                        self.dropped = 0
+                # Only logged, so handled right here
+                self.on_line(raw[:LINE_MAX].decode('utf-8', 'replace') + '\n')
+
+        def check(self, proc):
+                if proc is not self.process:
+                        return
+                if proc.poll() is None:
+                        self.loop.call_later(REAP_POLL, self.check, proc)
+                else:
+                        self.exited(proc)
+
+        def exited(self, proc):
+                # Collects what is left of the run, then restarts the
+                # pipeline or gives up
+                rc = proc.returncode
+                self.close_run()
+                lifecycle.resources.retire_shared(self.key, proc)
+                self.process = None
+
+                if self.stopping or rc == 0:
+                        self.finish()
+                        return
+                if time.time() - self.started > STABLE_RUN:
+                        self.backoff = BACKOFF_START
+                        self.restarts = 0
+                self.restarts += 1
+                if self.restarts > MAX_RESTARTS:
+                        logging.warning("Analyser for %s keeps failing, giving up",
+                                        self.key)
+                        self.finish()
+                        return
+                logging.warning("Analyser for %s exited with %d, restarting in %ds",
+                                self.key, rc, self.backoff)
+                self.loop.call_later(self.backoff, self.launch)
+                self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+
+        def close_events(self):
+                if self.conn is not None:
+                        self.loop.unregister(self.conn)
+                        self.conn.close()
+                        self.conn = None
+                self.inbox = bytearray()
+
+        def close_run(self):
+                proc = self.process
+                if proc is not None:
+                        self.loop.unregister(proc.stdout)
+                        proc.stdout.close()
+                self.close_events()
+                if self.listener is not None:
+                        self.loop.unregister(self.listener)
+                        self.listener.close()
+                        self.listener = None
+                        os.unlink(self.events_path)
+                self.out = bytearray()
+                self.skipping = False
+
+        def finish(self):
+                if self.done:
+                        return
+                self.done = True
+                self.sup.release(self)
+                lifecycle.resources.retire_shared(self.key, self)
+                self.deliver(self.on_exit)
+
+        def note_stats(self, fps, behind, decode_ms, match_ms, source_fps):
+                self.fps = fps
+                self.source_fps = source_fps
+                self.behind = behind
+                self.decode_ms = decode_ms
+                self.match_ms = match_ms
+                self.reports += 1
+
+        def lag(self):
+                # Seconds behind live, as of the analyser's last report
+                return self.behind
+
+        def stop(self):
+                # Returns at once, from any thread. The process gets
+                # stop_timeout to exit on SIGTERM before it is killed, and
+                # on_exit runs once it has been reaped.
+                self.stopping = True
+                self.sup.exiting(self)
+                self.loop.call_soon(self.terminate)
+
+        def terminate(self):
+                proc = self.process
+                if proc is None:
+                        # Waiting to restart, or never started
+                        self.finish()
+                        return
+                if proc.poll() is None:
+                        proc.terminate()
+                        self.loop.call_later(self.sup.stop_timeout, self.kill, proc)
+                # check() reaps it either way
+
+        def kill(self, proc):
+                if proc.poll() is None:
+                        logging.warning("Analyser for %s ignored SIGTERM for %ds, killing it",
+                                        self.key, self.sup.stop_timeout)
+                        KILLED.inc()
+                        proc.kill()
+
+# Manages every video analyser on the machine: caps how many run at once,
+# gives each its own share of the CPU cores at reduced priority, and turns
+# new ones away while the machine is already saturated.
+class Supervisor:
+        def __init__(self):
+                self.lock = threading.Lock()
+                self.running = {} # key -> Analyser
+                # Stopped but not yet reaped; they keep their slot until then
+                self.stopping = set()
+                self.sockdir = None
+                self.configure()
+
+        def configure(self, max_streams=MAX_STREAMS, niceness=NICENESS,
+                        load_limit=LOAD_LIMIT, pin=True, slot_offset=0, total_slots=None,
+                        stop_timeout=STOP_TIMEOUT, output_lines=OUTPUT_LINES):
+                self.max_streams = max_streams
+                self.niceness = niceness
+                self.load_limit = load_limit
+                self.pin = pin
+                # When several processes share the machine, each owns the
+                # slots from slot_offset out of total_slots
+                self.slot_offset = slot_offset
+                self.total_slots = max(1, total_slots or max_streams)
+                self.stop_timeout = stop_timeout
+                self.output_lines = output_lines
+
+        def cpus_for(self, slot):
+                if not self.pin or not hasattr(os, 'sched_getaffinity'):
+                        return None
+                cpus = sorted(os.sched_getaffinity(0))
+                per = max(1, len(cpus) // self.total_slots)
+                start = ((slot + self.slot_offset) * per) % len(cpus)
+                return set(cpus[start:start+per])
+
+        def socket_path(self, slot):
+                if self.sockdir is None:
+                        self.sockdir = tempfile.mkdtemp(prefix='morbidbot-')
+                return os.path.join(self.sockdir, 'analyser-%d.sock' % slot)
+
+        def saturated(self):
+                try:
+                        load = os.getloadavg()[0]
+                except OSError:
+                        return False
+                return load / (os.cpu_count() or 1) > self.load_limit
+
+        def start(self, key, args, cwd, on_line, on_exit, on_event=None):
+                with self.lock:
+                        if key in self.running:
+                                raise Refused('already running')
+                        if len(self.running) + len(self.stopping) >= self.max_streams:
+                                raise Refused('limit of %d streams reached' % self.max_streams)
+                        if self.saturated():
+                                raise Refused('machine is saturated')
+                        used = set(a.slot for a in self.running.values())
+                        used.update(a.slot for a in self.stopping)
+                        slot = min(set(range(self.max_streams)) - used)
+                        a = Analyser(self, key, args, cwd, slot, on_line, on_exit,
+                                        on_event)
+                        self.running[key] = a
+                lifecycle.resources.add_shared(key, a)
+                a.loop.call_soon(a.launch)
+                return a
+
+        def exiting(self, a):
+                # The key is free for a new analyser straight away
+                with self.lock:
+                        if self.running.get(a.key) is a:
+                                del self.running[a.key]
+                                self.stopping.add(a)
+
+        def release(self, a):
+                with self.lock:
+                        if self.running.get(a.key) is a:
+                                del self.running[a.key]
+                        self.stopping.discard(a)
+
+        def stats(self):
+                with self.lock:
+                        running = list(self.running.values())
+                return dict((a.key, {'fps': a.fps, 'lag': a.lag(),
+                        'decode_ms': a.decode_ms, 'match_ms': a.match_ms,
+                        'restarts': a.restarts}) for a in running)
+
+analysers = Supervisor()
+
+def source_key(url, quality):
+        # Spellings of the same source share a key: scheme, "www." and the
+        # case of the host (and of Twitch channel names) don't matter
+        rest = url.strip().partition('://')[2] or url.strip()
+        host, _, path = rest.partition('/')
+        host = host.lower()
+        if host.startswith('www.'):
+                host = host[4:]
+        if host == 'twitch.tv':
+                path = path.lower()
+        return '%s/%s@%s' % (host, path.rstrip('/'), quality)
+
+# One analyser shared by every channel watching the same source. Output,
+# events and the exit are fanned out to each channel's reader.
+class SharedStream:
+        __slots__ = ('key', 'analyser', 'readers')
+
+        def __init__(self, key):
+                self.key = key
+                self.analyser = None
+                self.readers = {} # chan -> reader
+
+        def subscribers(self):
+                return list(self.readers.values())
+
+        def on_line(self, line):
+                for r in self.subscribers():
+                        r.handle(line)
+
+        def on_event(self, ev):
+                for r in self.subscribers():
+                        r.handle_event(ev)
+
+# Reference counted pipelines, one per source. The first channel to ask for a
+# source starts its analyser (with that channel's command line); the last to
+# leave stops it.
+class Streams:
+        def __init__(self, sup):
+                self.sup = sup
+                self.lock = threading.Lock()
+                self.streams = {} # key -> SharedStream
+
+        def subscribe(self, key, chan, args, cwd, reader):
+                # Returns the stream and whether it was already running.
+                # Raises Refused if a new analyser can't be started.
+                with self.lock:
+                        s = self.streams.get(key)
+                        shared = s is not None
+                        if not shared:
+                                s = SharedStream(key)
+                                s.analyser = self.sup.start(key, args, cwd, s.on_line,
+                                                lambda: self.ended(s), s.on_event)
+                                self.streams[key] = s
+                        s.readers[chan] = reader
+                lifecycle.resources.subscribe(chan, key,
+                                lambda: self.unsubscribe(key, chan))
+                return s, shared
+
+        def unsubscribe(self, key, chan):
+                with self.lock:
+                        s = self.streams.get(key)
+                        if s is None or chan not in s.readers:
+                                return
+                        reader = s.readers.pop(chan)
+                        last = not s.readers
+                        if last:
+                                del self.streams[key]
+                lifecycle.resources.unsubscribe(chan, key)
+                if last:
+                        s.analyser.stop()
+                reader.finish()
+
+        def ended(self, s):
+                # The analyser stopped or gave up; everyone still watching hears
+                with self.lock:
+                        if self.streams.get(s.key) is s:
+                                del self.streams[s.key]
+                        readers = s.readers
+                        s.readers = {}
+                for chan, r in readers.items():
+                        lifecycle.resources.unsubscribe(chan, s.key)
+                        r.finish()
+
+        def stats(self):
+                with self.lock:
+                        return dict((k, sorted(s.readers)) for k, s in self.streams.items())
+
+streams = Streams(analysers)
+
+def analyser_gauge(field):
+        return lambda: dict(((k,), v[field]) for k, v in analysers.stats().items())
+
+metrics.gauge('analyser_fps', 'Frames per second the analyser is processing',
+                ('stream',), analyser_gauge('fps'))
+metrics.gauge('analyser_lag_seconds', 'How far the analyser is behind live',
+                ('stream',), analyser_gauge('lag'))
+metrics.gauge('analyser_decode_ms', 'Decode time per analysed frame',
+                ('stream',), analyser_gauge('decode_ms'))
+metrics.gauge('analyser_match_ms', 'Match time per analysed frame',
+                ('stream',), analyser_gauge('match_ms'))
+metrics.gauge('analyser_restarts', 'Analyser restarts since it was started',
+                ('stream',), analyser_gauge('restarts'))
+metrics.gauge('analyser_subscribers', 'Channels sharing each analyser',
+                ('stream',), lambda: dict(((k,), len(v)) for k, v in streams.stats().items()))
@@ -0,0 +1,235 @@
+import threading, collections, time, logging
+
+from . import metrics
+
+TWITCH_API = 'https://api.twitch.tv/kraken/'
+HEADERS = {'accept': 'application/vnd.twitchtv.v3+json'}
+
+CACHE_TTL = 60
+CACHE_SIZE = 1024
+REFRESH_INTERVAL = 30
+FETCH_TIMEOUT = 10
+BATCH_SIZE = 100
+FETCH_WORKERS = 8 # offline channels refetched at once
+
+REQUEST_TIME = metrics.histogram('twitch_request_seconds',
+                'Twitch API request latency', ('endpoint',))
+REQUEST_ERRORS = metrics.counter('twitch_request_errors', 'Failed Twitch API requests',
+                ('endpoint',))
+CACHE_LOOKUPS = metrics.counter('twitch_cache_lookups', 'Channel metadata lookups',
+                ('result',))
+
+class NotCached(IOError):
+        pass
+
+def channel_name(chan):
+        return chan.lstrip('#').lower()
+
+# Shared cache of Twitch channel metadata. Lookups are only ever served from
+# memory; missing and stale entries are fetched in the background, and
+# concurrent fetches of the same channel share a single request.
+class ChannelInfo:
+        def __init__(self, ttl=CACHE_TTL, size=CACHE_SIZE,
+                        interval=REFRESH_INTERVAL):
+                self.ttl = ttl
+                self.size = size
+                self.interval = interval
+
+                self.cache = collections.OrderedDict() # name -> (time, info)
+                self.pending = {} # name -> Event for in-flight fetches
+                self.stale = set() # names waiting for a background refresh
+                self.watched = set() # channels refreshed in batches
+                self.live = {} # name -> stream object from the last batch
+                self.live_at = 0.0 # when that batch came in
+                self.lock = threading.Lock()
+                self.wake = threading.Event()
+                self.refresher = None
+                self.session = None
+                self.pool = None
+
+                # Statistics
+                self.hits = 0
+                self.misses = 0
+                self.fetches = 0
+                self.batches = 0
+
+        def watch(self, chan):
+                with self.lock:
+                        self.watched.add(channel_name(chan))
+                self.wake.set()
+
+        def unwatch(self, chan):
+                with self.lock:
+                        self.watched.discard(channel_name(chan))
+
+        def start(self):
+                if self.refresher is not None:
+                        return
+                self.refresher = threading.Thread(target=self.refresh_loop,
+                                name='twitch-refresh')
+                self.refresher.daemon = True
+                self.refresher.start()
+
+        def http(self):
+                # Pooled keep-alive connections shared by every lookup. requests
+                # is slow to import, so it waits until the first lookup.
+                import requests, requests.adapters
+                with self.lock:
+                        if self.session is None:
+                                session = requests.Session()
+                                session.headers.update(HEADERS)
+                                adapter = requests.adapters.HTTPAdapter(pool_connections=2,
+                                                pool_maxsize=16)
+                                session.mount('https://', adapter)
+                                self.session = session
+                        return self.session
+
+        def request(self, endpoint, url, params=None):
+                session = self.http()
+                try:
+                        with REQUEST_TIME.time(endpoint):
+                                r = session.get(url, params=params, timeout=FETCH_TIMEOUT)
+                        r.raise_for_status()
+                except Exception:
+                        REQUEST_ERRORS.inc(endpoint)
+                        raise
+                return r
+
+        def store(self, name, info):
+                with self.lock:
+                        self.cache[name] = (time.time(), info)
+                        self.cache.move_to_end(name)
+                        while len(self.cache) > self.size:
+                                self.cache.popitem(last=False)
+
+        def fetch(self, name):
+                with self.lock:
+                        ev = self.pending.get(name)
+                        leader = ev is None
+                        if leader:
+                                ev = threading.Event()
+                                self.pending[name] = ev
+
+                if not leader:
+                        # Someone else is already asking; wait for their answer
+                        ev.wait(FETCH_TIMEOUT)
+                        with self.lock:
+                                ent = self.cache.get(name)
+                        if ent is None:
+                                raise IOError('Unable to look up channel %s' % name)
+                        return ent[1]
+
+                try:
+                        self.fetches += 1
+                        r = self.request('channels', TWITCH_API+'channels/'+name)
+                        info = r.json()
+                        self.store(name, info)
+                        return info
+                finally:
+                        with self.lock:
+                                del self.pending[name]
+                        ev.set()
+
+        def cached_game(self, chan):
+                # For the chat path: never waits on Twitch. Raises NotCached
+                # until the refresher has fetched the channel.
+                info = self.peek(chan)
+                if info is None:
+                        raise NotCached('No metadata for %s yet' % chan)
+                return info['game']
+
+        def peek(self, chan):
+                # Never touches the network; None if nothing is cached yet.
+                # Missing and expired entries are left to the refresher.
+                name = channel_name(chan)
+                with self.lock:
+                        ent = self.cache.get(name)
+                        if ent is None or time.time() - ent[0] > self.ttl:
+                                self.stale.add(name)
+                                self.wake.set()
+                        if ent is not None:
+                                self.cache.move_to_end(name)
+
+                if ent is None:
+                        self.misses += 1
+                        CACHE_LOOKUPS.inc('miss')
+                        return None
+                self.hits += 1
+                CACHE_LOOKUPS.inc('hit')
+                return ent[1]
+
+        def stream(self, chan):
+                # Current broadcast as of the last batch refresh, None if
+                # offline, or if refreshes have been failing for a while
+                if time.time() - self.live_at > 3 * self.interval:
+                        return None
+                return self.live.get(channel_name(chan))
+
+        def expired(self, name):
+                with self.lock:
+                        ent = self.cache.get(name)
+                return ent is None or time.time() - ent[0] > self.ttl
+
+        def refresh_all(self):
+                with self.lock:
+                        names = sorted(self.watched)
+
+                # Live channels come back in a single request per batch
+                live = {}
+                for i in range(0, len(names), BATCH_SIZE):
+                        chunk = names[i:i+BATCH_SIZE]
+                        params = {'channel': ','.join(chunk), 'limit': BATCH_SIZE}
+                        r = self.request('streams', TWITCH_API+'streams', params)
+                        self.batches += 1
+                        for s in r.json().get('streams', []):
+                                info = s['channel']
+                                self.store(info['name'], info)
+                                live[info['name']] = s
+                self.live = live
+                self.live_at = time.time()
+
+                # Offline channels are only refetched once their entry
+                # expires, a few at a time
+                self.fetch_all([n for n in names if n not in live and self.expired(n)])
+
+        def fetch_all(self, names):
+                if not names:
+                        return
+                if self.pool is None:
+                        import concurrent.futures
+                        self.pool = concurrent.futures.ThreadPoolExecutor(FETCH_WORKERS,
+                                        thread_name_prefix='twitch-fetch')
+                futures = [self.pool.submit(self.fetch, n) for n in names]
+                failed = sum(1 for f in futures if f.exception() is not None)
+                if failed:
+                        logging.warning("Failed to refresh %d of %d channels", failed,
+                                        len(names))
+
+        def refresh_loop(self):
+                last = 0
+                while True:
+                        self.wake.wait(self.interval)
+                        self.wake.clear()
+
+                        try:
+                                if time.time() - last >= self.interval:
+                                        last = time.time()
+                                        self.refresh_all()
+
+                                with self.lock:
+                                        stale = self.stale
+                                        self.stale = set()
+                                self.fetch_all([n for n in stale if self.expired(n)])
+                        except Exception:
+                                logging.exception("Channel metadata refresh failed")
+
+        def stats(self):
+                return {
+                        'entries': len(self.cache),
+                        'hits': self.hits,
+                        'misses': self.misses,
+                        'fetches': self.fetches,
+                        'batches': self.batches,
+                }
+
+channels = ChannelInfo()
@@ -0,0 +1,64 @@
+import subprocess, threading, logging
+
+# In-process alternative to running morbidcv as livestreamer's player. A feed
+# decodes a stream once with OpenCV and hands every frame to any number of
+# morbidcv.Detector instances (built from native/ with -DBUILD_PYTHON=ON).
+# Nothing in the bot uses it yet; overwatch runs the subprocess pipeline.
+#
+# Detectors are only ever fed from the feed's own thread; a Detector must not
+# be subscribed to two feeds at once.
+
+def resolve(url, quality='best'):
+        # Ask livestreamer for the direct media URL so OpenCV can open it
+        out = subprocess.check_output(['livestreamer', '--stream-url', url, quality],
+                        universal_newlines=True)
+        return out.strip()
+
+class VideoFeed(threading.Thread):
+        def __init__(self, source):
+                threading.Thread.__init__(self, name='videofeed')
+                self.daemon = True
+
+                self.source = source
+                self.lock = threading.Lock()
+                self.detectors = {} # key -> (Detector, callback)
+                self.stopping = threading.Event()
+                self.frames = 0
+
+        def subscribe(self, key, detector, callback):
+                # callback(event, frame_index, timestamp) runs on the feed thread
+                with self.lock:
+                        self.detectors[key] = (detector, callback)
+
+        def unsubscribe(self, key):
+                with self.lock:
+                        self.detectors.pop(key, None)
+                        return len(self.detectors)
+
+        def stop(self):
+                self.stopping.set()
+
+        def run(self):
+                import cv2
+                cap = cv2.VideoCapture(self.source)
+                if not cap.isOpened():
+                        logging.warning("Unable to open video source %s", self.source)
+                        return
+                try:
+                        while not self.stopping.is_set():
+                                ok, frame = cap.read()
+                                if not ok:
+                                        break
+                                self.frames += 1
+                                ts = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+
+                                with self.lock:
+                                        detectors = list(self.detectors.values())
+                                # Detectors release the GIL while matching and
+                                # share the decoded frame without copying it
+                                for det, cb in detectors:
+                                        ev = det.feed(frame, ts)
+                                        if ev is not None:
+                                                cb(*ev)
+                finally:
+                        cap.release()